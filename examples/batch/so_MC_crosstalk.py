@@ -12,7 +12,7 @@ from __future__ import division, absolute_import, print_function
 from mpi4py import MPI
 
 ## Import modules and routines
-from s4cmb.input_sky import HealpixFitsMap
+from s4cmb.input_sky import load_healpix_fits_map_on_node
 
 from s4cmb.instrument import Hardware
 
@@ -146,15 +146,17 @@ if __name__ == "__main__":
     ##   sky -> instrument -> scanning strategy ->
     ##      MAP2TOD -> (systematics) -> TOD2MAP
     ##################################################################
-    ## Initialise our input maps
-    sky_in = HealpixFitsMap(params.input_filename,
-                            fwhm_in=params.fwhm_in,
-                            nside_in=params.nside_in,
-                            map_seed=params.map_seed,
-                            do_pol=params.do_pol,
-                            verbose=params.verbose,
-                            no_ileak=params.no_ileak,
-                            no_quleak=params.no_quleak)
+    ## Initialise our input maps, once per node (shared by all
+    ## the processors of the node).
+    sky_in = load_healpix_fits_map_on_node(params.input_filename,
+                                           fwhm_in=params.fwhm_in,
+                                           nside_in=params.nside_in,
+                                           map_seed=params.map_seed,
+                                           do_pol=params.do_pol,
+                                           verbose=params.verbose,
+                                           no_ileak=params.no_ileak,
+                                           no_quleak=params.no_quleak,
+                                           comm=MPI.COMM_WORLD)
 
     ## Initialise our instrument
     inst = Hardware(ncrate=params.ncrate,
@@ -277,3 +279,6 @@ if __name__ == "__main__":
                 epsilon=0.08, HWP=False)
 
     MPI.COMM_WORLD.barrier()
+
+    ## Release the input maps shared on the node (collective)
+    sky_in.free_shared_maps()
@@ -53,6 +53,33 @@ def compare_version_number(version, threshold):
             return False
     return True
 
+def get_float_dtype(precision):
+    """
+    Return the floating point type corresponding to a precision.
+
+    Parameters
+    ----------
+    precision: string
+        `double` (float64) or `single` (float32).
+
+    Returns
+    ----------
+    dtype: numpy type
+        np.float64 or np.float32.
+
+    Examples
+    ----------
+    >>> get_float_dtype('single')
+    <class 'numpy.float32'>
+
+    """
+    assert precision in ['double', 'single'], \
+        ValueError("Precision <{}> not understood! ".format(precision) +
+                   "Choose among ['double', 'single'].")
+    if precision == 'single':
+        return np.float32
+    return np.float64
+
 def import_string_as_module(fn_full):
     """
     Import module from its name given as a string.
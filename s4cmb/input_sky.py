@@ -11,12 +11,22 @@ from __future__ import division, absolute_import, print_function
 
 import glob
 import os
+# Python3 does not have the cPickle module
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import healpy as hp
 import numpy as np
 from astropy.io import fits as pyfits
 
 from s4cmb.config_s4cmb import compare_version_number
+from s4cmb.config_s4cmb import get_float_dtype
+
+## Names of the map attributes of HealpixFitsMap
+MAP_NAMES = ['I', 'Q', 'U', 'I2', 'Q2', 'U2',
+             'dIdt', 'dIdp', 'd2Id2t', 'd2Idpdt', 'd2Id2p']
 
 class HealpixFitsMap():
     """ Class to handle fits file containing healpix maps """
@@ -24,7 +34,7 @@ class HealpixFitsMap():
                  do_pol=True, verbose=False, fwhm_in=0.0, fwhm_in2=None,
                  nside_in=16, lmax=None, map_seed=53543, no_ileak=False,
                  no_quleak=False, compute_derivatives=False,
-                 ext_map_gal=False):
+                 ext_map_gal=False, precision='double'):
         """
 
         Parameters
@@ -73,6 +83,10 @@ class HealpixFitsMap():
             dI/dt, dI/dp, d2I/d2t, d2I/d2p, d2I/dtdp.
             Note that dI/dp is already divided by sin(theta).
             Be sure that you have enough memory!
+        precision : string, optional
+            Floating point precision of the maps in memory: `double` (float64)
+            or `single` (float32). Maps are created or read in double
+            precision, and then converted. Default is `double`.
 
         """
         self.input_filename = input_filename
@@ -90,6 +104,8 @@ class HealpixFitsMap():
             self.lmax = lmax
         self.map_seed = map_seed
         self.compute_derivatives = compute_derivatives
+        self.precision = precision
+        self.dtype = get_float_dtype(self.precision)
 
         self.I = None
         self.Q = None
@@ -99,6 +115,18 @@ class HealpixFitsMap():
         self.Q2 = None
         self.U2 = None
 
+        ## Only set if several sky realisations are scanned at once
+        ## (see set_stack).
+        self.stack = None
+        self.stack_interleaved = False
+        self.nstack = 0
+
+        ## Only set if the maps are restricted to a sky patch
+        ## (see restrict_to_patch).
+        self.patch_pixels = None
+        self.patch_lookup = None
+        self.patch_boundaries = None
+
         fromalms = False
         if type(self.input_filename) == list:
             if self.verbose:
@@ -126,6 +154,26 @@ class HealpixFitsMap():
         if self.compute_derivatives:
             self.compute_intensity_derivatives(fromalm=fromalms)
 
+        self.set_precision()
+
+    def set_precision(self):
+        """
+        Convert the maps in memory to the precision of the instance.
+
+        Examples
+        ----------
+        >>> filename = 's4cmb/data/test_data_set_lensedCls.dat'
+        >>> hpmap = HealpixFitsMap(input_filename=filename, nside_in=16,
+        ...     map_seed=489237, precision='single')
+        >>> print(hpmap.I.dtype, hpmap.U.dtype)
+        float32 float32
+        """
+        for name in MAP_NAMES:
+            m = getattr(self, name, None)
+            if m is not None:
+                setattr(self, name, np.asarray(m).astype(
+                    self.dtype, copy=False))
+
     def load_healpix_fits_map(self, force=False):
         """
         Load from disk into memory a sky map.
@@ -406,6 +454,568 @@ class HealpixFitsMap():
         junk, self.d2Idpdt, self.d2Id2p = hp.alm2map_der1(
             alm_der1_phi, self.nside_in, self.lmax)
 
+    def restrict_to_patch(self, xmin, xmax, ymin, ymax, margin=0.0):
+        """
+        Keep in memory only the pixels of the input maps which fall inside a
+        sky patch (plus a margin), and discard the rest of the sky.
+        The maps (I, Q, U, their second set for dichroic detectors, and the
+        derivatives if computed) are stored contiguously in the order of
+        `patch_pixels`, and `patch_lookup` can be used to go from
+        global (full sky) indices to local (patch) indices.
+
+        Each compact map has one extra trailing element set to zero, such
+        that samples falling outside the patch (local index -1) read a
+        null signal.
+
+        Parameters
+        ----------
+        xmin : float
+            RA min of the patch in radian.
+        xmax : float
+            RA max of the patch in radian.
+        ymin : float
+            Dec min of the patch in radian.
+        ymax : float
+            Dec max of the patch in radian.
+        margin : float, optional
+            Extra margin added on each side of the patch in radian.
+            Typically the size of the focal plane projected on the sky.
+            In RA, it is divided by the cosine of the largest declination
+            of the patch (all RA are kept close to the poles).
+
+        Examples
+        ----------
+        >>> filename = 's4cmb/data/test_data_set_lensedCls.dat'
+        >>> hpmap = HealpixFitsMap(input_filename=filename, fwhm_in=3.5,
+        ...     nside_in=16, map_seed=489237)
+        >>> I_full = hpmap.I.copy()
+        >>> hpmap.restrict_to_patch(-np.pi/8, np.pi/8, -np.pi/8, np.pi/8)
+        >>> print(len(hpmap.patch_pixels), len(hpmap.I))
+        145 146
+
+        Values are retrieved using local indices
+        >>> local = hpmap.patch_lookup.get_local(hpmap.patch_pixels[:3])
+        >>> assert np.all(hpmap.I[local] == I_full[hpmap.patch_pixels[:3]])
+
+        Pixels outside the patch read zero
+        >>> print(hpmap.I[hpmap.patch_lookup.get_local(0)])
+        0.0
+
+        The margin is an angular distance, also in RA at high declination
+        >>> hpmap = HealpixFitsMap(input_filename=filename, fwhm_in=3.5,
+        ...     nside_in=16, map_seed=489237)
+        >>> hpmap.restrict_to_patch(-0.1, 0.1, 1.2, 1.3, margin=0.1)
+        >>> theta, phi = hp.pix2ang(16, 41)
+        >>> print(round(np.pi / 2 - theta, 3), round(phi, 3))
+        1.315 0.471
+        >>> assert 41 in hpmap.patch_pixels
+
+        The patch (with margin) can cross RA = +/- pi
+        >>> hpmap = HealpixFitsMap(input_filename=filename, fwhm_in=3.5,
+        ...     nside_in=16, map_seed=489237)
+        >>> hpmap.restrict_to_patch(-np.pi, -np.pi + 0.2, 0., 0.2,
+        ...     margin=0.1)
+        >>> pix = hp.ang2pix(16, np.pi / 2 - 0.1, np.pi - 0.05)
+        >>> assert pix in hpmap.patch_pixels
+
+        The restriction cannot be undone
+        >>> hpmap.restrict_to_patch(-np.pi/4, np.pi/4, -np.pi/4, np.pi/4)
+        ... # doctest: +NORMALIZE_WHITESPACE, +ELLIPSIS
+        Traceback (most recent call last):
+         ...
+        ValueError: Input maps are already restricted to a different patch!
+        """
+        boundaries = (xmin, xmax, ymin, ymax, margin)
+        if self.patch_pixels is not None:
+            if np.allclose(boundaries, self.patch_boundaries):
+                return
+            raise ValueError(
+                "Input maps are already restricted to a different patch!")
+
+        ## Observed pixels in the input resolution, with margin.
+        ## Along RA, the margin is stretched by 1 / cos(dec) at the largest
+        ## declination (clamped at the poles, where all RA are kept).
+        ## Pixels are selected by their RA difference with the centre of
+        ## the patch (wrapped in [-pi, pi]), so that the interval can cross
+        ## RA = +/- pi.
+        ymin_m = max(ymin - margin, -np.pi / 2)
+        ymax_m = min(ymax + margin, np.pi / 2)
+        cosdec = max(np.cos(max(abs(ymin_m), abs(ymax_m))), 1e-6)
+        pixels = get_obspix(-np.pi, np.pi, ymin_m, ymax_m, self.nside)
+        halfwidth = (xmax - xmin) / 2. + margin / cosdec
+        if halfwidth < np.pi:
+            phi = hp.pix2ang(self.nside, pixels)[1]
+            dphi = (phi - (xmin + xmax) / 2. + np.pi) % (2 * np.pi) - np.pi
+            pixels = pixels[np.abs(dphi) <= halfwidth]
+
+        ## The patch is defined in celestial coordinates.
+        ## If maps are in Galactic coordinates, rotate the pixels and
+        ## include their neighbours to fill holes due to the rotation.
+        if self.ext_map_gal:
+            theta, phi = hp.pix2ang(self.nside, pixels)
+            r = hp.Rotator(coord=['C', 'G'])
+            theta, phi = r(theta, phi)
+            pixels = hp.ang2pix(self.nside, theta, phi)
+            neighbours = hp.get_all_neighbours(self.nside, pixels).flatten()
+            pixels = np.unique(
+                np.concatenate((pixels, neighbours[neighbours >= 0])))
+
+        for name in MAP_NAMES:
+            fullmap = getattr(self, name, None)
+            if fullmap is not None:
+                setattr(self, name, np.append(
+                    fullmap[pixels], np.zeros(1, dtype=fullmap.dtype)))
+
+        if self.stack is not None:
+            self.stack = restrict_stack(
+                self.stack, pixels, self.stack_interleaved)
+
+        self.patch_pixels = pixels
+        self.patch_lookup = PixelLookupTable(pixels)
+        self.patch_boundaries = boundaries
+
+    def set_stack(self, maps, interleaved=False):
+        """
+        Store a stack of N sky realisations (I, Q, U), to be scanned all
+        at once (see TimeOrderedDataPairDiff.scan_and_bin_stack): the
+        pointing is then computed once for all the realisations.
+
+        Parameters
+        ----------
+        maps : ndarray
+            Sky realisations, of shape (N, 3, npix). Maps are either
+            full sky (at the resolution of the instance), or already
+            restricted to the patch (see restrict_to_patch).
+        interleaved : bool, optional
+            If True, store the realisations interleaved (npix, 3, N), such
+            that all the values needed for one time sample are contiguous
+            in memory. Otherwise, store them as (N, 3, npix).
+            Default is False.
+
+        Examples
+        ----------
+        >>> filename = 's4cmb/data/test_data_set_lensedCls.dat'
+        >>> hpmap = HealpixFitsMap(input_filename=filename, nside_in=16,
+        ...     map_seed=489237)
+        >>> IQU = np.array([hpmap.I, hpmap.Q, hpmap.U])
+        >>> hpmap.set_stack([IQU, 2 * IQU], interleaved=True)
+        >>> print(hpmap.stack.shape)
+        (3072, 3, 2)
+        >>> print(hpmap.get_stack(np.array([0, 1, 2])).shape)
+        (2, 3, 3)
+
+        Restricting to a patch also restricts the realisations
+        >>> hpmap.restrict_to_patch(-np.pi/8, np.pi/8, -np.pi/8, np.pi/8)
+        >>> local = hpmap.patch_lookup.get_local(hpmap.patch_pixels[:3])
+        >>> assert np.all(hpmap.get_stack(local)[1, 0] == 2 * hpmap.I[local])
+        """
+        maps = np.asarray(maps, dtype=self.dtype)
+        assert maps.ndim == 3 and maps.shape[1] == 3, \
+            ValueError("The stack of maps must have shape (N, 3, npix).")
+
+        if interleaved:
+            maps = np.ascontiguousarray(maps.transpose((2, 1, 0)))
+
+        npix = maps.shape[0] if interleaved else maps.shape[-1]
+        if self.patch_pixels is not None and npix == 12 * self.nside**2:
+            maps = restrict_stack(maps, self.patch_pixels, interleaved)
+        else:
+            assert npix == len(self.I), \
+                ValueError("Maps in the stack must have {} pixels.".format(
+                    len(self.I)))
+
+        self.stack = maps
+        self.stack_interleaved = interleaved
+        self.nstack = maps.shape[-1] if interleaved else maps.shape[0]
+
+    def get_stack(self, index):
+        """
+        Return the values of all the sky realisations of the stack
+        (see set_stack) for the pixels `index`.
+
+        Parameters
+        ----------
+        index : 1d array of int
+            Pixel indices (as for the maps I, Q, U).
+
+        Returns
+        ----------
+        values : ndarray
+            Array of shape (N, 3, len(index)).
+        """
+        if self.stack_interleaved:
+            return self.stack[index].transpose((2, 1, 0))
+        return self.stack[:, :, index]
+
+    def share_maps(self, backend='multiprocessing'):
+        """
+        Move the maps into shared memory, and expose them read-only.
+
+        With the `multiprocessing` backend, the maps are copied into
+        multiprocessing.shared_memory blocks. Pickling the instance (e.g.
+        when sending it to workers of a multiprocessing.Pool) only sends the
+        names of the blocks, and the workers attach to the same memory.
+        For MPI runs, use load_healpix_fits_map_on_node instead, which
+        builds the maps only once per node.
+
+        Parameters
+        ----------
+        backend : string, optional
+            Only `multiprocessing` is available here (python >= 3.8).
+
+        Examples
+        ----------
+        >>> filename = 's4cmb/data/test_data_set_lensedCls.dat'
+        >>> hpmap = HealpixFitsMap(input_filename=filename, nside_in=16,
+        ...     map_seed=489237)
+        >>> I = hpmap.I.copy()
+        >>> hpmap.share_maps()
+        >>> assert np.all(hpmap.I == I)
+        >>> hpmap.I.flags.writeable
+        False
+
+        A copy sent to another process reads the same memory
+        >>> hpmap2 = pickle.loads(pickle.dumps(hpmap))
+        >>> assert np.all(hpmap2.I == I)
+        >>> hpmap2.free_shared_maps()
+        >>> hpmap.free_shared_maps()
+        """
+        if backend != 'multiprocessing':
+            raise ValueError("Backend <{}> not understood! ".format(backend) +
+                             "Use load_healpix_fits_map_on_node for MPI.")
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise ImportError("multiprocessing.shared_memory requires " +
+                              "python >= 3.8.")
+
+        self.shared_blocks = {}
+        for name in MAP_NAMES + ['stack']:
+            m = getattr(self, name, None)
+            if m is None:
+                continue
+            m = np.asarray(m)
+            block = shared_memory.SharedMemory(
+                create=True, size=max(m.nbytes, 1))
+            shared = np.ndarray(m.shape, dtype=m.dtype, buffer=block.buf)
+            shared[:] = m
+            shared.flags.writeable = False
+            setattr(self, name, shared)
+            self.shared_blocks[name] = block
+        self.shared_owner = True
+
+    def free_shared_maps(self):
+        """
+        Release the shared memory used by the maps (see share_maps and
+        load_healpix_fits_map_on_node). The maps are not usable anymore
+        afterwards. The shared memory is destroyed only when released by
+        its owner (the process which created it).
+        """
+        for name, block in getattr(self, 'shared_blocks', {}).items():
+            setattr(self, name, None)
+            block.close()
+            if self.shared_owner:
+                block.unlink()
+        self.shared_blocks = {}
+
+        for name, win in getattr(self, 'shared_windows', {}).items():
+            setattr(self, name, None)
+            win.Free()
+        self.shared_windows = {}
+
+    def __getstate__(self):
+        """
+        Do not pickle maps stored in shared memory, but only the information
+        needed to attach to them (multiprocessing backend). MPI windows and
+        communicators are never pickled.
+        """
+        state = self.__dict__.copy()
+        state.pop('shared_windows', None)
+        state.pop('node_comm', None)
+        blocks = state.pop('shared_blocks', None)
+        if blocks:
+            state['shared_blocks_info'] = {}
+            for name, block in blocks.items():
+                m = state.pop(name)
+                state['shared_blocks_info'][name] = (
+                    block.name, m.shape, m.dtype.str)
+        return state
+
+    def __setstate__(self, state):
+        """
+        Re-attach to the shared memory blocks if needed.
+        """
+        info = state.pop('shared_blocks_info', None)
+        self.__dict__.update(state)
+        if info:
+            from multiprocessing import shared_memory
+            self.shared_blocks = {}
+            self.shared_owner = False
+            for name, (blockname, shape, dtype) in info.items():
+                block = shared_memory.SharedMemory(name=blockname)
+                shared = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+                shared.flags.writeable = False
+                setattr(self, name, shared)
+                self.shared_blocks[name] = block
+
+
+def restrict_stack(stack, pixels, interleaved=False):
+    """
+    Keep only the pixels `pixels` of a stack of sky realisations (see
+    HealpixFitsMap.set_stack), and append one trailing pixel set to zero
+    (see HealpixFitsMap.restrict_to_patch).
+
+    Parameters
+    ----------
+    stack : ndarray
+        Stack of maps (N, 3, npix), or (npix, 3, N) if interleaved.
+    pixels : 1d array of int
+        Pixels to keep.
+    interleaved : bool, optional
+        Layout of the stack. Default is False.
+
+    Returns
+    ----------
+    stack : ndarray
+        The restricted stack.
+
+    Examples
+    ----------
+    >>> stack = np.ones((2, 3, 12))
+    >>> print(restrict_stack(stack, np.arange(4)).shape)
+    (2, 3, 5)
+    """
+    axis = 0 if interleaved else -1
+    restricted = np.take(stack, pixels, axis=axis)
+    shape = list(restricted.shape)
+    shape[axis] = 1
+    return np.concatenate(
+        (restricted, np.zeros(shape, dtype=stack.dtype)), axis=axis)
+
+
+class PixelLookupTable():
+    """ Class to convert global pixel indices into local indices """
+    def __init__(self, pixels, mode='auto', max_dense_ratio=16, nest=False):
+        """
+        Lookup table from global pixel indices to their position in
+        the array `pixels` (typically the pixels of a sky patch).
+
+        In `dense` mode, the table spans the range [min(pixels), max(pixels)]
+        which, in the RING scheme, is a contiguous band of rings containing
+        the patch. This replaces a binary search per sample by a
+        single gather.
+        For very high resolution, this band can be much bigger than the patch
+        itself. The `ranges` mode stores instead the runs of consecutive
+        pixels (one per ring crossing the patch in the RING scheme), and
+        searches only among the runs.
+
+        Parameters
+        ----------
+        pixels : 1d array of int
+            Global indices of the pixels (unique). Their position in the array
+            defines their local index.
+        mode : string, optional
+            `dense`, `ranges` or `auto`. With `auto`, the dense table is used
+            unless it is more than max_dense_ratio times bigger than the
+            number of pixels. Default is `auto`.
+        max_dense_ratio : int, optional
+            See mode. Default is 16.
+        nest : bool, optional
+            Set it to True if pixels are indices in the NESTED scheme.
+            Only stored, so that users of the table know which pixel
+            indices to look up. Default is False (RING).
+
+        Examples
+        ----------
+        >>> lookup = PixelLookupTable(np.array([10, 12, 13, 20]))
+        >>> print(lookup.mode)
+        dense
+        >>> print(lookup.get_local(np.array([12, 20, 11, 3, 400])))
+        [ 1  3 -1 -1 -1]
+
+        >>> lookup = PixelLookupTable(np.array([10, 12, 13, 20]),
+        ...     mode='ranges')
+        >>> print(lookup.get_local(np.array([12, 20, 11, 3, 400])))
+        [ 1  3 -1 -1 -1]
+        """
+        self.pixels = np.asarray(pixels)
+        self.nest = nest
+        assert self.pixels.size > 0, \
+            ValueError("You need at least one pixel to build the table!")
+
+        self.npix = self.pixels.size
+        self.offset = int(np.min(self.pixels))
+        size = int(np.max(self.pixels)) - self.offset + 1
+
+        if mode == 'auto':
+            if size <= max_dense_ratio * self.npix:
+                mode = 'dense'
+            else:
+                mode = 'ranges'
+        assert mode in ['dense', 'ranges'], \
+            ValueError("Mode <{}> not understood! ".format(mode) +
+                       "Choose among ['auto', 'dense', 'ranges'].")
+        self.mode = mode
+
+        if self.mode == 'dense':
+            self.table = np.empty(size, dtype=np.int32)
+            self.table.fill(-1)
+            self.table[self.pixels - self.offset] = np.arange(
+                self.npix, dtype=np.int32)
+        else:
+            ## Runs of consecutive pixels
+            order = np.argsort(self.pixels)
+            sorted_pixels = self.pixels[order]
+            run_first = np.concatenate(
+                ([0], np.where(np.diff(sorted_pixels) != 1)[0] + 1))
+            self.run_starts = sorted_pixels[run_first]
+            self.run_first = run_first
+            self.run_lengths = np.diff(np.append(run_first, self.npix))
+            self.sorted_local = order.astype(np.int32)
+
+    def get_local(self, index_global):
+        """
+        Return the local indices of global pixel indices.
+
+        Parameters
+        ----------
+        index_global : int or 1d array of int
+            Global pixel indices.
+
+        Returns
+        ----------
+        index_local : int or 1d array of int
+            Local indices (int32). -1 for pixels not in the table.
+        """
+        if self.mode == 'dense':
+            idx = np.asarray(index_global) - self.offset
+            inside = (idx >= 0) & (idx < self.table.size)
+            index_local = self.table.take(np.where(inside, idx, 0))
+        else:
+            index_global = np.asarray(index_global)
+            run = self.run_starts.searchsorted(index_global, 'right') - 1
+            run_safe = np.maximum(run, 0)
+            shift = index_global - self.run_starts[run_safe]
+            inside = (run >= 0) & (shift < self.run_lengths[run_safe])
+            pos = np.where(inside, self.run_first[run_safe] + shift, 0)
+            index_local = self.sorted_local.take(pos)
+        if index_local.ndim == 0:
+            return index_local if inside else np.int32(-1)
+        index_local[~inside] = -1
+        return index_local
+
+
+def load_healpix_fits_map_on_node(*args, **kwargs):
+    """
+    Build the input sky maps once per node, and expose them read-only
+    to all the MPI ranks of the node via MPI-3 shared memory windows.
+    Only the first rank of each node reads/creates the maps, so that the
+    number of ranks per node is not limited by the memory of the maps.
+
+    Parameters
+    ----------
+    *args, **kwargs
+        Arguments passed to HealpixFitsMap.
+    comm : MPI communicator, optional
+        Keyword argument only. Communicator of all processes.
+        Default is MPI.COMM_WORLD.
+
+    Returns
+    ----------
+    sky : HealpixFitsMap instance
+        Instance whose maps live in the node shared memory.
+        Call sky.free_shared_maps() (collectively) to release the memory.
+
+    Examples
+    ----------
+    >>> filename = 's4cmb/data/test_data_set_lensedCls.dat'
+    >>> hpmap = load_healpix_fits_map_on_node(
+    ...     filename, nside_in=16, map_seed=489237)
+    >>> hpmap_ref = HealpixFitsMap(filename, nside_in=16, map_seed=489237)
+    >>> assert np.all(hpmap.I == hpmap_ref.I)
+    >>> hpmap.Q.flags.writeable
+    False
+    >>> hpmap.free_shared_maps()
+    """
+    from mpi4py import MPI
+    ## Keyword only, so that the arguments of HealpixFitsMap are unchanged
+    comm = kwargs.pop('comm', None)
+    if comm is None:
+        comm = MPI.COMM_WORLD
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+
+    ## Only the root of the node builds the maps.
+    maps = {}
+    sky = None
+    if node_comm.rank == 0:
+        sky = HealpixFitsMap(*args, **kwargs)
+        for name in MAP_NAMES:
+            m = getattr(sky, name, None)
+            if m is not None:
+                maps[name] = np.asarray(m)
+                setattr(sky, name, None)
+
+    ## Broadcast the instance without its maps, and the map layout.
+    sky = node_comm.bcast(sky, root=0)
+    layout = node_comm.bcast(
+        [(name, m.shape, m.dtype.str) for name, m in sorted(maps.items())],
+        root=0)
+
+    sky.node_comm = node_comm
+    sky.shared_windows = {}
+    for name, shape, dtype in layout:
+        shared, win = allocate_shared_array(shape, dtype, node_comm)
+        if node_comm.rank == 0:
+            shared[:] = maps.pop(name)
+        sky.shared_windows[name] = win
+        setattr(sky, name, shared)
+    node_comm.Barrier()
+
+    for name, shape, dtype in layout:
+        getattr(sky, name).flags.writeable = False
+
+    return sky
+
+def allocate_shared_array(shape, dtype, node_comm):
+    """
+    Allocate an array in a MPI-3 shared memory window.
+    The memory is allocated by the first rank of node_comm, and
+    all the ranks get a view of it.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the array.
+    dtype : string or numpy dtype
+        Type of the array elements.
+    node_comm : MPI communicator
+        Communicator of the ranks sharing memory (same node).
+
+    Returns
+    ----------
+    array : ndarray
+        View on the shared memory.
+    win : MPI.Win instance
+        The window. It must be kept alive as long as the array is used.
+
+    Examples
+    ----------
+    >>> from mpi4py import MPI
+    >>> node_comm = MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED)
+    >>> array, win = allocate_shared_array((2, 3), 'f8', node_comm)
+    >>> print(array.shape)
+    (2, 3)
+    >>> win.Free()
+    """
+    from mpi4py import MPI
+    dtype = np.dtype(dtype)
+    nbytes = 0
+    if node_comm.rank == 0:
+        nbytes = max(int(np.prod(shape)) * dtype.itemsize, dtype.itemsize)
+    win = MPI.Win.Allocate_shared(nbytes, dtype.itemsize, comm=node_comm)
+    buf, itemsize = win.Shared_query(0)
+    array = np.ndarray(buffer=buf, dtype=dtype, shape=shape)
+    return array, win
 
 def add_hierarch(lis):
     """
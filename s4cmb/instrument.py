@@ -968,13 +968,37 @@ class HalfWavePlate():
         AssertionError: You cannot have a stepped HWP and non-zero frequency!
         set freq_hwp=0.0 if you want a stepped HWP.
         """
-        angle = self.angle_hwp * np.pi / 180.
+        return self.get_angle_model(
+            sample_rate=sample_rate, size=size).angles()
+
+    def get_angle_model(self, sample_rate=1., size=1):
+        """
+        Return the HWP angles as a model (see HWPAngles): angles and
+        trigonometric functions are computed for any range of time samples
+        when needed, instead of storing them for the whole scan.
 
-        HWP_angles = np.array(
-            [angle + t * (self.freq_hwp / sample_rate) *
-             2. * np.pi for t in range(size)])
+        Parameters
+        ----------
+        sample_rate : float, optional
+            Sample rate of the detectors
+        size : int, optional
+            Number of time samples.
+
+        Returns
+        ----------
+        model : HWPAngles instance
+            The HWP angles.
+
+        Examples
+        ----------
+        >>> hwp = HalfWavePlate(type_hwp='CRHWP', freq_hwp=2., angle_hwp=0.)
+        >>> model = hwp.get_angle_model(sample_rate=100., size=10)
+        >>> model.angles(start=2, stop=5)
+        array([ 0.25132741,  0.37699112,  0.50265482])
+        """
+        angle = self.angle_hwp * np.pi / 180.
 
-        return HWP_angles
+        return HWPAngles(angle, self.freq_hwp / sample_rate, size)
 
     def update_hardware(self, new_type_hwp, new_freq_hwp, new_angle_hwp):
         """
@@ -1013,6 +1037,116 @@ class HalfWavePlate():
         self.angle_hwp = new_angle_hwp
 
 
+class HWPAngles():
+    """ Class to compute the HWP angles on demand """
+    def __init__(self, angle0, rate, size):
+        """
+        Angles of a HWP rotating at constant speed:
+        angle0 + 2 * pi * rate * t, for the time samples t = 0 ... size - 1.
+        Angles, and complex exponentials of multiple of the angles, are
+        computed for any range of time samples on demand, so that no
+        full-length array needs to be stored.
+
+        Parameters
+        ----------
+        angle0 : float
+            HWP angle at the first time sample [radian].
+        rate : float
+            Number of HWP rotations per time sample (freq_hwp / sample_rate).
+            Zero for a stepped HWP.
+        size : int
+            Number of time samples.
+
+        Examples
+        ----------
+        >>> model = HWPAngles(0., 0.02, 10)
+        >>> print(model.size, model.angles().shape)
+        10 (10,)
+        """
+        self.angle0 = angle0
+        self.rate = rate
+        self.size = size
+
+    def angles(self, start=0, stop=None):
+        """
+        Return the HWP angles for the time samples start ... stop - 1.
+
+        Parameters
+        ----------
+        start : int, optional
+            First time sample. Default is 0.
+        stop : int, optional
+            Last time sample (excluded). Default is the end of the scan.
+
+        Returns
+        ----------
+        angles : 1d array
+            HWP angles [radian].
+
+        Examples
+        ----------
+        >>> model = HWPAngles(0., 0.02, 10)
+        >>> model.angles(start=8)
+        array([ 1.00530965,  1.13097336])
+        """
+        if stop is None:
+            stop = self.size
+        return self.angle0 + \
+            np.arange(start, stop) * self.rate * 2. * np.pi
+
+    def phasor(self, harmonic, start=0, stop=None, block_size=1024):
+        """
+        Return exp(i * harmonic * angles) for the time samples
+        start ... stop - 1. The angles being linear in time, the
+        exponentials are products of exponentials within a block of
+        block_size samples and exponentials at the beginning of the blocks
+        (exact rotations: no accumulation of errors), that is about
+        one complex multiplication per sample instead of one complex
+        exponential.
+
+        Parameters
+        ----------
+        harmonic : int
+            Multiple of the HWP angles (e.g. 4 for the demodulation).
+        start : int, optional
+            First time sample. Default is 0.
+        stop : int, optional
+            Last time sample (excluded). Default is the end of the scan.
+        block_size : int, optional
+            Number of samples per block. Default is 1024.
+
+        Returns
+        ----------
+        phasor : 1d array of complex
+            exp(i * harmonic * angles).
+
+        Examples
+        ----------
+        >>> model = HWPAngles(0.3, 0.0123, 100000)
+        >>> p = model.phasor(4, start=10, stop=50000)
+        >>> assert np.allclose(p, np.exp(4.j * model.angles(10, 50000)))
+
+        cos and sin of the angles
+        >>> p = model.phasor(2, start=10, stop=20)
+        >>> assert np.allclose(p.real, np.cos(2 * model.angles(10, 20)))
+        >>> assert np.allclose(p.imag, np.sin(2 * model.angles(10, 20)))
+        """
+        if stop is None:
+            stop = self.size
+        n = stop - start
+        nblock = max(1, -(-n // block_size))
+        block_size = min(block_size, n)
+
+        ## Angles within the first block, and offsets of the blocks
+        inblock = self.angles(start, start + block_size)
+        offsets = np.arange(nblock) * (
+            block_size * self.rate * 2. * np.pi)
+
+        phasor = np.exp(1.j * harmonic * offsets)[:, None] * \
+            np.exp(1.j * harmonic * inblock)[None, :]
+        return phasor.ravel()[:n]
+
+
 if __name__ == "__main__":
     import doctest
     if np.__version__ >= "1.14.0":
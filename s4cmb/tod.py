@@ -9,6 +9,9 @@ from __future__ import division, absolute_import, print_function
 
 import sys
 import os
+import warnings
+
+from collections import OrderedDict
 
 import numpy as np
 import healpy as hp
@@ -18,31 +21,58 @@ try:
 except ImportError:
     import pickle
 
-from numpy.fft import fft, fftfreq, fftshift
+from numpy.fft import fft, fftfreq, fftshift, rfft, irfft, rfftfreq
 
 from scipy.signal import firwin
 from scipy import fftpack
+from scipy import sparse
+## scipy.fft (scipy >= 1.4) is used for the batched demodulation.
+## Before scipy 1.4, scipy.fft is a function (numpy's fft), not a module.
+try:
+    import scipy.fft as sp_fft
+except ImportError:
+    sp_fft = None
+if not hasattr(sp_fft, 'next_fast_len'):
+    sp_fft = None
 
 from s4cmb.detector_pointing import Pointing
 from s4cmb.detector_pointing import radec2thetaphi
+from s4cmb.instrument import HWPAngles
 from s4cmb import input_sky
+from s4cmb.config_s4cmb import get_float_dtype
 from s4cmb.tod_f import tod_f
 from s4cmb.xpure import qu_weight_mineig
 
 d2r = np.pi / 180.0
 am2rad = np.pi / 180. / 60.
 
+## Filters used for the demodulation, shared by all Demodulation instances
+## with the same parameters (see Demodulation.filter_bank_key). Only the
+## MAX_DEMODULATION_FILTER_BANKS most recently used banks are kept, and
+## at most MAX_DEMODULATION_FILTER_BYTES (see get_filter_bank).
+DEMODULATION_FILTER_BANKS = OrderedDict()
+MAX_DEMODULATION_FILTER_BANKS = 8
+MAX_DEMODULATION_FILTER_BYTES = 2**28
+
+## Largest masks of ones (in bytes) created at once when no timestream
+## sample is flagged. The buffer is reused across calls (see
+## get_unflagged_masks).
+MAX_MASK_BYTES = 2**24
+UNFLAGGED_MASKS = {}
+
 class TimeOrderedDataPairDiff():
     """ Class to handle Time-Ordered Data (TOD) """
     def __init__(self, hardware, scanning_strategy, HealpixFitsMap,
                  CESnumber, projection='healpix',
                  nside_out=None, pixel_size=None, width=140.,
                  cut_pixels_outside=True,
+                 restrict_input_sky=False, input_sky_margin=None,
                  array_noise_level=None, array_noise_seed=487587,
                  array_noise_level2=None, array_noise_seed2=56736,
                  nclouds=None, corrlength=None, alpha=None,
-                 f0=None, amp_atm=None,
-                 mapping_perpair=False, mode='standard', verbose=False):
+                 f0=None, amp_atm=None, noise_rng='legacy',
+                 mapping_perpair=False, mode='standard', precision='double',
+                 store_pointing=True, verbose=False):
         """
         C'est parti!
 
@@ -83,6 +113,16 @@ class TimeOrderedDataPairDiff():
             Why this is so? To save memory by not having full sky maps stored
             in the memory and in the same time be able to coadd maps from
             different scans easily. If you have a better idea, let me know!
+        restrict_input_sky : bool, optional
+            If True, keep in memory only the pixels of the input maps which
+            are inside the sky patch defined by (width, ra_src, dec_src),
+            plus a margin. The input maps are modified in-place (see
+            HealpixFitsMap.restrict_to_patch), and the pointing matrix
+            directly returns indices local to the patch. Useful to save
+            memory at high resolution. Default is False.
+        input_sky_margin : float, optional
+            Margin in degree added around the patch when restricting the
+            input maps. Default is the projected size of the focal plane.
         array_noise_level : float, optional
             Noise level for the whole array in [u]K.sqrt(s). If not None, it
             will inject on-the-fly noise in time-domain while scanning
@@ -107,6 +147,10 @@ class TimeOrderedDataPairDiff():
         amp_atm : float, optional
             Typical value of atmospheric fluctuations in [u]K^2.s.
             WARNING: units has to be same as the input map!
+        noise_rng : string, optional
+            Random number generator for the noise: `legacy` or `philox`
+            (counter-based, keyed by seed, scan, detector and time chunk).
+            See WhiteNoiseGenerator. Default is `legacy`.
         mapping_perpair : bool, optional
             If True, assume that you want to process pairs of bolometers
             one-by-one, that is pairs are uncorrelated. Default is False (and
@@ -116,6 +160,17 @@ class TimeOrderedDataPairDiff():
             (2 frequency bands). If `dichroic` is chosen, make sure your
             hardware can handle it (see instrument.py) and HealpixFitsMap
             should contain the inputs maps at different frequency.
+        precision : string, optional
+            Floating point precision of the timestreams, noise and
+            polarisation angles: `double` (float64) or `single` (float32).
+            Sky map accumulators (OutputSkyMap) are always in double
+            precision. Default is `double`.
+        store_pointing : bool, optional
+            If True, map2tod stores the pixel indices and polarisation angles
+            of the top bolometers (point_matrix, pol_angs) to be used later
+            by tod2map. If False, nothing is stored (saving
+            2 x npair x nsamples numbers), and tod2map recomputes the
+            pointing pair-by-pair. Default is True.
         """
         ## Initialise args
         self.verbose = verbose
@@ -123,6 +178,9 @@ class TimeOrderedDataPairDiff():
         self.scanning_strategy = scanning_strategy
         self.HealpixFitsMap = HealpixFitsMap
         self.mapping_perpair = mapping_perpair
+        self.precision = precision
+        self.dtype = get_float_dtype(self.precision)
+        self.store_pointing = store_pointing
 
         ## Check if you can run dichroic detectors
         self.mode = mode
@@ -173,16 +231,18 @@ class TimeOrderedDataPairDiff():
         self.xpos = self.hardware.beam_model.xpos
         self.xpos = self.xpos / np.cos(self.ypos)
 
-        ## Initialise pointing matrix, that is the matrix to go from time
-        ## to map domain, for all pairs of detectors.
-        if not self.mapping_perpair:
-            self.point_matrix = np.zeros(
-                (self.npair, self.nsamples), dtype=np.int32)
-        else:
-            self.point_matrix = np.zeros((1, self.nsamples), dtype=np.int32)
+        ## Pointing matrix (the matrix to go from time to map domain),
+        ## polarisation angles and masks for all pairs of detectors.
+        ## They are allocated only when needed (see allocate_buffers).
+        ## Masks are None as long as no sample is flagged (see
+        ## get_timestream_masks).
+        self.point_matrix = None
+        self.pol_angs = None
+        self.pol_angs2 = None
+        self.wafermask_pixel = None
 
-        ## Initialise the mask for timestreams
-        self.wafermask_pixel = self.get_timestream_masks()
+        ## Last top bolometer scanned (for mapping_perpair).
+        self.current_top_bolometer = 0
 
         ## Boundaries for subscans (t_beg, t_end)
         self.subscans = self.scan['subscans']
@@ -202,6 +262,24 @@ class TimeOrderedDataPairDiff():
             self.scanning_strategy.ra_mid,
             self.scanning_strategy.dec_mid)
 
+        ## Conversion global -> local output pixels, built once per CES.
+        ## If the output resolution differs from the input one, output
+        ## pixels are derived from the NESTED input pixels (see
+        ## build_pointing_matrix), so the table is built in NESTED.
+        if self.projection == 'healpix' and (
+                self.nside_out != self.HealpixFitsMap.nside):
+            self.obspix_lookup = input_sky.PixelLookupTable(
+                hp.ring2nest(self.nside_out, self.obspix), nest=True)
+        elif self.projection == 'healpix':
+            self.obspix_lookup = input_sky.PixelLookupTable(self.obspix)
+        else:
+            self.obspix_lookup = None
+
+        ## Keep only the part of the input sky that we will scan
+        self.restrict_input_sky = restrict_input_sky
+        if self.restrict_input_sky:
+            self.restrict_input_sky_to_patch(margin=input_sky_margin)
+
         ## Get timestream weights
         self.sum_weight, self.diff_weight = self.get_weights()
 
@@ -216,12 +294,16 @@ class TimeOrderedDataPairDiff():
         self.alpha = alpha
         self.f0 = f0
         self.amp_atm = amp_atm
+        self.noise_rng = noise_rng
         if self.array_noise_level is not None and self.alpha is None:
             self.noise_generator = WhiteNoiseGenerator(
                 array_noise_level=self.array_noise_level,
                 ndetectors=2*self.npair,
                 ntimesamples=self.nsamples,
-                array_noise_seed=self.array_noise_seed)
+                array_noise_seed=self.array_noise_seed,
+                precision=self.precision,
+                rng=self.noise_rng,
+                CESnumber=self.CESnumber)
         elif self.array_noise_level is not None and self.alpha is not None:
             self.noise_generator = CorrNoiseGenerator(
                 array_noise_level=self.array_noise_level,
@@ -233,7 +315,10 @@ class TimeOrderedDataPairDiff():
                 amp_atm=self.amp_atm,
                 corrlength=self.corrlength,
                 alpha=self.alpha,
-                sampling_freq=self.scanning_strategy.sampling_freq)
+                sampling_freq=self.scanning_strategy.sampling_freq,
+                precision=self.precision,
+                rng=self.noise_rng,
+                CESnumber=self.CESnumber)
         else:
             self.noise_generator = None
 
@@ -244,7 +329,10 @@ class TimeOrderedDataPairDiff():
                 array_noise_level=self.array_noise_level2,
                 ndetectors=2*self.npair,
                 ntimesamples=self.nsamples,
-                array_noise_seed=self.array_noise_seed2)
+                array_noise_seed=self.array_noise_seed2,
+                precision=self.precision,
+                rng=self.noise_rng,
+                CESnumber=self.CESnumber)
         elif self.array_noise_level2 is not None and self.alpha is not None:
             self.noise_generator2 = CorrNoiseGenerator(
                 array_noise_level=self.array_noise_level2,
@@ -256,7 +344,10 @@ class TimeOrderedDataPairDiff():
                 amp_atm=self.amp_atm,
                 corrlength=self.corrlength,
                 alpha=self.alpha,
-                sampling_freq=self.scanning_strategy.sampling_freq)
+                sampling_freq=self.scanning_strategy.sampling_freq,
+                precision=self.precision,
+                rng=self.noise_rng,
+                CESnumber=self.CESnumber)
         else:
             self.noise_generator2 = None
 
@@ -265,7 +356,8 @@ class TimeOrderedDataPairDiff():
         Retrieve polarisation angles: intrinsic (focal plane) and HWP angles,
         and initialise total polarisation angle.
         """
-        self.hwpangle = self.hardware.half_wave_plate.compute_HWP_angles(
+        ## HWP angles are computed on demand (see hwpangle)
+        self.hwp = self.hardware.half_wave_plate.get_angle_model(
             sample_rate=self.scan['sample_rate'],
             size=self.nsamples)
 
@@ -274,29 +366,101 @@ class TimeOrderedDataPairDiff():
         if self.mode == 'dichroic':
             self.intrinsic_polangle2 = self.hardware.focal_plane2.bolo_polangle
 
-        ## Will contain the total polarisation angles for all bolometers
-        ## That is PA + intrinsic + 2 * HWP
+    @property
+    def hwpangle(self):
+        """
+        HWP angles for the whole scan [radian]. They are not stored, but
+        computed from the HWP model (self.hwp) when needed.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> print(tod.hwpangle.shape)
+        (139992,)
+        """
+        return self.hwp.angles()
+
+    def allocate_buffers(self):
+        """
+        Allocate the buffers filled by map2tod and used by tod2map, if not
+        already done: pointing matrix (int32) and total polarisation angles
+        (that is PA + intrinsic + 2 * HWP, in the precision of the TOD).
+
+        The buffers are not created in __init__ but at their first use, for
+        the whole focal plane: (npair, nsamples) arrays (or (1, nsamples)
+        if mapping_perpair), zero-initialised. Use store_pointing=False to
+        avoid them altogether (the pointing is then recomputed pair by
+        pair in tod2map).
+
+        Timestream masks are not allocated here: as long as no sample is
+        flagged, wafermask_pixel is None and the masks are created for the
+        pairs being projected only (see get_timestream_masks).
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1)
+        >>> print(tod.point_matrix)
+        None
+        >>> d = tod.map2tod(0)
+        >>> print(tod.point_matrix.shape, tod.wafermask_pixel)
+        (4, 115200) None
+        """
         if not self.mapping_perpair:
-            self.pol_angs = np.zeros((self.npair, self.nsamples))
-            self.pol_angs2 = None
-            if self.mode == 'dichroic':
-                self.pol_angs2 = np.zeros((self.npair, self.nsamples))
+            shape = (self.npair, self.nsamples)
         else:
-            self.pol_angs = np.zeros((1, self.nsamples))
-            self.pol_angs2 = None
-            if self.mode == 'dichroic':
-                self.pol_angs2 = np.zeros((1, self.nsamples))
+            shape = (1, self.nsamples)
+
+        ## Pointing is recomputed in tod2map if not stored.
+        if self.store_pointing and self.point_matrix is None:
+            self.point_matrix = np.zeros(shape, dtype=np.int32)
 
-    def get_timestream_masks(self):
+        if self.store_pointing and self.pol_angs is None:
+            self.pol_angs = np.zeros(shape, dtype=self.dtype)
+        if self.store_pointing and self.pol_angs2 is None and (
+                self.mode == 'dichroic'):
+            self.pol_angs2 = np.zeros(shape, dtype=self.dtype)
+
+    def get_timestream_masks(self, pairs=slice(None)):
         """
-        Define the masks for all the timestreams.
+        Return the masks of the timestreams of some pairs.
         1 if the time sample should be included, 0 otherwise.
-        Set to ones for the moment.
+        Stored on one byte (uint8).
+
+        Flags are set by assigning an array of size (npair, nsamples)
+        (or (1, nsamples) if mapping_perpair) to wafermask_pixel. As long
+        as it is None (default), all samples are valid and the masks are
+        created for the requested pairs only.
+
+        Parameters
+        ----------
+        pairs : slice, optional
+            Rows of the masks (pairs, or the current pair if
+            mapping_perpair). Default is all the rows.
+
+        Returns
+        ----------
+        masks : 2d array of uint8
+            Masks of size (number of pairs, nsamples).
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1)
+        >>> print(tod.get_timestream_masks(slice(1, 2)).shape)
+        (1, 115200)
+        >>> tod.wafermask_pixel = tod.get_timestream_masks()
+        >>> tod.wafermask_pixel[1, :100] = 0
+        >>> print(tod.get_timestream_masks(slice(1, 2))[0, 98:102])
+        [0 0 1 1]
         """
-        if not self.mapping_perpair:
-            return np.ones((self.npair, self.nsamples), dtype=int)
-        else:
-            return np.ones((1, self.nsamples), dtype=int)
+        if self.wafermask_pixel is not None:
+            return self.wafermask_pixel[pairs]
+
+        nrows = 1 if self.mapping_perpair else self.npair
+        nrows = len(range(nrows)[pairs])
+        return np.ones((nrows, self.nsamples), dtype=np.uint8)
 
     def get_obspix(self, width, ra_src, dec_src):
         """
@@ -384,6 +548,48 @@ class TimeOrderedDataPairDiff():
 
         return obspix, npixsky
 
+    def restrict_input_sky_to_patch(self, margin=None):
+        """
+        Restrict the input sky maps to the sky patch scanned by this TOD
+        (plus a margin). This is the patch returned by get_obspix, expressed
+        in the frame used to scan the input maps (the patch is centered
+        on (0, 0) for flat projection).
+
+        The input maps are modified in-place, so this has to be done only
+        once if the same HealpixFitsMap instance is shared between several
+        CES (the patch being the same for all CES).
+
+        Parameters
+        ----------
+        margin : float, optional
+            Margin in degree added around the patch. Default is the
+            projected size of the focal plane.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> d = tod.map2tod(0)
+
+        Same with the input maps restricted to the patch
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     restrict_input_sky=True)
+        >>> print(len(sky_in.I), 12 * sky_in.nside**2)
+        1950 3072
+        >>> assert np.allclose(tod.map2tod(0), d)
+        """
+        if margin is None:
+            margin = self.hardware.beam_model.projected_fp_size
+
+        if self.projection == 'healpix':
+            xmin, xmax, ymin, ymax = self.xmin, self.xmax, self.ymin, self.ymax
+        elif self.projection == 'flat':
+            xmin = ymin = - self.width / 2. * d2r
+            xmax = ymax = self.width / 2. * d2r
+
+        self.HealpixFitsMap.restrict_to_patch(
+            xmin, xmax, ymin, ymax, margin=margin * d2r)
+
     def get_weights(self):
         """
         Return the noise weights of the sum and difference timestreams
@@ -399,11 +605,12 @@ class TimeOrderedDataPairDiff():
             Weights for the sum of timestreams (size: npair)
         diff_weight : 1d array
             Weights for the difference of timestreams (size: npair)
+            Weights are in float64, as expected by the fortran kernels.
         """
         if not self.mapping_perpair:
-            return np.ones((2, self.npair), dtype=int)
+            return np.ones((2, self.npair), dtype=np.float64)
         else:
-            return np.ones((2, 1), dtype=int)
+            return np.ones((2, 1), dtype=np.float64)
 
     def set_detector_gains(self, new_gains=None, new_gains2=None):
         """
@@ -566,7 +773,8 @@ class TimeOrderedDataPairDiff():
             ut1utc_fn=self.scanning_strategy.ut1utc_fn,
             lat=lat, ra_src=ra_src, dec_src=dec_src)
 
-    def compute_simpolangle(self, ch, parallactic_angle, polangle_err=False):
+    def compute_simpolangle(self, ch, parallactic_angle, polangle_err=False,
+                            hwpangle=None):
         """
         Compute the full polarisation angles used to generate timestreams.
         The polarisation angle contains intrinsic polarisation angle (from
@@ -582,6 +790,9 @@ class TimeOrderedDataPairDiff():
         polangle_err : bool, optional
             If True, inject systematic effect.
             TODO: remove that in the systematic module.
+        hwpangle : 1d array, optional
+            HWP angles for the whole scan, if already computed (e.g. when
+            looping over detectors). Default is self.hwpangle.
 
         Returns
         ----------
@@ -610,13 +821,15 @@ class TimeOrderedDataPairDiff():
         """
         if not polangle_err:
             ang_pix = (90.0 - self.intrinsic_polangle[ch]) * d2r
+            if hwpangle is None:
+                hwpangle = self.hwpangle
 
             ## Demodulation or pair diff use different convention
             ## for the definition of the angle.
             if not hasattr(self, 'dm'):
-                pol_ang = parallactic_angle + ang_pix + 2.0 * self.hwpangle
+                pol_ang = parallactic_angle + ang_pix + 2.0 * hwpangle
             else:
-                pol_ang = parallactic_angle - ang_pix - 2.0 * self.hwpangle
+                pol_ang = parallactic_angle - ang_pix - 2.0 * hwpangle
 
             pol_ang2 = None
             if self.mode == 'dichroic':
@@ -625,9 +838,9 @@ class TimeOrderedDataPairDiff():
                 ## Demodulation or pair diff use different convention
                 ## for the definition of the angle.
                 if not hasattr(self, 'dm'):
-                    pol_ang2 = parallactic_angle + ang_pix2 + 2.0*self.hwpangle
+                    pol_ang2 = parallactic_angle + ang_pix2 + 2.0 * hwpangle
                 else:
-                    pol_ang2 = parallactic_angle - ang_pix2 - 2.0*self.hwpangle
+                    pol_ang2 = parallactic_angle - ang_pix2 - 2.0 * hwpangle
         else:
             print("This is where you call the systematic module!")
             sys.exit()
@@ -651,6 +864,7 @@ class TimeOrderedDataPairDiff():
         ----------
         pa : 1d array
             Parallactic angles (timestream) for detector ch. [radian]
+            Shape (1, nsamples) if mapping_perpair is True.
 
         Examples
         ----------
@@ -665,31 +879,204 @@ class TimeOrderedDataPairDiff():
         ...     mode='dichroic', CESnumber=1)
         >>> pa1 = tod.return_parallactic_angle(0, frequency_channel=1)
         >>> pa2 = tod.return_parallactic_angle(0, frequency_channel=2)
+
+        Stored or recomputed, the angles are the same
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataDemod(inst, scan, sky_in, CESnumber=1)
+        >>> tod_nostore = TimeOrderedDataDemod(inst, scan, sky_in,
+        ...     CESnumber=1, store_pointing=False)
+        >>> d = tod.map2tod(2)
+        >>> pa = tod.return_parallactic_angle(1)
+        >>> pa_nostore = tod_nostore.return_parallactic_angle(1)
+        >>> assert np.allclose(pa, pa_nostore)
         """
+        ## Index of the (top) detector in the focal plane, and of its
+        ## stored angles (only the current pair if mapping per pair).
+        if self.mapping_perpair is True:
+            det, rows = ch, slice(0, 1)
+        else:
+            det, rows = 2 * ch, ch
+
+        if not self.store_pointing:
+            ## Nothing stored: the parallactic angle is recomputed.
+            pa = self.compute_pointing(det)[2]
+            if self.mapping_perpair is True:
+                return pa.reshape((1, -1))
+            return pa
+
+        self.allocate_buffers()
         if frequency_channel == 1:
-            pa = self.pol_angs
+            pa = self.pol_angs[rows]
+            ang_pix = (90.0 - self.intrinsic_polangle[det]) * d2r
         elif frequency_channel == 2:
-            pa = self.pol_angs2
+            pa = self.pol_angs2[rows]
+            ang_pix = (90.0 - self.intrinsic_polangle2[det]) * d2r
+
+        ## Stored angles are pa - ang_pix for the demodulation, and
+        ## pa + ang_pix + 2 * hwpangle for the pair difference
+        ## (see compute_simpolangle).
+        if not hasattr(self, 'dm'):
+            return pa - ang_pix - 2 * self.hwpangle
+        else:
+            return pa + ang_pix
 
-        if self.mapping_perpair is True:
-            if frequency_channel == 1:
-                ang_pix = (90.0 - self.intrinsic_polangle[ch]) * d2r
-            elif frequency_channel == 2:
-                ang_pix = (90.0 - self.intrinsic_polangle2[ch]) * d2r
+    def compute_pointing(self, ch):
+        """
+        Compute the pointing of detector ch: pixel indices in the input
+        and output maps, and parallactic angles.
 
-            if not hasattr(self, 'dm'):
-                return pa - ang_pix - 2*self.hwpangle
-            else:
-                return pa + ang_pix
+        Parameters
+        ----------
+        ch : int
+            Channel index in the focal plane.
+
+        Returns
+        ----------
+        index_global : 1d array
+            Pixel indices in the input map (see build_pointing_matrix).
+        index_local : 1d array
+            Pixel indices in the output map (-1 outside).
+        pa : 1d array
+            Parallactic angles [radian].
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1)
+        >>> index_global, index_local, pa = tod.compute_pointing(0)
+        >>> print(index_local.shape, pa.shape)
+        (115200,) (115200,)
+        """
+        ## Use bolometer beam offsets.
+        azd, eld = self.xpos[ch], self.ypos[ch]
+
+        ## Compute pointing for detector ch
+        ra, dec, pa = self.pointing.offset_detector(azd, eld)
+
+        ## Retrieve corresponding pixels on the sky, and their index locally.
+        if self.projection == 'flat':
+            ## ??
+            xmin = - self.width/2.*np.pi/180.
+            ymin = - self.width/2.*np.pi/180.
+            index_global, index_local = build_pointing_matrix(
+                ra, dec, nside_in=self.HealpixFitsMap.nside,
+                nside_out=self.nside_out,
+                xmin=xmin,
+                ymin=ymin,
+                pixel_size=self.pixel_size,
+                npix_per_row=int(np.sqrt(self.npixsky)),
+                projection=self.projection,
+                input_lookup=self.HealpixFitsMap.patch_lookup,
+                cut_pixels_outside=self.cut_pixels_outside)
+        elif self.projection == 'healpix':
+            index_global, index_local = build_pointing_matrix(
+                ra, dec, nside_in=self.HealpixFitsMap.nside,
+                nside_out=self.nside_out,
+                obspix=self.obspix,
+                output_lookup=self.obspix_lookup,
+                ext_map_gal=self.HealpixFitsMap.ext_map_gal,
+                projection=self.projection,
+                input_lookup=self.HealpixFitsMap.patch_lookup,
+                cut_pixels_outside=self.cut_pixels_outside)
+
+        return index_global, index_local, pa
+
+    def get_pointing_operator(self, frequency_channel=1):
+        """
+        Compute the pointing of all the detectors of the focal plane, and
+        store it in a PointingOperator. The operator can be saved on disk
+        and reused to scan and project new sky or noise realisations
+        without recomputing the pointing.
+
+        Parameters
+        ----------
+        frequency_channel : int, optional
+            If you are processing dichroic pixels, you need to specify the
+            index of the frequency channel (1 or 2). Default is 1.
+
+        Returns
+        ----------
+        P : PointingOperator instance
+            The pointing operator for this CES.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataDemod(inst, scan, sky_in, CESnumber=0)
+        >>> P = tod.get_pointing_operator()
+        >>> d = P.apply(sky_in.I, sky_in.Q, sky_in.U)
+        >>> assert np.allclose(d[0], tod.map2tod(0))
+        """
+        ## Detectors of a pair share the pointing, unless beam offsets
+        ## have been perturbed.
+        pair_pointing = np.all(self.xpos[::2] == self.xpos[1::2]) and \
+            np.all(self.ypos[::2] == self.ypos[1::2])
+        if pair_pointing:
+            channels = range(0, 2 * self.npair, 2)
         else:
-            if frequency_channel == 1:
-                ang_pix = (90.0 - self.intrinsic_polangle[2*ch]) * d2r
-            elif frequency_channel == 2:
-                ang_pix = (90.0 - self.intrinsic_polangle2[2*ch]) * d2r
-            if not hasattr(self, 'dm'):
-                return pa[ch] - ang_pix - 2*self.hwpangle
+            channels = range(2 * self.npair)
+
+        index_global = np.zeros((len(channels), self.nsamples), dtype=np.int32)
+        index_local = np.zeros((self.npair, self.nsamples), dtype=np.int32)
+        pa = np.zeros((len(channels), self.nsamples), dtype=self.dtype)
+        for row, ch in enumerate(channels):
+            index_global[row], index_local_ch, pa[row] = \
+                self.compute_pointing(ch)
+            if ch % 2 == 0:
+                index_local[ch // 2] = index_local_ch
+
+        if frequency_channel == 1:
+            intrinsic_polangle = self.intrinsic_polangle
+        elif frequency_channel == 2:
+            intrinsic_polangle = self.intrinsic_polangle2
+        ang_pix = (90.0 - np.array(intrinsic_polangle)) * d2r
+
+        ## Weights and masks for the whole focal plane.
+        shape = (self.npair, self.nsamples)
+        diff_weight = np.ones(self.npair) * self.diff_weight
+        sum_weight = np.ones(self.npair) * self.sum_weight
+        wafermask_pixel = np.ones(shape, dtype=np.uint8) * \
+            self.get_timestream_masks()
+
+        if self.projection == 'flat':
+            sign = -1.
+        elif self.projection == 'healpix':
+            sign = 1.
+
+        return PointingOperator(
+            index_global, index_local, pa, ang_pix, self.hwpangle,
+            diff_weight, sum_weight, wafermask_pixel, self.npixsky,
+            sign=sign, demodulation=hasattr(self, 'dm'))
+
+    def get_detector_gain(self, ch, gain=None):
+        """
+        Return the gain of detector ch.
+        Default gain for a detector is 1., but you can change it using
+        set_detector_gains or set_detector_gains_perpair.
+
+        Parameters
+        ----------
+        ch : int
+            Channel index in the focal plane.
+        gain : ndarray, optional
+            Gains to use (same format as self.gain). Default is self.gain.
+
+        Returns
+        ----------
+        norm : float
+            The gain of the detector.
+        """
+        if gain is None:
+            gain = self.gain
+        if len(gain) == self.npair * 2:
+            norm = gain[ch]
+        elif len(gain) == 2:
+            # print("Gains per pair")
+            if ch % 2 == 0:
+                norm = gain[0]
             else:
-                return pa[ch] + ang_pix
+                norm = gain[1]
+        return norm
 
     def map2tod(self, ch):
         """
@@ -733,57 +1120,40 @@ class TimeOrderedDataPairDiff():
         ...     array_noise_level2=25., array_noise_seed2=56736,
         ...     mode='dichroic', CESnumber=1)
         >>> d = tod.map2tod(0)
+
+        Single precision timestreams
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1,
+        ...     array_noise_level=2.5, precision='single')
+        >>> d = tod.map2tod(0)
+        >>> print(d.dtype, tod.pol_angs.dtype)
+        float32 float32
         """
-        ## Use bolometer beam offsets.
-        azd, eld = self.xpos[ch], self.ypos[ch]
+        ## Both frequency channels share the pointing (see map2tod_bands)
+        if self.mode == 'dichroic':
+            return self.map2tod_bands(ch)
 
-        ## Compute pointing for detector ch
-        ra, dec, pa = self.pointing.offset_detector(azd, eld)
+        self.allocate_buffers()
 
-        ## Retrieve corresponding pixels on the sky, and their index locally.
+        index_global, index_local, pa = self.compute_pointing(ch)
+
+        ## For flat projection, one needs to flip the sign of U
+        ## (angle convention)
         if self.projection == 'flat':
-            ## ??
-            xmin = - self.width/2.*np.pi/180.
-            ymin = - self.width/2.*np.pi/180.
-            index_global, index_local = build_pointing_matrix(
-                ra, dec, nside_in=self.HealpixFitsMap.nside,
-                nside_out=self.nside_out,
-                xmin=xmin,
-                ymin=ymin,
-                pixel_size=self.pixel_size,
-                npix_per_row=int(np.sqrt(self.npixsky)),
-                projection=self.projection,
-                cut_pixels_outside=self.cut_pixels_outside)
-            ## For flat projection, one needs to flip the sign of U
-            ## (angle convention)
             sign = -1.
         elif self.projection == 'healpix':
-            index_global, index_local = build_pointing_matrix(
-                ra, dec, nside_in=self.HealpixFitsMap.nside,
-                nside_out=self.nside_out,
-                obspix=self.obspix,
-                ext_map_gal=self.HealpixFitsMap.ext_map_gal,
-                projection=self.projection,
-                cut_pixels_outside=self.cut_pixels_outside)
             sign = 1.
 
         ## Store list of hit pixels only for top bolometers
-        if ch % 2 == 0 and not self.mapping_perpair:
+        if ch % 2 == 0:
+            self.current_top_bolometer = ch
+        store = (ch % 2 == 0) and self.store_pointing
+        if store and not self.mapping_perpair:
             self.point_matrix[int(ch/2)] = index_local
-        elif ch % 2 == 0 and self.mapping_perpair:
+        elif store and self.mapping_perpair:
             self.point_matrix[0] = index_local
 
-        ## Default gain for a detector is 1.,
-        ## but you can change it using set_detector_gains or
-        ## set_detector_gains_perpair.
-        if len(self.gain) == self.npair * 2:
-            norm = self.gain[ch]
-        elif len(self.gain) == 2:
-            # print("Gains per pair")
-            if ch % 2 == 0:
-                norm = self.gain[0]
-            else:
-                norm = self.gain[1]
+        norm = self.get_detector_gain(ch)
 
         ## Noise simulation
         if self.noise_generator is not None:
@@ -791,27 +1161,22 @@ class TimeOrderedDataPairDiff():
         else:
             noise = 0.0
 
-        if self.noise_generator2 is not None:
-            noise2 = self.noise_generator2.simulate_noise_one_detector(ch)
-        else:
-            noise2 = 0.0
-
         if self.HealpixFitsMap.do_pol:
-            ## pol_ang2 is None if mode == 'standard'
-            pol_ang, pol_ang2 = self.compute_simpolangle(
-                ch, pa, polangle_err=False)
+            pol_ang = self.compute_simpolangle(
+                ch, pa, polangle_err=False)[0]
+            pol_ang = pol_ang.astype(self.dtype, copy=False)
 
             ## For demodulation, HWP angles are not included at the level
             ## of the pointing matrix (convention).
             if hasattr(self, 'dm'):
-                pol_ang_out = pol_ang + 2.0 * self.hwpangle
+                pol_ang_out = self.get_binning_angle(ch, pa)
             else:
                 pol_ang_out = pol_ang
 
             ## Store list polangle only for top bolometers
-            if ch % 2 == 0 and not self.mapping_perpair:
+            if store and not self.mapping_perpair:
                 self.pol_angs[int(ch/2)] = pol_ang_out
-            elif ch % 2 == 0 and self.mapping_perpair:
+            elif store and self.mapping_perpair:
                 self.pol_angs[0] = pol_ang_out
 
             ts1 = (
@@ -819,42 +1184,179 @@ class TimeOrderedDataPairDiff():
                 self.HealpixFitsMap.Q[index_global] * np.cos(2 * pol_ang) +
                 sign * self.HealpixFitsMap.U[index_global] *
                 np.sin(2 * pol_ang) + noise) * norm
+        else:
+            ts1 = norm * (self.HealpixFitsMap.I[index_global] + noise)
 
-            if self.mode == 'standard':
-                return ts1
+        return ts1.astype(self.dtype, copy=False)
 
-            elif self.mode == 'dichroic':
-                # For demodulation, HWP angles are not included at the level
-                ## of the pointing matrix (convention).
-                if hasattr(self, 'dm'):
-                    pol_ang_out2 = pol_ang2 + 2.0 * self.hwpangle
-                else:
-                    pol_ang_out2 = pol_ang2
+    def get_frequency_bands(self):
+        """
+        Return the frequency bands of the detectors: one for `standard`
+        mode, two for `dichroic` mode (input maps I2, Q2, U2, intrinsic
+        polarisation angles of focal_plane2 and noise_generator2).
+
+        Returns
+        ----------
+        bands : list of FrequencyBand instances
+            The frequency bands.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument(fwhm_in2=1.8)
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...     mode='dichroic', CESnumber=1)
+        >>> print(len(tod.get_frequency_bands()))
+        2
+        """
+        sky = self.HealpixFitsMap
+        bands = [FrequencyBand(
+            sky.I, sky.Q, sky.U, polangle=self.intrinsic_polangle,
+            noise_generator=self.noise_generator)]
+        if self.mode == 'dichroic':
+            bands.append(FrequencyBand(
+                sky.I2, sky.Q2, sky.U2, polangle=self.intrinsic_polangle2,
+                noise_generator=self.noise_generator2))
+        return bands
+
+    def map2tod_bands(self, ch, bands=None, out=None):
+        """
+        Scan the input maps of several frequency bands (multichroic
+        detectors) to generate the timestreams of detector ch.
+        The pointing (pixel indices, parallactic angles) and the
+        trigonometry of the polarisation angles are computed once, and
+        reused for all the bands (bands with different intrinsic
+        polarisation angles only rotate cos and sin by a constant).
+        For the bands of the detectors (bands=None), the pointing is
+        stored for the top bolometers as in map2tod: point_matrix, and
+        pol_angs (and pol_angs2 in dichroic mode) for the first (and
+        second) band. Nothing is stored for bands given by the caller.
+
+        Parameters
+        ----------
+        ch : int
+            Channel index in the focal plane.
+        bands : list of FrequencyBand instances, optional
+            Frequency bands to scan. Their input maps must be indexed as the
+            input sky maps of the TOD (HealpixFitsMap). Default is the bands
+            of the detectors (see get_frequency_bands). If given, the
+            pointing buffers of the TOD (point_matrix, pol_angs) are left
+            untouched.
+        out : ndarray, optional
+            Array of size (nbands, nsamples) where to write the timestreams
+            (e.g. d[:, ch] for d of size (nbands, ndetectors, nsamples)).
+            Default is a new array.
+
+        Returns
+        ----------
+        ts : ndarray
+            Timestreams for all the bands. Size (nbands, nsamples).
+
+        Examples
+        ----------
+        Dichroic detectors: same as map2tod
+        >>> inst, scan, sky_in = load_fake_instrument(fwhm_in2=1.8)
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...     mode='dichroic', CESnumber=1, array_noise_level=2.5,
+        ...     array_noise_level2=25.)
+        >>> ts = tod.map2tod_bands(0)
+        >>> print(ts.shape)
+        (2, 115200)
+
+        Four bands, with different polarisation angles and gains,
+        written in an array of size (nbands, ndetectors, nsamples)
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1)
+        >>> bands = [FrequencyBand(sky_in.I * k, sky_in.Q, sky_in.U,
+        ...     polangle=np.array(tod.intrinsic_polangle) + 10. * k,
+        ...     gain=np.ones(2 * tod.npair) * k) for k in range(1, 5)]
+        >>> d = np.zeros((4, 2 * tod.npair, tod.nsamples))
+        >>> for ch in range(2 * tod.npair):
+        ...     _ = tod.map2tod_bands(ch, bands, out=d[:, ch])
+
+        The pointing buffers of the TOD are not modified
+        >>> print(tod.point_matrix.any(), tod.pol_angs.any())
+        False False
+
+        Each band is what map2tod gives for its maps and angles
+        >>> tod.intrinsic_polangle = bands[2].polangle
+        >>> tod.HealpixFitsMap.I = bands[2].I
+        >>> assert np.allclose(d[2, 1], 3. * tod.map2tod(1))
+        """
+        ## Pointing stored only for the bands of the detectors
+        own_bands = bands is None
+        if own_bands:
+            bands = self.get_frequency_bands()
 
-                ## Store list polangle only for top bolometers
-                if ch % 2 == 0 and not self.mapping_perpair:
-                    self.pol_angs2[int(ch/2)] = pol_ang_out2
-                elif ch % 2 == 0 and self.mapping_perpair:
-                    self.pol_angs2[0] = pol_ang_out2
+        self.allocate_buffers()
 
-                ts2 = (
-                    self.HealpixFitsMap.I2[index_global] +
-                    self.HealpixFitsMap.Q2[index_global] * np.cos(2*pol_ang2) +
-                    sign * self.HealpixFitsMap.U2[index_global] *
-                    np.sin(2 * pol_ang2) + noise2) * norm
-                return np.array([ts1, ts2])
+        index_global, index_local, pa = self.compute_pointing(ch)
+
+        ## For flat projection, one needs to flip the sign of U
+        ## (angle convention)
+        if self.projection == 'flat':
+            sign = -1.
+        elif self.projection == 'healpix':
+            sign = 1.
 
+        ## Store list of hit pixels only for top bolometers
+        if ch % 2 == 0 and own_bands:
+            self.current_top_bolometer = ch
+        store = (ch % 2 == 0) and self.store_pointing and own_bands
+        row = 0 if self.mapping_perpair else int(ch / 2)
+        if store:
+            self.point_matrix[row] = index_local
+
+        if out is None:
+            out = np.zeros((len(bands), self.nsamples), dtype=self.dtype)
+
+        ## Demodulation or pair diff use different convention
+        ## for the definition of the angle.
+        if not hasattr(self, 'dm'):
+            angle_sign = 1.
         else:
-            ts1 = norm * (self.HealpixFitsMap.I[index_global] + noise)
-            if self.mode == 'standard':
-                return ts1
-            elif self.mode == 'dichroic':
-                ts2 = norm * (self.HealpixFitsMap.I2[index_global] + noise2)
-                return np.array([ts1, ts2])
+            angle_sign = -1.
+
+        if self.HealpixFitsMap.do_pol:
+            ## Polarisation angles without the intrinsic ones: trigonometry
+            ## done once for all bands.
+            hwpangle = self.hwpangle
+            pol_ang0 = pa + angle_sign * 2.0 * hwpangle
+            cos0 = np.cos(2 * pol_ang0)
+            sin0 = np.sin(2 * pol_ang0)
+
+        pol_angs = [self.pol_angs, self.pol_angs2]
+        for k, band in enumerate(bands):
+            if band.noise_generator is not None:
+                noise = band.noise_generator.simulate_noise_one_detector(ch)
+            else:
+                noise = 0.0
+
+            norm = self.get_detector_gain(ch, band.gain)
+
+            tsk = band.I[index_global] + noise
+            if self.HealpixFitsMap.do_pol:
+                ## Rotation by the intrinsic polarisation angle
+                ang_pix = angle_sign * (90.0 - band.polangle[ch]) * d2r
+                cosk = cos0 * np.cos(2 * ang_pix) - \
+                    sin0 * np.sin(2 * ang_pix)
+                sink = sin0 * np.cos(2 * ang_pix) + \
+                    cos0 * np.sin(2 * ang_pix)
+                tsk += band.Q[index_global] * cosk + \
+                    sign * band.U[index_global] * sink
+
+                ## For demodulation, HWP angles are not included at the
+                ## level of the pointing matrix (convention).
+                if store:
+                    if hasattr(self, 'dm'):
+                        pol_angs[k][row] = pa + ang_pix
+                    else:
+                        pol_angs[k][row] = pol_ang0 + ang_pix
+            out[k] = tsk * norm
+
+        return out
 
     def tod2map(self, waferts, output_maps,
                 gdeprojection=False,
-                frequency_channel=1):
+                frequency_channel=1, nthreads=1, tiled=None):
         """
         Project time-ordered data into sky maps for the whole array.
         Maps are updated on-the-fly. Massive speed-up thanks to the
@@ -874,6 +1376,15 @@ class TimeOrderedDataPairDiff():
         frequency_channel : int, optional
             If you are processing dichroic pixels, you need to specify the
             index of the frequency channel (1 or 2). Default is 1.
+        nthreads : int, optional
+            Number of (OpenMP) threads used to project the data. Default is 1.
+        tiled : bool, optional
+            Only if nthreads > 1. If False, each thread projects a subset of
+            detectors into its own partial maps, which are then summed in a
+            fixed order. If True, each thread takes care of a range of sky
+            pixels (no extra memory, but all threads read the full
+            pointing). Default (None) uses the partial maps unless they
+            require more memory than the timestreams.
 
         Examples
         ----------
@@ -911,13 +1422,63 @@ class TimeOrderedDataPairDiff():
         >>> assert np.allclose(sky_out[0][mask], sky_in.Q[mask])
         >>> assert np.allclose(sky_out[1][mask], sky_in.U[mask])
 
-        FLAT: Test the routines MAP -> TOD -> MAP.
-        >>> inst, scan, sky_in = load_fake_instrument()
+        Same in single precision (input maps and timestreams)
+        >>> inst, scan, sky_in = load_fake_instrument(precision='single')
         >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in,
-        ...     CESnumber=0, projection='flat')
+        ...     CESnumber=0, projection='healpix', precision='single')
         >>> d = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
         >>> m = OutputSkyMap(projection=tod.projection,
-        ...     npixsky=tod.npixsky, pixel_size=tod.pixel_size)
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(d, m)
+        >>> sky_out = np.zeros((2, 12 * tod.nside_out**2))
+        >>> sky_out[0][tod.obspix], sky_out[1][tod.obspix] = m.get_QU()
+        >>> mask = (sky_out[0] != 0.0) * (sky_out[1] != 0.0)
+        >>> assert np.allclose(sky_out[0][mask], sky_in.Q[mask], atol=1e-4)
+        >>> print(d.dtype, m.d.dtype)
+        float32 float64
+
+        Using several threads gives the same maps
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...     CESnumber=0, projection='healpix')
+        >>> d = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
+        >>> m1 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(d, m1)
+        >>> for tiled in [False, True]:
+        ...     m = OutputSkyMap(projection=tod.projection,
+        ...         nside=tod.nside_out, obspix=tod.obspix)
+        ...     tod.tod2map(d, m, nthreads=3, tiled=tiled)
+        ...     assert np.allclose(m.d, m1.d) and np.all(m.nhit == m1.nhit)
+
+        Benchmark: the projection does not copy the timestreams,
+        the pointing or the masks (peak memory much smaller than the data).
+        >>> import tracemalloc
+        >>> tracemalloc.start()
+        >>> tod.tod2map(d, m1)
+        >>> peak = tracemalloc.get_traced_memory()[1]
+        >>> tracemalloc.stop()
+        >>> assert peak < tod.point_matrix.nbytes / 10, peak
+
+        Without storing the pointing (recomputed pair-by-pair in tod2map),
+        one gets the same maps
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...     CESnumber=0, projection='healpix', store_pointing=False)
+        >>> d = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
+        >>> m0 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(d, m0)
+        >>> assert np.allclose(m0.d, m.d) and np.all(m0.nhit == m.nhit)
+        >>> print(tod.point_matrix, tod.pol_angs)
+        None None
+
+        FLAT: Test the routines MAP -> TOD -> MAP.
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...     CESnumber=0, projection='flat')
+        >>> d = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     npixsky=tod.npixsky, pixel_size=tod.pixel_size)
         >>> tod.tod2map(d, m)
 
         HEALPIX + Dichroic
@@ -945,16 +1506,32 @@ class TimeOrderedDataPairDiff():
         ...   d = np.array([tod.map2tod(det) for det in pair])
         ...   tod.tod2map(d, m, gdeprojection=True)
 
+        Pair-by-pair without storing the pointing
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...     CESnumber=0, projection='healpix', mapping_perpair=True,
+        ...     store_pointing=False)
+        >>> m2 = OutputSkyMapIGQU(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> for pair in tod.pair_list:
+        ...   d = np.array([tod.map2tod(det) for det in pair])
+        ...   tod.tod2map(d, m2, gdeprojection=True)
+        >>> assert np.allclose(m2.d, m.d) and np.all(m2.nhit == m.nhit)
+
         """
-        if frequency_channel == 1:
-            pol_angs = self.pol_angs
-        elif frequency_channel == 2:
-            pol_angs = self.pol_angs2
+        self.allocate_buffers()
 
         nbolofp = waferts.shape[0]
         npixfp = nbolofp / 2
         nt = int(waferts.shape[-1])
 
+        ## Decimated (demodulated) timestreams: pointing and masks are
+        ## taken every step samples.
+        step = getattr(self, 'decimation', 1)
+        ## None: no sample flagged (masks created pair by pair when binning)
+        wafermask_pixel = self.wafermask_pixel
+        if wafermask_pixel is not None:
+            wafermask_pixel = wafermask_pixel[:, ::step]
+
         ## Check sizes
         msg = 'Most likely you set mapping_perpair wrongly when ' + \
             'initialising your TOD.' + \
@@ -966,48 +1543,267 @@ class TimeOrderedDataPairDiff():
             'pair-by-pair and the mapmaking is done pair-by-pair.' + \
             'See so_MC_crosstalk.py vs so_MC_gain_drift.py to see both ' + \
             'approaches (s4cmb-resources/Part2), and example in doctest above.'
-        assert npixfp == self.point_matrix.shape[0], msg
-        assert nt == self.point_matrix.shape[1], msg
-
-        assert npixfp == pol_angs.shape[0], msg
-        assert nt == pol_angs.shape[1], msg
+        if wafermask_pixel is not None:
+            assert npixfp == wafermask_pixel.shape[0], msg
+            assert nt == wafermask_pixel.shape[1], msg
 
         assert npixfp == self.diff_weight.shape[0], msg
         assert npixfp == self.sum_weight.shape[0], msg
 
-        point_matrix = self.point_matrix.flatten()
-        pol_angs = pol_angs.flatten()
-        waferts = waferts.flatten()
-        diff_weight = self.diff_weight.flatten()
-        sum_weight = self.sum_weight.flatten()
-        wafermask_pixel = self.wafermask_pixel.flatten()
-
-        if (hasattr(self, 'dm') and (gdeprojection is False)):
-            tod_f.tod2map_hwp_f(
-                output_maps.d0, output_maps.d4r, output_maps.d4i,
-                output_maps.w0, output_maps.w4, output_maps.nhit,
-                point_matrix, pol_angs, waferts,
-                diff_weight, sum_weight, nt,
-                wafermask_pixel, npixfp, self.npixsky)
-        elif (hasattr(self, 'dm') and gdeprojection):
-            tod_f.tod2map_pair_gdeprojection_f(
-                output_maps.d, output_maps.w,
-                output_maps.dm, output_maps.dc, output_maps.ds,
-                output_maps.wm, output_maps.cc, output_maps.cs,
-                output_maps.ss, output_maps.c, output_maps.s, output_maps.nhit,
-                point_matrix, pol_angs, waferts,
-                diff_weight, sum_weight, nt,
-                wafermask_pixel, npixfp, self.npixsky)
+        if self.store_pointing:
+            if frequency_channel == 1:
+                pol_angs = self.pol_angs
+            elif frequency_channel == 2:
+                pol_angs = self.pol_angs2
+
+            point_matrix = self.point_matrix[:, ::step]
+            pol_angs = pol_angs[:, ::step]
+
+            assert npixfp == point_matrix.shape[0], msg
+            assert nt == point_matrix.shape[1], msg
+
+            assert npixfp == pol_angs.shape[0], msg
+            assert nt == pol_angs.shape[1], msg
+
+            self.project_timestreams(
+                waferts, output_maps, point_matrix, pol_angs,
+                self.diff_weight, self.sum_weight, wafermask_pixel,
+                gdeprojection=gdeprojection, nthreads=nthreads, tiled=tiled)
+            return
+
+        ## Pointing not stored: recompute it pair-by-pair (only one pair
+        ## of pointing in memory at a time).
+        if self.mapping_perpair:
+            top_bolometers = [self.current_top_bolometer]
         else:
-            tod_f.tod2map_pair_f(
-                output_maps.d, output_maps.w, output_maps.dc,
-                output_maps.ds, output_maps.cc, output_maps.cs,
-                output_maps.ss, output_maps.nhit,
-                point_matrix, pol_angs, waferts,
-                diff_weight, sum_weight, nt,
-                wafermask_pixel, npixfp, self.npixsky)
-        # Garbage collector guard
-        wafermask_pixel
+            top_bolometers = range(0, nbolofp, 2)
+
+        ## HWP angles computed once for all pairs (pair difference only)
+        hwpangle = None
+        if not hasattr(self, 'dm') and self.HealpixFitsMap.do_pol:
+            hwpangle = self.hwpangle
+
+        for pair, ch in enumerate(top_bolometers):
+            index_global, index_local, pa = self.compute_pointing(ch)
+            pol_ang = self.get_binning_angle(
+                ch, pa, frequency_channel, hwpangle=hwpangle)
+            index_local = index_local[::step].astype(np.int32)
+
+            sl = slice(pair, pair + 1)
+            self.project_timestreams(
+                waferts[2 * pair: 2 * pair + 2], output_maps,
+                index_local.reshape((1, nt)),
+                pol_ang[::step].reshape((1, nt)),
+                self.diff_weight[sl], self.sum_weight[sl],
+                None if wafermask_pixel is None else wafermask_pixel[sl],
+                gdeprojection=gdeprojection, nthreads=nthreads, tiled=tiled)
+
+    def get_binning_angle(self, ch, pa, frequency_channel=1, hwpangle=None):
+        """
+        Return the polarisation angles of the top bolometer ch used to
+        project the timestreams (what map2tod stores in pol_angs).
+
+        Parameters
+        ----------
+        ch : int
+            Channel index in the focal plane (top bolometer).
+        pa : 1d array
+            Parallactic angles of the detector (see compute_pointing).
+        frequency_channel : int, optional
+            If you are processing dichroic pixels, you need to specify the
+            index of the frequency channel (1 or 2). Default is 1.
+        hwpangle : 1d array, optional
+            HWP angles for the whole scan, if already computed (pair
+            difference only). Default is self.hwpangle.
+
+        Returns
+        ----------
+        pol_ang : 1d array
+            Polarisation angles, in the precision of the TOD.
+        """
+        if not self.HealpixFitsMap.do_pol:
+            return np.zeros(len(pa), dtype=self.dtype)
+
+        ## For demodulation, HWP angles are not included at the
+        ## level of the pointing matrix (convention): no need to
+        ## compute them.
+        if hasattr(self, 'dm'):
+            if frequency_channel == 1:
+                polangle = self.intrinsic_polangle[ch]
+            elif frequency_channel == 2:
+                polangle = self.intrinsic_polangle2[ch]
+            pol_ang = pa - (90.0 - polangle) * d2r
+            return pol_ang.astype(self.dtype, copy=False)
+
+        pol_ang, pol_ang2 = self.compute_simpolangle(
+            ch, pa, polangle_err=False, hwpangle=hwpangle)
+        if frequency_channel == 2:
+            pol_ang = pol_ang2
+
+        return pol_ang.astype(self.dtype, copy=False)
+
+    def map2tod_stack(self, ch, pointing=None, hwpangle=None):
+        """
+        Scan all the sky realisations stored in the input sky
+        (HealpixFitsMap.set_stack) for channel ch. The pointing is computed
+        once for all realisations. Only the sky signal is scanned
+        (noise can be added in the map domain, see
+        OutputSkyMap.add_white_noise).
+
+        Parameters
+        ----------
+        ch : int
+            Channel index in the focal plane.
+        pointing : tuple, optional
+            Output of compute_pointing(ch), if already computed.
+        hwpangle : 1d array, optional
+            HWP angles for the whole scan, if already computed.
+            Default is self.hwpangle.
+
+        Returns
+        ----------
+        ts : ndarray
+            Timestreams for all realisations. Size (N, ntimesamples).
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> IQU = np.array([sky_in.I, sky_in.Q, sky_in.U])
+        >>> sky_in.set_stack([IQU, 2 * IQU])
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> ts = tod.map2tod_stack(0)
+        >>> print(ts.shape)
+        (2, 139992)
+        >>> assert np.allclose(ts[1], 2 * tod.map2tod(0))
+        """
+        assert self.mode == 'standard', \
+            ValueError("Stacks of sky realisations are only available " +
+                       "for mode='standard'.")
+        if pointing is None:
+            pointing = self.compute_pointing(ch)
+        index_global, index_local, pa = pointing
+
+        ## All realisations gathered at once: (N, 3, ntimesamples)
+        sky = self.HealpixFitsMap.get_stack(index_global)
+
+        if self.projection == 'flat':
+            sign = -1.
+        elif self.projection == 'healpix':
+            sign = 1.
+
+        ts = sky[:, 0]
+        if self.HealpixFitsMap.do_pol:
+            pol_ang, pol_ang2 = self.compute_simpolangle(
+                ch, pa, polangle_err=False, hwpangle=hwpangle)
+            pol_ang = pol_ang.astype(self.dtype, copy=False)
+            ts = ts + sky[:, 1] * np.cos(2 * pol_ang) + \
+                sign * sky[:, 2] * np.sin(2 * pol_ang)
+
+        return (ts * self.get_detector_gain(ch)).astype(
+            self.dtype, copy=False)
+
+    def scan_and_bin_stack(self, output_maps, gdeprojection=False,
+                           nthreads=1, tiled=None):
+        """
+        Scan all the sky realisations stored in the input sky
+        (HealpixFitsMap.set_stack), and project them into one set of
+        output maps per realisation, in one pass over the pairs of
+        detectors. The pointing of each detector is computed once for all
+        the realisations, and only the timestreams of one pair are in
+        memory at a time.
+
+        Parameters
+        ----------
+        output_maps : list of OutputSkyMap instances
+            One instance per realisation (updated on-the-fly).
+        gdeprojection : bool, optional
+            See tod2map.
+        nthreads : int, optional
+            See tod2map.
+        tiled : bool, optional
+            See tod2map.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> IQU = np.array([sky_in.I, sky_in.Q, sky_in.U])
+        >>> sky_in.set_stack([IQU, 2 * IQU], interleaved=True)
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> maps = [OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix) for i in range(2)]
+        >>> tod.scan_and_bin_stack(maps)
+
+        Same as map2tod and tod2map for each realisation
+        >>> d = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(d, m)
+        >>> assert np.allclose(maps[0].d, m.d)
+        >>> assert np.allclose(maps[0].ds, m.ds)
+        >>> assert np.allclose(maps[1].dc, 2 * m.dc)
+
+        Demodulation
+        >>> tod = TimeOrderedDataDemod(inst, scan, sky_in, CESnumber=0)
+        >>> maps = [OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix, demodulation=True)
+        ...     for i in range(2)]
+        >>> tod.scan_and_bin_stack(maps)
+        >>> assert np.allclose(maps[1].d4r, 2 * maps[0].d4r)
+        """
+        nstack = self.HealpixFitsMap.nstack
+        assert len(output_maps) == nstack, \
+            ValueError("You need one output map per realisation " +
+                       "({} realisations).".format(nstack))
+
+        self.allocate_buffers()
+        nt = self.nsamples
+
+        ## HWP angles computed once for all detectors
+        hwpangle = None
+        if self.HealpixFitsMap.do_pol:
+            hwpangle = self.hwpangle
+
+        for pair in range(self.npair):
+            ## Weights and masks are given for one pair if mapping_perpair
+            row = 0 if self.mapping_perpair else pair
+            sl = slice(row, row + 1)
+
+            top = 2 * pair
+            pointing = self.compute_pointing(top)
+            ts = np.empty((nstack, 2, nt), dtype=self.dtype)
+            ts[:, 0] = self.map2tod_stack(
+                top, pointing=pointing, hwpangle=hwpangle)
+            ts[:, 1] = self.map2tod_stack(top + 1, hwpangle=hwpangle)
+
+            index_local = pointing[1].astype(np.int32, copy=False)
+            pol_ang = self.get_binning_angle(
+                top, pointing[2], hwpangle=hwpangle)
+
+            for output_map, waferts in zip(output_maps, ts):
+                if hasattr(self, 'dm'):
+                    waferts = self.demodulate_timestreams(waferts)
+                self.project_timestreams(
+                    waferts, output_map,
+                    index_local.reshape((1, nt)), pol_ang.reshape((1, nt)),
+                    self.diff_weight[sl], self.sum_weight[sl],
+                    self.get_timestream_masks(sl),
+                    gdeprojection=gdeprojection, nthreads=nthreads,
+                    tiled=tiled)
+
+    def project_timestreams(self, waferts, output_maps, point_matrix,
+                            pol_angs, diff_weight, sum_weight,
+                            wafermask_pixel, gdeprojection=False,
+                            nthreads=1, tiled=None):
+        """
+        Project timestreams of pairs of detectors into sky maps using
+        the fortran kernels (see bin_timestreams). Used by tod2map.
+        """
+        bin_timestreams(
+            waferts, output_maps, point_matrix, pol_angs,
+            diff_weight, sum_weight, wafermask_pixel,
+            npixsky=self.npixsky, dtype=self.dtype,
+            demodulation=hasattr(self, 'dm'),
+            gdeprojection=gdeprojection, nthreads=nthreads, tiled=tiled)
 
 
 class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
@@ -1016,9 +1812,12 @@ class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
                  CESnumber, projection='healpix',
                  nside_out=None, pixel_size=None, width=140.,
                  cut_pixels_outside=True,
+                 restrict_input_sky=False, input_sky_margin=None,
                  array_noise_level=None, array_noise_seed=487587,
                  array_noise_level2=None, array_noise_seed2=56736,
-                 mapping_perpair=False, mode='standard', verbose=False):
+                 noise_rng='legacy',
+                 mapping_perpair=False, mode='standard', precision='double',
+                 store_pointing=True, decimation=None, verbose=False):
         """
         C'est parti!
 
@@ -1047,6 +1846,13 @@ class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
             In arcmin. Default is resolution of the input map.
         width : float, optional
             Width for the output map in degree.
+        restrict_input_sky : bool, optional
+            If True, keep in memory only the pixels of the input maps which
+            are inside the sky patch (plus a margin).
+            See TimeOrderedDataPairDiff.
+        input_sky_margin : float, optional
+            Margin in degree added around the patch when restricting the
+            input maps. Default is the projected size of the focal plane.
         array_noise_level : float, optional
             Noise level for the whole array in [u]K.sqrt(s). If not None, it
             will inject on-the-fly noise in time-domain while scanning
@@ -1057,6 +1863,9 @@ class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
             From this single seed, we generate a list of seeds
             for all detectors. Has an effect only if array_noise_level is
             provided.
+        noise_rng : string, optional
+            Random number generator for the noise: `legacy` or `philox`.
+            See TimeOrderedDataPairDiff.
         mapping_perpair : bool, optional
             If True, assume that you want to process pairs of bolometers
             one-by-one, that is pairs are uncorrelated. Default is False (and
@@ -1066,6 +1875,26 @@ class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
             (2 frequency bands). If `dichroic` is chosen, make sure your
             hardware can handle it (see instrument.py) and HealpixFitsMap
             should contain the inputs maps at different frequency.
+        precision : string, optional
+            Floating point precision of the timestreams, noise and
+            polarisation angles: `double` (float64) or `single` (float32).
+            Sky map accumulators (OutputSkyMap) are always in double
+            precision. Default is `double`.
+        store_pointing : bool, optional
+            If True, map2tod stores the pixel indices and polarisation angles
+            of the top bolometers (point_matrix, pol_angs) to be used later
+            by tod2map. If False, nothing is stored (saving
+            2 x npair x nsamples numbers), and tod2map recomputes the
+            pointing pair-by-pair. Default is True.
+        decimation : int or string, optional
+            Decimation factor of the demodulated timestreams: once low
+            passed, they are kept (and projected by tod2map) every
+            `decimation` samples only, with the matching pointing and
+            polarisation angles. If `auto`, use the largest factor allowed
+            by the bandwidth of the demodulation filters (see
+            Demodulation.get_decimation_factor). Note that nhit (and w0,
+            w4) then count decimated samples. Default is None (no
+            decimation).
 
         Examples
         ----------
@@ -1079,6 +1908,17 @@ class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
         ...     nside=tod.nside_out, obspix=tod.obspix, demodulation=True)
         >>> tod.tod2map(d, m)
 
+        Same without storing the pointing
+        >>> tod2 = TimeOrderedDataDemod(inst, scan, sky_in,
+        ...     CESnumber=0, projection='healpix', mapping_perpair=True,
+        ...     store_pointing=False)
+        >>> d = np.array([tod2.map2tod(det) for det in range(2)])
+        >>> d = tod2.demodulate_timestreams(d)
+        >>> m2 = OutputSkyMap(projection=tod2.projection,
+        ...     nside=tod2.nside_out, obspix=tod2.obspix, demodulation=True)
+        >>> tod2.tod2map(d, m2)
+        >>> assert np.allclose(m2.d0, m.d0) and np.allclose(m2.d4r, m.d4r)
+
         Same with dichroic detectors
         >>> inst, scan, sky_in = load_fake_instrument(fwhm_in2=1.8)
         >>> tod = TimeOrderedDataDemod(inst, scan, sky_in, mode='dichroic',
@@ -1094,32 +1934,84 @@ class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
         ...     nside=tod.nside_out, obspix=tod.obspix, demodulation=True)
         >>> tod.tod2map(d1, m1, frequency_channel=1)
         >>> tod.tod2map(d2, m2, frequency_channel=2)
+
+        Decimating the demodulated timestreams: 8x fewer samples to
+        project, which are the full rate demodulated samples taken
+        every 8 samples
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataDemod(inst, scan, sky_in,
+        ...     CESnumber=0, projection='healpix', decimation='auto')
+        >>> print(tod.decimation)
+        8
+        >>> d = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
+        >>> dd = tod.demodulate_timestreams(d)
+        >>> print(dd.shape)
+        (8, 3, 17499)
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix, demodulation=True)
+        >>> tod.tod2map(dd, m)
+        >>> tod.decimation = 1
+        >>> d = tod.demodulate_timestreams(d)
+        >>> assert np.allclose(dd, d[..., ::8])
+        >>> m1 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix, demodulation=True)
+        >>> tod.tod2map(d, m1)
+
+        The maps are close to the full rate ones (with fewer samples per
+        pixel, the average of the signal within the pixels is noisier)
+        >>> mask = m.nhit > 10
+        >>> Qin = sky_in.Q[tod.obspix][mask]
+        >>> res = np.std(m.get_QU_demod()[0][mask] - Qin)
+        >>> res1 = np.std(m1.get_QU_demod()[0][mask] - Qin)
+        >>> assert res < 1.25 * res1, (res, res1)
+        >>> Iin = sky_in.I[tod.obspix][mask]
+        >>> res = np.std(m.get_I_demod()[mask] - Iin)
+        >>> res1 = np.std(m1.get_I_demod()[mask] - Iin)
+        >>> assert res < 1.05 * res1, (res, res1)
         """
         TimeOrderedDataPairDiff.__init__(
             self, hardware, scanning_strategy, HealpixFitsMap,
             CESnumber, projection=projection,
             nside_out=nside_out, pixel_size=pixel_size, width=width,
             cut_pixels_outside=cut_pixels_outside,
+            restrict_input_sky=restrict_input_sky,
+            input_sky_margin=input_sky_margin,
             array_noise_level=array_noise_level,
             array_noise_seed=array_noise_seed,
             array_noise_level2=array_noise_level2,
             array_noise_seed2=array_noise_seed2,
+            noise_rng=noise_rng,
             mapping_perpair=mapping_perpair,
             mode=mode,
+            precision=precision,
+            store_pointing=store_pointing,
             verbose=verbose)
 
         ## Prepare the demodulation of timestreams
         self.dm = Demodulation(
             self.hardware.half_wave_plate.freq_hwp,
             self.scanning_strategy.sampling_freq,
-            self.hwpangle,
+            self.hwp,
             self.verbose)
 
         ## Prepare the filters use for the demodulation
         self.dm.prepfilter([4], [1.9])
-        self.dm.prepfftedfilter(nt=self.nsamples)
+        if sp_fft is None:
+            ## FFTed filters for Demodulation.demod (otherwise,
+            ## Demodulation.demod_batch prepares its own).
+            self.dm.prepfftedfilter(nt=self.nsamples)
+
+        ## Decimation of the demodulated timestreams
+        if decimation == 'auto':
+            self.decimation = self.dm.get_decimation_factor()
+        elif decimation is None:
+            self.decimation = 1
+        else:
+            self.decimation = int(decimation)
+        assert self.decimation >= 1, \
+            ValueError("decimation must be a positive integer or `auto`.")
 
-    def demodulate_timestreams(self, ts):
+    def demodulate_timestreams(self, ts, workers=None):
         """
         Perform the demodulation of timestreams, that is split full timestream
         according to their HWP frequency dependency:
@@ -1127,19 +2019,46 @@ class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
 
         Careful, memory requirement explodes here! You go from an array of size
         (ndet, nbolometer) to (ndet, 3, nbolometer), that is you need 3x more
-        memory.
+        memory (unless the demodulated timestreams are decimated, see
+        decimation).
 
         Parameters
         ----------
         ts : array of size (ndet, nbolometer)
             Array of timestreams.
+        workers : int, optional
+            Number of threads used by the FFTs (all detectors are
+            transformed at once, see Demodulation.demod_batch).
+            Default (None) is one thread.
 
         Returns
         ----------
         newts : array of size (ndet, 3, nbolometer)
+            If decimation > 1, only one sample every decimation samples
+            is returned.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataDemod(inst, scan, sky_in, CESnumber=0)
+        >>> d = np.array([tod.map2tod(det) for det in range(2)])
+        >>> newts = tod.demodulate_timestreams(d, workers=2)
+        >>> print(newts.shape)
+        (2, 3, 139992)
         """
-        outshape = (ts.shape[0], 3, ts.shape[1])
-        newts = np.zeros(outshape)
+        ## Demodulated timestreams are low passed: keep one sample every
+        ## decimation samples.
+        step = self.decimation
+        outshape = (ts.shape[0], 3, len(range(0, ts.shape[1], step)))
+        newts = np.zeros(outshape, dtype=self.dtype)
+
+        if sp_fft is not None:
+            ## One real FFT of the timestreams for both 0f and 4f
+            b0, bm = self.dm.demod_batch(ts, mode=4, workers=workers)
+            newts[:, 0, :] = b0[:, ::step]
+            newts[:, 1, :] = bm.real[:, ::step]
+            newts[:, 2, :] = bm.imag[:, ::step]
+            return newts
 
         self.dm.b = ts
         # dm.b.copy()
@@ -1147,15 +2066,154 @@ class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
 
         ## Do temperature
         self.dm.demod(0)
-        newts[:, 0, :] = self.dm.bm.real
+        newts[:, 0, :] = self.dm.bm.real[:, ::step]
 
         ## Do 4f component (effectively polarisation)
         self.dm.demod(4)
-        newts[:, 1, :] = self.dm.bm.real
-        newts[:, 2, :] = self.dm.bm.imag
+        newts[:, 1, :] = self.dm.bm.real[:, ::step]
+        newts[:, 2, :] = self.dm.bm.imag[:, ::step]
 
         return newts
 
+    def demodulate_and_bin(self, ts, output_maps, block_size=65536,
+                           frequency_channel=1):
+        """
+        Demodulate timestreams and project them into sky maps at once.
+        Same as demodulate_timestreams followed by tod2map, but the
+        timestreams are demodulated block-by-block (StreamingDemodulation)
+        and each block is projected directly into d0, d4r, d4i, w0, w4 and
+        nhit (tod2map_hwp_demod_f): the array of demodulated timestreams
+        (ndet, 3, nt) is never created.
+
+        Parameters
+        ----------
+        ts : array of size (ndet, nbolometer)
+            Array of timestreams (pairs of detectors).
+        output_maps : OutputSkyMap instance
+            Sky maps (demodulation=True) updated on-the-fly.
+        block_size : int, optional
+            Number of time samples demodulated at once. Default is 65536.
+        frequency_channel : int, optional
+            If you are processing dichroic pixels, you need to specify the
+            index of the frequency channel (1 or 2). Default is 1.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataDemod(inst, scan, sky_in,
+        ...     CESnumber=0, projection='healpix', mapping_perpair=True)
+        >>> m1 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix, demodulation=True)
+        >>> m2 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix, demodulation=True)
+        >>> for pair in tod.pair_list:
+        ...   d = np.array([tod.map2tod(det) for det in pair])
+        ...   tod.demodulate_and_bin(d, m1, block_size=10000)
+        ...   tod.tod2map(tod.demodulate_timestreams(d), m2)
+        >>> assert np.allclose(m1.d0, m2.d0) and np.allclose(m1.d4r, m2.d4r)
+        >>> assert np.allclose(m1.d4i, m2.d4i) and np.all(m1.nhit == m2.nhit)
+
+        With decimation of the demodulated timestreams
+        >>> tod.decimation = 8
+        >>> m1 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix, demodulation=True)
+        >>> m2 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix, demodulation=True)
+        >>> for pair in tod.pair_list:
+        ...   d = np.array([tod.map2tod(det) for det in pair])
+        ...   tod.demodulate_and_bin(d, m1, block_size=10001)
+        ...   tod.tod2map(tod.demodulate_timestreams(d), m2)
+        >>> assert np.allclose(m1.d0, m2.d0) and np.allclose(m1.d4r, m2.d4r)
+        >>> assert np.all(m1.nhit == m2.nhit)
+
+        All the pairs at once (mapping_perpair=False): the top detector of
+        each pair is projected, as in tod2map
+        >>> tod = TimeOrderedDataDemod(inst, scan, sky_in,
+        ...     CESnumber=0, projection='healpix', mapping_perpair=False)
+        >>> d = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
+        >>> m1 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix, demodulation=True)
+        >>> m2 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix, demodulation=True)
+        >>> tod.demodulate_and_bin(d, m1, block_size=10000)
+        >>> tod.tod2map(tod.demodulate_timestreams(d), m2)
+        >>> assert np.allclose(m1.d0, m2.d0) and np.allclose(m1.d4r, m2.d4r)
+        >>> assert np.allclose(m1.d4i, m2.d4i) and np.all(m1.nhit == m2.nhit)
+        """
+        self.allocate_buffers()
+        npixfp = ts.shape[0] // 2
+        nt = ts.shape[-1]
+
+        ## Nothing to project for empty timestreams
+        if nt == 0:
+            return
+
+        assert npixfp == self.diff_weight.shape[0], \
+            ValueError("Timestreams and TOD buffers do not match " +
+                       "(see mapping_perpair in tod2map).")
+
+        if self.mapping_perpair:
+            top_bolometers = [self.current_top_bolometer]
+        else:
+            top_bolometers = range(0, 2 * npixfp, 2)
+
+        for pair, ch in enumerate(top_bolometers):
+            ## Pointing of the top bolometer (stored or recomputed)
+            if self.store_pointing:
+                pol_angs = self.pol_angs if frequency_channel == 1 \
+                    else self.pol_angs2
+                index_local = self.point_matrix[pair]
+                pol_ang = pol_angs[pair]
+            else:
+                index_global, index_local, pa = self.compute_pointing(ch)
+                index_local = index_local.astype(np.int32, copy=False)
+                pol_ang = self.get_binning_angle(ch, pa, frequency_channel)
+            mask = self.get_timestream_masks(
+                slice(pair, pair + 1))[0].view(np.int8)
+
+            ## Only the top bolometer is projected (as in tod2map)
+            sdm = StreamingDemodulation(self.dm)
+            start = 0
+            for beg in range(0, nt, block_size):
+                b0, bm = sdm.push_components(
+                    ts[2 * pair: 2 * pair + 1, beg: beg + block_size])
+                start = self.bin_demodulated_block(
+                    b0, bm, start, index_local, pol_ang, mask, pair,
+                    output_maps)
+            b0, bm = sdm.flush_components()
+            self.bin_demodulated_block(
+                b0, bm, start, index_local, pol_ang, mask, pair, output_maps)
+
+    def bin_demodulated_block(self, b0, bm, start, index_local, pol_ang,
+                              mask, pair, output_maps):
+        """
+        Project a block of demodulated samples (starting at time sample
+        start) of one pair into the sky maps. Return the time sample
+        following the block. See demodulate_and_bin.
+        """
+        nout = b0.shape[-1]
+
+        ## Decimation: keep the samples which are multiples of decimation
+        step = self.decimation
+        first = (-start) % step
+        b0 = b0[..., first::step]
+        bm = bm[..., first::step]
+        if b0.shape[-1] == 0:
+            return start + nout
+        sl = slice(start + first, start + nout, step)
+        tod_f.tod2map_hwp_demod_f(
+            d0=output_maps.d0, d4r=output_maps.d4r, d4i=output_maps.d4i,
+            w0=output_maps.w0, w4=output_maps.w4, nhit=output_maps.nhit,
+            waferi1d=index_local[sl],
+            waferpa=pol_ang[sl].astype(np.float64, copy=False),
+            b0=b0.ravel().astype(np.float64, copy=False),
+            b4=bm.ravel().astype(np.complex128, copy=False),
+            weight4=self.diff_weight[pair: pair + 1],
+            weight0=self.sum_weight[pair: pair + 1],
+            npix=1, nt=b0.shape[-1], wafermask_pixel=mask[sl],
+            nskypix=self.npixsky)
+        return start + nout
+
 
 class Demodulation():
     """ Class to handle demodulation of timestreams """
@@ -1176,9 +2234,11 @@ class Demodulation():
             HWP spin frequency in Hz.
         sampling_freq : float
             Detector sampling frequency in Hz.
-        hwp_angles : 1D array
+        hwp_angles : 1D array or HWPAngles instance
             Array containing the hwp angles sampled at the detector
-            sampling frequency. In radians.
+            sampling frequency. In radians. If HWPAngles instance (HWP
+            rotating at constant speed), angles and complex exponentials are
+            computed on demand.
 
         For examples, see TimeOrderedDataDemod.
 
@@ -1189,8 +2249,11 @@ class Demodulation():
         self.verbose = verbose
 
         ## In Hz
-        self.speed = np.median(
-            np.diff(self.hwp_angles)) * self.sampling_freq / (2 * np.pi)
+        if isinstance(self.hwp_angles, HWPAngles):
+            self.speed = self.hwp_angles.rate * self.sampling_freq
+        else:
+            self.speed = np.median(
+                np.diff(self.hwp_angles)) * self.sampling_freq / (2 * np.pi)
 
         ## Nyquist frequency at half the sampling
         self.nyq = self.sampling_freq / 2.
@@ -1225,6 +2288,7 @@ class Demodulation():
                 numtaps = 1023
 
         self.modes = np.array([modes]).flatten()
+        self.relative = relative
 
         if bands is None:
             self.bands = np.ones(self.modes.shape) * self.speed
@@ -1252,13 +2316,34 @@ class Demodulation():
             self.modes = self.modes[~bad]
             self.bands = self.bands[~bad]
 
-        self.lpf0 = firwin(numtaps, self.hwp_freq, nyq=self.nyq)
+        self.numtaps = numtaps
+
+        ## Filters are designed once per set of parameters (shared by all
+        ## scans with the same HWP speed and sampling frequency).
+        bank = get_filter_bank(self.filter_bank_key(), self.design_filters)
+        self.lpf0 = bank['lpf0']
+        self.lpfs = bank['lpfs']
+        self.bpfs = bank['bpfs']
+
+    def design_filters(self):
+        """
+        Construct the low pass filters for intensity and for each mode, and
+        the complex band pass filters for each mode (time domain).
+
+        Returns
+        ----------
+        filters : dict
+            Low pass filters for intensity (`lpf0`) and for each mode
+            (`lpfs`), and band pass filters for each mode (`bpfs`).
+        """
+        numtaps = self.numtaps
+        lpf0 = firwin(numtaps, self.hwp_freq, nyq=self.nyq)
 
         ## Construct the filters
-        self.lpfs = []
-        self.bpfs = []
+        lpfs = []
+        bpfs = []
         for mode, band in zip(self.modes, self.bands):
-            self.lpfs.append(firwin(numtaps, band, nyq=self.nyq))
+            lpfs.append(firwin(numtaps, band, nyq=self.nyq))
             bpfreal = firwin(
                 numtaps,
                 [self.speed * mode - band, self.speed * mode + band],
@@ -1267,11 +2352,83 @@ class Demodulation():
 
             fbpf = fftpack.fft(bpfreal)
             fbpf[: int((numtaps + 1) / 2)] = 0.
-            self.bpfs.append(fftpack.ifft(fbpf))
+            bpfs.append(fftpack.ifft(fbpf))
 
-        self.bpfs = np.array(self.bpfs)
-        self.lpfs = np.array(self.lpfs)
-        self.numtaps = numtaps
+        return {
+            'lpf0': lpf0,
+            'lpfs': np.array(lpfs),
+            'bpfs': np.array(bpfs)}
+
+    def filter_bank_key(self, *args):
+        """
+        Return the key of the filters in DEMODULATION_FILTER_BANKS: HWP
+        speed, sampling frequency, modes, bands, cutoff of the intensity
+        filter and number of coefficients (plus any extra arguments, e.g.
+        the size of the FFTs for the FFTed filters).
+        Frequencies are rounded to 12 significant digits (the HWP speed
+        is estimated from the HWP angles).
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod1 = TimeOrderedDataDemod(inst, scan, sky_in, CESnumber=0)
+        >>> tod2 = TimeOrderedDataDemod(inst, scan, sky_in, CESnumber=1)
+        >>> print(tod1.dm.filter_bank_key())
+        (0.2, 8.0, (4,), (0.38,), 0.04, 255)
+
+        Filters are shared between scans
+        >>> assert tod1.dm.lpfs is tod2.dm.lpfs
+        """
+        def freq(x):
+            return float('%.12g' % x)
+
+        return (freq(self.speed), freq(self.sampling_freq),
+                tuple(int(mode) for mode in self.modes),
+                tuple(freq(band) for band in self.bands),
+                freq(self.hwp_freq), self.numtaps) + args
+
+    def get_phasor(self, mode, start=0, stop=None):
+        """
+        Return exp(i * mode * HWP angles) for the time samples
+        start ... stop - 1 (see HWPAngles.phasor).
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataDemod(inst, scan, sky_in, CESnumber=0)
+        >>> e = tod.dm.get_phasor(4, 100, 200)
+        >>> assert np.allclose(e, np.exp(4.j * tod.hwpangle[100: 200]))
+        """
+        if isinstance(self.hwp_angles, HWPAngles):
+            return self.hwp_angles.phasor(mode, start, stop)
+        return np.exp(1.j * mode * self.hwp_angles[start: stop])
+
+    def get_decimation_factor(self):
+        """
+        Return the largest decimation factor of the demodulated timestreams
+        which does not alias their content. Once low passed, intensity and
+        polarisation have no power above the largest cutoff of the low pass
+        filters plus the width of their transition band (about
+        3.3 * sampling_freq / numtaps for a Hamming window), so they can be
+        sampled at twice this frequency.
+
+        Returns
+        ----------
+        factor : int
+            Decimation factor (1 means no decimation).
+
+        Examples
+        ----------
+        HWP spinning at 2 Hz, detectors sampled at 100 Hz
+        >>> hwp_angles = 2 * np.pi * 2. * np.arange(1000) / 100.
+        >>> dm = Demodulation(2., 100., hwp_angles)
+        >>> dm.prepfilter([4], [1.9])
+        >>> print(dm.get_decimation_factor())
+        11
+        """
+        fmax = np.max(np.append(self.bands, self.hwp_freq))
+        fmax += 3.3 * self.sampling_freq / self.numtaps
+        return max(1, int(np.floor(self.nyq / fmax)))
 
     def prepfftedfilter(self, nt):
         """
@@ -1285,17 +2442,186 @@ class Demodulation():
         n = self.lpf0.size
 
         fftsize = int(2 ** np.ceil(np.log2(nt + 3 * n - 1)))
-        self.flpf0 = fftpack.fft(self.lpf0, fftsize)
 
-        self.fbpfs = []
-        for bpf in self.bpfs:
-            self.fbpfs.append(fftpack.fft(bpf, fftsize))
-        self.fbpfs = np.asarray(self.fbpfs)
+        bank = get_filter_bank(
+            self.filter_bank_key('fftpack', fftsize),
+            lambda: {
+                'lpf0': fftpack.fft(self.lpf0, fftsize),
+                'bpfs': fftpack.fft(self.bpfs, fftsize, axis=-1),
+                'lpfs': fftpack.fft(self.lpfs, fftsize, axis=-1)})
+        self.flpf0 = bank['lpf0']
+        self.fbpfs = bank['bpfs']
+        self.flpfs = bank['lpfs']
+
+    def get_fft_filters(self, nt):
+        """
+        Return the size of the FFTs used to filter timestreams of length nt
+        (fast size for scipy.fft, not necessarily a power of two), and the
+        FFTed filters at this size. They are computed once per size, and
+        shared between instances (see DEMODULATION_FILTER_BANKS).
+        The padded length is first rounded up onto a coarse grid (1/16 of
+        its power of two), so that scans of similar lengths share the
+        same FFT size, hence the same filters.
+
+        Parameters
+        ----------
+        nt : int
+            Length of the timestreams to filter (number of time samples).
+
+        Returns
+        ----------
+        fftsize : int
+            Size of the FFTs.
+        filters : dict
+            Half spectra (rfft) of the real low pass filters for intensity
+            (`lpf0`) and for each mode (`lpfs`), and of the real and
+            imaginary parts of the complex band pass filters for each mode
+            (`bpfs_real`, `bpfs_imag`).
+
+        Examples
+        ----------
+        Scans of similar lengths share their filters
+        >>> hwp_angles = 2 * np.pi * 2. * np.arange(1000) / 100.
+        >>> dm = Demodulation(2., 100., hwp_angles)
+        >>> dm.prepfilter([4], [1.9])
+        >>> fftsize1, filters1 = dm.get_fft_filters(139992)
+        >>> fftsize2, filters2 = dm.get_fft_filters(139000)
+        >>> print(fftsize1, fftsize2, filters1 is filters2)
+        147456 147456 True
+
+        Only the most recently used filters are kept in memory.
+        >>> hwp_angles = 2 * np.pi * 2. * np.arange(1000) / 100.
+        >>> dm = Demodulation(2., 100., hwp_angles)
+        >>> dm.prepfilter([4], [1.9])
+        >>> for nt in range(1000, 1000 + 20 * 256, 256):
+        ...     fftsize, filters = dm.get_fft_filters(nt)
+        >>> nbanks = len(DEMODULATION_FILTER_BANKS)
+        >>> assert nbanks <= MAX_DEMODULATION_FILTER_BANKS
+        >>> print(filters['bpfs_real'].shape == (1, fftsize // 2 + 1))
+        True
+        """
+        n = self.lpf0.size
+        npad = nt + 3 * n - 1
+        grid = 2 ** max(0, int(npad).bit_length() - 5)
+        fftsize = sp_fft.next_fast_len(-(-npad // grid) * grid)
+
+        filters = get_filter_bank(
+            self.filter_bank_key('scipy.fft', fftsize),
+            lambda: {
+                'lpf0': sp_fft.rfft(self.lpf0, fftsize),
+                'bpfs_real': sp_fft.rfft(self.bpfs.real, fftsize, axis=-1),
+                'bpfs_imag': sp_fft.rfft(self.bpfs.imag, fftsize, axis=-1),
+                'lpfs': sp_fft.rfft(self.lpfs, fftsize, axis=-1)})
+        return fftsize, filters
+
+    def get_buffer(self, name, shape, dtype):
+        """
+        Return a buffer of a given shape and type, reused across calls
+        as long as the shape and type do not change.
+        """
+        if not hasattr(self, 'buffers'):
+            self.buffers = {}
+
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self.buffers[name] = buf
+        return buf
+
+    def demod_batch(self, x, mode=4, workers=None):
+        """
+        Demodulate all the timestreams at once, for both intensity (0f, low
+        pass filter) and polarisation (mode, band pass filter and
+        low pass filter). Same as demod(0) and demod(mode), but the (real)
+        FFT of the timestreams is done once and shared by the two paths,
+        the FFTs are done with scipy.fft for all detectors at once
+        (possibly with several threads), at a fast size, using buffers
+        reused across calls.
+
+        Parameters
+        ----------
+        x : ndarray
+            Timestreams, of size (ndet, nt).
+        mode : int, optional
+            Mode for polarisation. Default is 4.
+        workers : int, optional
+            Number of threads for the FFTs. Default (None) is one thread.
+
+        Returns
+        ----------
+        b0 : ndarray
+            Demodulated intensity (real), of size (ndet, nt).
+        bm : ndarray
+            Demodulated polarisation (complex), of size (ndet, nt).
 
-        self.flpfs = []
-        for lpf in self.lpfs:
-            self.flpfs.append(fftpack.fft(lpf, fftsize))
-        self.flpfs = np.asarray(self.flpfs)
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataDemod(inst, scan, sky_in, CESnumber=0)
+        >>> d = np.array([tod.map2tod(det) for det in range(2)])
+        >>> b0, b4 = tod.dm.demod_batch(d)
+
+        Same as the demodulation mode-by-mode
+        >>> tod.dm.br = d
+        >>> assert np.allclose(b0, tod.dm.demod(0).real)
+        >>> assert np.allclose(b4, tod.dm.demod(4))
+
+        Outputs are not overwritten by the next calls
+        >>> b4_ref = b4.copy()
+        >>> _ = tod.dm.demod_batch(2 * d)
+        >>> assert np.array_equal(b4, b4_ref)
+        >>> assert not np.shares_memory(b4, tod.dm.buffers['complex'])
+        """
+        i = np.where(self.modes == mode)[0][0]
+        x2 = x.reshape(-1, x.shape[-1])
+        ndet, nt = x2.shape
+        n = self.lpf0.size
+        fftsize, filters = self.get_fft_filters(nt)
+        nh = fftsize // 2 + 1
+        beg = (3 * n - 1) // 2
+
+        ## Timestreams padded with their first and last values
+        ## (as in convolvefilter).
+        rbuf = self.get_buffer('real', (ndet, fftsize), x2.dtype)
+        rbuf[:, :n] = x2[:, :1]
+        rbuf[:, n: nt + n] = x2
+        rbuf[:, nt + n: nt + 2 * n] = x2[:, -1:]
+        rbuf[:, nt + 2 * n:] = 0.
+        fx = sp_fft.rfft(rbuf, axis=-1, workers=workers)
+
+        ## Intensity: low pass filter (real)
+        b0 = sp_fft.irfft(
+            fx * filters['lpf0'], fftsize, axis=-1,
+            workers=workers)[:, beg: beg + nt]
+
+        ## Polarisation: band pass filter (complex). The timestreams are
+        ## real, so the real and imaginary parts of the filter are applied
+        ## separately on the half spectra.
+        u = 1.j * sp_fft.irfft(
+            fx * filters['bpfs_imag'][i], fftsize, axis=-1,
+            workers=workers)[:, beg: beg + nt]
+        u += sp_fft.irfft(
+            fx * filters['bpfs_real'][i], fftsize, axis=-1,
+            workers=workers)[:, beg: beg + nt]
+        u *= 2. * self.get_phasor(mode)
+
+        ## Low pass filter
+        cbuf = self.get_buffer('complex', (ndet, fftsize), np.complex128)
+        cbuf[:, :n] = u[:, :1]
+        cbuf[:, n: nt + n] = u
+        cbuf[:, nt + n: nt + 2 * n] = u[:, -1:]
+        cbuf[:, nt + 2 * n:] = 0.
+        u = sp_fft.fft(cbuf, axis=-1, overwrite_x=True, workers=workers)
+        ## Real filter: negative frequencies from hermitian symmetry
+        flpf = filters['lpfs'][i]
+        u[:, :nh] *= flpf
+        u[:, nh:] *= np.conj(flpf[1: fftsize - nh + 1][::-1])
+        ## New array (not the reused buffer): results of previous calls
+        ## must not be overwritten.
+        bm = sp_fft.ifft(u, axis=-1, workers=workers)
+
+        return (b0.reshape(x.shape),
+                bm[:, beg: beg + nt].reshape(x.shape))
 
     def demod(self, mode, bpf=True, lpf=True):
         """
@@ -1359,12 +2685,59 @@ class Demodulation():
         else:
             lpf = None
 
-        self.bm = demod(self.br, np.exp(1.j * mode * self.hwp_angles),
+        self.bm = demod(self.br, self.get_phasor(mode),
                         bpf=bpf, lpf=lpf, fbpf=fbpf, flpf=flpf)
 
         return self.bm
 
 
+def read_only(arrays):
+    """
+    Flag the arrays of a dictionary as read-only (they are shared, see
+    DEMODULATION_FILTER_BANKS), and return the dictionary.
+    """
+    for array in arrays.values():
+        array.flags.writeable = False
+    return arrays
+
+
+def get_filter_bank(key, build):
+    """
+    Return the filters stored in DEMODULATION_FILTER_BANKS under key,
+    constructed with build() if they are not there yet. Only the
+    MAX_DEMODULATION_FILTER_BANKS most recently used banks are kept, and
+    the least recently used are discarded as long as all the banks take
+    more than MAX_DEMODULATION_FILTER_BYTES (the last one is always kept).
+
+    Parameters
+    ----------
+    key : tuple
+        Key of the filters (see Demodulation.filter_bank_key).
+    build : function
+        Function without arguments returning the filters (dict of arrays).
+
+    Returns
+    ----------
+    filters : dict
+        Read-only arrays of the filters.
+    """
+    if key in DEMODULATION_FILTER_BANKS:
+        ## Most recently used banks are at the end
+        DEMODULATION_FILTER_BANKS[key] = DEMODULATION_FILTER_BANKS.pop(key)
+    else:
+        DEMODULATION_FILTER_BANKS[key] = read_only(build())
+        while len(DEMODULATION_FILTER_BANKS) > MAX_DEMODULATION_FILTER_BANKS:
+            DEMODULATION_FILTER_BANKS.popitem(last=False)
+        nbytes = sum(
+            array.nbytes for bank in DEMODULATION_FILTER_BANKS.values()
+            for array in bank.values())
+        while nbytes > MAX_DEMODULATION_FILTER_BYTES and (
+                len(DEMODULATION_FILTER_BANKS) > 1):
+            bank = DEMODULATION_FILTER_BANKS.popitem(last=False)[1]
+            nbytes -= sum(array.nbytes for array in bank.values())
+    return DEMODULATION_FILTER_BANKS[key]
+
+
 def demod(x, e, bpf=None, lpf=None, fbpf=None, flpf=None):
     """
     Actual demodulation scheme for a timestream vector x.
@@ -1466,13 +2839,284 @@ def convolvefilter(x, f, ff=None, isreal=False):
     return u[fftslice].reshape(init_shape)
 
 
-class WhiteNoiseGenerator():
-    """ Class to handle white noise """
-    def __init__(self, array_noise_level, ndetectors, ntimesamples,
-                 array_noise_seed):
+class OverlapSaveFilter():
+    """ Class to apply a FIR filter to timestreams given by time blocks """
+    def __init__(self, f):
         """
-        This class is used to simulate time-domain noise.
-        Usually, it is used in combination with map2tod to insert noise
+        Apply a finite impulse response filter to timestreams which are
+        given block-by-block (overlap-save method): only the last
+        numtaps - 1 samples are kept between two blocks. The result is the
+        same as convolvefilter on the full timestreams (edges are extended
+        with the first and last values), delayed by (numtaps - 1) // 2
+        samples, which are returned by flush.
+
+        Parameters
+        ----------
+        f : 1D array
+            Coefficients of the filter (see scipy.signal.firwin).
+
+        Examples
+        ----------
+        >>> x = np.random.RandomState(0).normal(size=(2, 1000))
+        >>> f = firwin(31, 0.1)
+        >>> osf = OverlapSaveFilter(f)
+        >>> y = [osf.push(x[:, i: i + 128]) for i in range(0, 1000, 128)]
+        >>> y = np.concatenate(y + [osf.flush()], axis=-1)
+        >>> assert np.allclose(y, convolvefilter(x, f))
+        """
+        if sp_fft is None:
+            raise ImportError("Streaming demodulation requires scipy >= 1.4.")
+        self.f = np.asarray(f)
+        self.n = self.f.size
+        self.delay = (self.n - 1) // 2
+        self.history = None
+        self.last = None
+        self.spectra = {}
+
+    def convolve(self, z):
+        """
+        Return the valid part of the convolution of z with the filter,
+        that is len(z) - numtaps + 1 samples, using one FFT per block.
+        """
+        m = z.shape[-1]
+        fftsize = sp_fft.next_fast_len(m)
+        real = np.isrealobj(z) and np.isrealobj(self.f)
+        if (fftsize, real) not in self.spectra:
+            if real:
+                self.spectra[(fftsize, real)] = sp_fft.rfft(self.f, fftsize)
+            else:
+                self.spectra[(fftsize, real)] = sp_fft.fft(self.f, fftsize)
+        ff = self.spectra[(fftsize, real)]
+
+        if real:
+            y = sp_fft.irfft(sp_fft.rfft(z, fftsize, axis=-1) * ff,
+                             fftsize, axis=-1)
+        else:
+            y = sp_fft.ifft(sp_fft.fft(z, fftsize, axis=-1) * ff, axis=-1)
+        return y[..., self.n - 1: m]
+
+    def push(self, x):
+        """
+        Filter a new block of timestreams.
+
+        Parameters
+        ----------
+        x : ndarray
+            Next time samples of the timestreams, of size (ndet, nblock).
+
+        Returns
+        ----------
+        y : ndarray
+            Filtered samples available so far (size (ndet, nout), with
+            nout = nblock once the first numtaps samples are received).
+        """
+        if self.history is None:
+            ## First block: extend the timestreams with their first value.
+            pad = np.repeat(x[..., :1], self.n - 1 - self.delay, axis=-1)
+            z = np.concatenate((pad, x), axis=-1)
+        else:
+            z = np.concatenate((self.history, x), axis=-1)
+        self.last = x[..., -1:]
+
+        ## Keep the last numtaps - 1 samples for the next block.
+        m = z.shape[-1]
+        self.history = z[..., max(m - (self.n - 1), 0):]
+        if m < self.n:
+            return z[..., :0]
+        return self.convolve(z)
+
+    def flush(self):
+        """
+        Return the last samples of the filtered timestreams (the end of the
+        timestreams is extended with their last value), and reset the
+        filter.
+        """
+        z = np.concatenate(
+            (self.history, np.repeat(self.last, self.delay, axis=-1)),
+            axis=-1)
+        self.history = None
+        self.last = None
+        return self.convolve(z)
+
+
+class StreamingDemodulation():
+    """ Class to demodulate timestreams given by time blocks """
+    def __init__(self, dm, mode=4):
+        """
+        Demodulation of timestreams given block-by-block (e.g. when the
+        timestreams are generated by time chunks), with bounded memory:
+        each filter (low pass for intensity, band pass and low pass for
+        polarisation) is applied with the overlap-save method
+        (see OverlapSaveFilter). Same result as
+        TimeOrderedDataDemod.demodulate_timestreams, but the outputs are
+        delayed (available once the filters have enough samples), and the
+        last samples are returned by flush.
+
+        Parameters
+        ----------
+        dm : Demodulation instance
+            Demodulation with filters prepared (see Demodulation.prepfilter).
+        mode : int, optional
+            Mode for polarisation. Default is 4.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataDemod(inst, scan, sky_in, CESnumber=0)
+        >>> d = np.array([tod.map2tod(det) for det in range(2)])
+        >>> sdm = StreamingDemodulation(tod.dm)
+        >>> blocks = [sdm.push(d[:, i: i + 16384])
+        ...     for i in range(0, tod.nsamples, 16384)]
+        >>> newts = np.concatenate(blocks + [sdm.flush()], axis=-1)
+        >>> print(newts.shape)
+        (2, 3, 139992)
+        >>> assert np.allclose(newts, tod.demodulate_timestreams(d))
+        """
+        self.mode = mode
+        self.dm = dm
+        i = np.where(dm.modes == mode)[0][0]
+
+        self.lpf0 = OverlapSaveFilter(dm.lpf0)
+        self.bpf = OverlapSaveFilter(dm.bpfs[i])
+        self.lpf = OverlapSaveFilter(dm.lpfs[i])
+
+        ## Number of band passed samples (for the HWP angles), and
+        ## intensity samples waiting for the polarisation ones.
+        self.nbpf = 0
+        self.pending = None
+
+    def rotate(self, v):
+        """
+        Multiply band passed samples by 2 * exp(i * mode * HWP angles).
+        """
+        nv = v.shape[-1]
+        e = self.dm.get_phasor(self.mode, self.nbpf, self.nbpf + nv)
+        self.nbpf += nv
+        return 2. * e * v
+
+    def align(self, b0, bm):
+        """
+        Return intensity and polarisation for the samples available for
+        both (intensity is less delayed than polarisation).
+        """
+        if self.pending is None:
+            self.pending = b0
+        else:
+            self.pending = np.concatenate((self.pending, b0), axis=-1)
+
+        nout = bm.shape[-1]
+        b0 = self.pending[..., :nout]
+        self.pending = self.pending[..., nout:]
+        return b0, bm
+
+    def push_components(self, x):
+        """
+        Demodulate a new block of timestreams, and return separately the
+        intensity (real) and polarisation (complex) samples available so
+        far, each of size (ndet, nout).
+        """
+        b0 = self.lpf0.push(x)
+        bm = self.lpf.push(self.rotate(self.bpf.push(x)))
+        return self.align(b0, bm)
+
+    def flush_components(self):
+        """
+        Return the last intensity (real) and polarisation (complex)
+        samples, and reset the demodulation.
+        """
+        b0 = self.lpf0.flush()
+        u = self.rotate(self.bpf.flush())
+        bm = np.concatenate(
+            (self.lpf.push(u), self.lpf.flush()), axis=-1)
+        b0, bm = self.align(b0, bm)
+        self.nbpf = 0
+        self.pending = None
+        return b0, bm
+
+    def push(self, x):
+        """
+        Demodulate a new block of timestreams.
+
+        Parameters
+        ----------
+        x : ndarray
+            Next time samples of the timestreams, of size (ndet, nblock).
+
+        Returns
+        ----------
+        newts : ndarray
+            Demodulated samples available so far, of size (ndet, 3, nout).
+        """
+        return stack_demodulated(*self.push_components(x))
+
+    def flush(self):
+        """
+        Return the last demodulated samples, and reset the demodulation.
+        """
+        return stack_demodulated(*self.flush_components())
+
+
+def stack_demodulated(b0, bm):
+    """
+    Stack demodulated intensity b0 and polarisation bm (complex) into
+    an array of size (ndet, 3, nt), as returned by
+    TimeOrderedDataDemod.demodulate_timestreams.
+    """
+    newts = np.zeros(bm.shape[:-1] + (3, bm.shape[-1]), dtype=b0.dtype)
+    newts[..., 0, :] = b0
+    newts[..., 1, :] = bm.real
+    newts[..., 2, :] = bm.imag
+    return newts
+
+
+class FrequencyBand():
+    """ Class to describe a frequency band of multichroic detectors """
+    def __init__(self, I, Q=None, U=None, polangle=None, gain=None,
+                 noise_generator=None):
+        """
+        Input sky maps and detector properties of one frequency band,
+        to be scanned by TimeOrderedDataPairDiff.map2tod_bands.
+
+        Parameters
+        ----------
+        I : 1d array
+            Input intensity map (indexed as HealpixFitsMap.I).
+        Q : 1d array, optional
+            Input Stokes Q map.
+        U : 1d array, optional
+            Input Stokes U map.
+        polangle : 1d array, optional
+            Intrinsic polarisation angles of the bolometers [degree], as
+            focal_plane.bolo_polangle. Required if the input sky is
+            polarised.
+        gain : 1d array, optional
+            Gains of the detectors (see set_detector_gains). Default uses
+            the gains of the TOD.
+        noise_generator : WhiteNoiseGenerator instance, optional
+            Noise added to the timestreams. Default is no noise.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> band = FrequencyBand(sky_in.I, sky_in.Q, sky_in.U,
+        ...     polangle=inst.focal_plane.bolo_polangle)
+        """
+        self.I = I
+        self.Q = Q
+        self.U = U
+        self.polangle = polangle
+        self.gain = gain
+        self.noise_generator = noise_generator
+
+
+class WhiteNoiseGenerator():
+    """ Class to handle white noise """
+    def __init__(self, array_noise_level, ndetectors, ntimesamples,
+                 array_noise_seed, precision='double', rng='legacy',
+                 CESnumber=0, chunk_size=65536):
+        """
+        This class is used to simulate time-domain noise.
+        Usually, it is used in combination with map2tod to insert noise
         on-the-fly while scanning an input CMB map.
 
         Parameters
@@ -1487,9 +3131,36 @@ class WhiteNoiseGenerator():
         array_noise_seed : int
             Seed used to generate random numbers. From this single seed,
             we generate a list of seeds for all detectors.
+        precision : string, optional
+            Floating point precision of the noise timestreams: `double`
+            (float64) or `single` (float32). With the `legacy` generator,
+            random numbers are always drawn in double precision, so that
+            both give the same realisation.
+        rng : string, optional
+            Random number generator: `legacy` (one np.random.RandomState per
+            detector, the full timestream is always drawn) or `philox`
+            (counter-based generator keyed by the seed, the scan number,
+            the detector and the time chunk). With `philox`, any time chunk
+            can be generated independently, and the result does not depend on
+            how detectors and chunks are distributed among processes.
+            `philox` requires numpy >= 1.17. Default is `legacy`.
+        CESnumber : int, optional
+            Index of the scan. Used only to key the `philox` generator, so
+            that different scans get different noise. Default is 0.
+        chunk_size : int, optional
+            Number of time samples per chunk for the `philox` generator.
+            Realisations depend on it. Default is 65536.
 
         """
         self.array_noise_level = array_noise_level
+        self.precision = precision
+        self.dtype = get_float_dtype(self.precision)
+        self.rng = rng
+        assert self.rng in ['legacy', 'philox'], \
+            ValueError("Random number generator <{}> ".format(self.rng) +
+                       "not understood! Choose among ['legacy', 'philox'].")
+        self.CESnumber = CESnumber
+        self.chunk_size = int(chunk_size)
         self.ndetectors = ndetectors
         self.ntimesamples = ntimesamples
 
@@ -1501,7 +3172,41 @@ class WhiteNoiseGenerator():
         state = np.random.RandomState(self.array_noise_seed)
         self.noise_seeds = state.randint(0, 1e6, size=self.ndetectors)
 
-    def simulate_noise_one_detector(self, ch):
+    def philox_generator(self, stream, index, chunk=0):
+        """
+        Return a counter-based random number generator.
+        The key is (array_noise_seed, CESnumber), and the counter
+        starts at (0, stream, chunk, index), so that each triplet gets its own
+        sequence of random numbers (up to 2**64 draws).
+
+        Parameters
+        ----------
+        stream : int
+            Type of random numbers: 0 for white noise, 1 for amplitudes
+            and 2 for phases of the correlated noise.
+        index : int
+            Index of the detector (or of the cloud).
+        chunk : int, optional
+            Index of the time chunk.
+
+        Returns
+        ----------
+        generator : np.random.Generator instance
+
+        Examples
+        ----------
+        >>> wn = WhiteNoiseGenerator(3000., 2, 4, array_noise_seed=493875,
+        ...     rng='philox')
+        >>> g1 = wn.philox_generator(0, 1, chunk=3)
+        >>> g2 = wn.philox_generator(0, 1, chunk=3)
+        >>> assert g1.standard_normal() == g2.standard_normal()
+        """
+        key = np.array(
+            [self.array_noise_seed, self.CESnumber], dtype=np.uint64)
+        counter = np.array([0, stream, chunk, index], dtype=np.uint64)
+        return np.random.Generator(np.random.Philox(key=key, counter=counter))
+
+    def simulate_noise_one_detector(self, ch, start=0, stop=None):
         """
         Simulate white noise on-the-fly for one detector.
 
@@ -1509,11 +3214,15 @@ class WhiteNoiseGenerator():
         ----------
         ch : int
             Index of the detector in the array.
+        start : int, optional
+            First time sample to return. Default is 0.
+        stop : int, optional
+            Last time sample to return (excluded). Default is ntimesamples.
 
         Returns
         ----------
         vec : 1d array
-            Vector of noise of size ntimesamples.
+            Vector of noise of size stop - start.
             The level of noise is given by detector_noise_level in uK.sqrt(s).
 
         Examples
@@ -1522,17 +3231,51 @@ class WhiteNoiseGenerator():
         >>> ts = wn.simulate_noise_one_detector(0)
         >>> print(ts) #doctest: +NORMALIZE_WHITESPACE
         [ -2185.65609023   5137.21044598  -5407.22292574  11020.59471471]
-        """
-        state = np.random.RandomState(self.noise_seeds[ch])
-        vec = state.normal(size=self.ntimesamples)
 
-        return self.detector_noise_level * vec
+        >>> wn = WhiteNoiseGenerator(3000., 2, 4, array_noise_seed=493875,
+        ...     precision='single')
+        >>> print(wn.simulate_noise_one_detector(0).dtype)
+        float32
+
+        With the counter-based generator, time chunks can be
+        generated independently.
+        >>> wn = WhiteNoiseGenerator(3000., 2, 1000, array_noise_seed=493875,
+        ...     rng='philox', chunk_size=128)
+        >>> ts = wn.simulate_noise_one_detector(1)
+        >>> ts_part = wn.simulate_noise_one_detector(1, start=100, stop=300)
+        >>> assert np.all(ts[100:300] == ts_part)
+        """
+        if stop is None:
+            stop = self.ntimesamples
+
+        if self.rng == 'legacy':
+            state = np.random.RandomState(self.noise_seeds[ch])
+            vec = state.normal(size=self.ntimesamples)[start:stop]
+            return (self.detector_noise_level * vec).astype(
+                self.dtype, copy=False)
+
+        ## Generate only the chunks overlapping [start, stop[
+        vec = np.empty(stop - start, dtype=self.dtype)
+        first_chunk = start // self.chunk_size
+        last_chunk = (stop - 1) // self.chunk_size
+        for chunk in range(first_chunk, last_chunk + 1):
+            beg = chunk * self.chunk_size
+            end = min(beg + self.chunk_size, self.ntimesamples)
+            generator = self.philox_generator(0, ch, chunk)
+            draws = generator.standard_normal(end - beg, dtype=self.dtype)
+            lo = max(beg, start)
+            hi = min(end, stop)
+            vec[lo - start:hi - start] = draws[lo - beg:hi - beg]
+
+        vec *= self.detector_noise_level
+        return vec
 
 class CorrNoiseGenerator(WhiteNoiseGenerator):
     """ """
     def __init__(self, array_noise_level, ndetectors, ntimesamples,
                  array_noise_seed, nclouds=10, f0=0.1, alpha=-4, amp_atm=1e2,
-                 corrlength=300, sampling_freq=8):
+                 corrlength=300, sampling_freq=8, precision='double',
+                 rng='legacy', CESnumber=0, chunk_size=65536):
         """
         This class is used to simulate time-domain correlated noise.
         Usually, it is used in combination with map2tod to insert noise
@@ -1596,11 +3339,24 @@ class CorrNoiseGenerator(WhiteNoiseGenerator):
             Units are seconds.
         sampling_freq : float, optional
             Sampling frequency of the detectors in Hz.
+        precision : string, optional
+            Floating point precision of the noise timestreams: `double`
+            (float64) or `single` (float32).
+        rng : string, optional
+            Random number generator: `legacy` or `philox`.
+            See WhiteNoiseGenerator. With `philox`, the phases of the
+            correlated part are drawn per correlation length.
+        CESnumber : int, optional
+            Index of the scan (key for the `philox` generator).
+        chunk_size : int, optional
+            Number of time samples per chunk for the white noise part
+            (`philox` only).
 
         """
         WhiteNoiseGenerator.__init__(
             self, array_noise_level, ndetectors,
-            ntimesamples, array_noise_seed)
+            ntimesamples, array_noise_seed, precision=precision,
+            rng=rng, CESnumber=CESnumber, chunk_size=chunk_size)
         self.nclouds = nclouds
         self.alpha = alpha
         self.sampling_freq = sampling_freq
@@ -1611,7 +3367,104 @@ class CorrNoiseGenerator(WhiteNoiseGenerator):
         ## Bolometers in a pair get the same seed for correlated noise
         self.pixel_noise_seeds = np.repeat(self.noise_seeds[::2], 2)
 
-    def simulate_noise_one_detector(self, ch):
+        ## Correlated timestreams of the clouds, computed once per cloud.
+        self.cloud_timestreams = {}
+
+    def psd_atm(self, step):
+        """
+        PSD of the atmosphere over a period of step samples.
+
+        Parameters
+        ----------
+        step : int
+            Number of time samples.
+
+        Returns
+        ----------
+        psd : 1d array
+            The PSD, set to zero at zero frequency.
+        """
+        ## Get the PSD and the frequency range
+        fs = fftfreq(step, 1. / self.sampling_freq)
+        psd = np.zeros_like(fs)
+
+        ## Avoid zero frequency
+        psd[1:] = self.amp_atm * (1 + (fs[1:]/self.f0)**self.alpha)
+        return psd
+
+    def get_cloud_timestream(self, cloud):
+        """
+        Return the correlated timestream (unit amplitude) seen by all the
+        detectors of a cloud. It is computed only once per cloud, and
+        kept in memory. The PSD is computed once for all the correlation
+        periods of the same length, and the FFTs of all the periods are done
+        at once.
+
+        Parameters
+        ----------
+        cloud : int
+            Index of the cloud.
+
+        Returns
+        ----------
+        ts_corr : 1d array
+            Correlated timestream of size ntimesamples,
+            not normalised by the sampling frequency.
+
+        Examples
+        ----------
+        >>> cn = CorrNoiseGenerator(3000., 4, 1000,
+        ...     array_noise_seed=493875, nclouds=2, f0=0.5, amp_atm=1.,
+        ...     corrlength=30, alpha=-4, sampling_freq=8.)
+        >>> ts = cn.get_cloud_timestream(1)
+        >>> assert ts is cn.get_cloud_timestream(1)
+
+        Same as computing periods one-by-one
+        >>> state = np.random.RandomState(cn.array_noise_seed + 1)
+        >>> phases = 2 * np.pi * state.rand(cn.ntimesamples)
+        >>> ts2 = np.concatenate([corr_ts(cn.psd_atm(len(p)), len(p), 1., p)
+        ...     for p in np.split(phases, range(240, 1000, 240))])
+        >>> assert np.allclose(ts, ts2)
+        """
+        if cloud in self.cloud_timestreams:
+            return self.cloud_timestreams[cloud]
+
+        if self.rng == 'legacy':
+            state = np.random.RandomState(self.array_noise_seed + cloud)
+            phases = 2 * np.pi * state.rand(self.ntimesamples)
+        else:
+            phases = np.empty(self.ntimesamples)
+            for i in range(0, self.ntimesamples, self.corrlength):
+                step = min(self.corrlength, self.ntimesamples - i)
+                phases[i: i+step] = 2 * np.pi * self.philox_generator(
+                    2, cloud, i // self.corrlength).random(step)
+
+        ts_corr = np.zeros(self.ntimesamples)
+
+        ## All the complete periods at once
+        nfull = self.ntimesamples // self.corrlength
+        nsamp = nfull * self.corrlength
+        if nfull > 0:
+            ts_corr[:nsamp] = corr_ts(
+                PSD=self.psd_atm(self.corrlength),
+                N=self.corrlength,
+                amp=1.,
+                phase=phases[:nsamp].reshape((nfull, self.corrlength))
+            ).flatten()
+
+        ## Last (incomplete) period
+        if nsamp < self.ntimesamples:
+            step = self.ntimesamples - nsamp
+            ts_corr[nsamp:] = corr_ts(
+                PSD=self.psd_atm(step),
+                N=step,
+                amp=1.,
+                phase=phases[nsamp:])
+
+        self.cloud_timestreams[cloud] = ts_corr
+        return ts_corr
+
+    def simulate_noise_one_detector(self, ch, start=0, stop=None):
         """
         Simulate correlated noise on-the-fly for one detector.
 
@@ -1619,11 +3472,15 @@ class CorrNoiseGenerator(WhiteNoiseGenerator):
         ----------
         ch : int
             Index of the detector in the array.
+        start : int, optional
+            First time sample to return. Default is 0.
+        stop : int, optional
+            Last time sample to return (excluded). Default is ntimesamples.
 
         Returns
         ----------
         vec : 1d array
-            Vector of noise of size ntimesamples.
+            Vector of noise of size stop - start.
             The level of noise is given by detector_noise_level in uK.sqrt(s).
 
         Examples
@@ -1635,207 +3492,1093 @@ class CorrNoiseGenerator(WhiteNoiseGenerator):
         >>> print(ts) #doctest: +NORMALIZE_WHITESPACE
         [ -7536.5882971    -224.58319073 -10795.19644268 ...,
           -5528.66256308  -3161.93996673  -5174.84161989]
+
+        With the counter-based generator, time chunks can be
+        generated independently.
+        >>> cn = CorrNoiseGenerator(3000., 2, 17000,
+        ...     array_noise_seed=493875, nclouds=1, f0=0.5, amp_atm=1.,
+        ...     corrlength=300, alpha=-4, sampling_freq=8., rng='philox')
+        >>> ts = cn.simulate_noise_one_detector(0)
+        >>> ts_part = cn.simulate_noise_one_detector(0, start=5000, stop=9000)
+        >>> assert np.all(ts[5000:9000] == ts_part)
         """
-        ## White noise part
-        state = np.random.RandomState(self.noise_seeds[ch])
-        vec = state.normal(size=self.ntimesamples)
-        wnoise = self.detector_noise_level * vec
+        if stop is None:
+            stop = self.ntimesamples
 
-        ## Correlated part
-        state = np.random.RandomState(self.pixel_noise_seeds[ch])
-        # amps = 2 * (-0.5 + state.uniform(size=1))
-        amps = state.uniform(size=1)
+        ## White noise part
+        wnoise = WhiteNoiseGenerator.simulate_noise_one_detector(
+            self, ch, start=start, stop=stop)
+
+        ## Correlated part: the timestream of the cloud, scaled
+        ## by the amplitude of the detector.
+        if self.rng == 'legacy':
+            state = np.random.RandomState(self.pixel_noise_seeds[ch])
+            # amps = 2 * (-0.5 + state.uniform(size=1))
+            amps = state.uniform(size=1)
+        else:
+            ## Bolometers in a pair get the same amplitude
+            amps = self.philox_generator(1, ch // 2).uniform(size=1)
 
         corrdet = int(self.ndetectors / self.nclouds)
-        state = np.random.RandomState(
-            self.array_noise_seed + ch // corrdet)
-        phases = 2 * np.pi * state.rand(self.ntimesamples)
+        ts_corr = amps * self.get_cloud_timestream(ch // corrdet)[start:stop]
 
-        ts_corr = np.zeros(self.ntimesamples)
-        for i in range(0, self.ntimesamples, self.corrlength):
-            ## Check that you have enough samples
-            if self.ntimesamples - i < self.corrlength:
-                step = self.ntimesamples - i
-            else:
-                step = self.corrlength
+        ## remove PSD normalisation and add white noise!
+        ts = ts_corr / np.sqrt(self.sampling_freq) + wnoise
+        return ts.astype(self.dtype, copy=False)
 
-            ## Get the PSD and the frequency range
-            fs = fftfreq(step, 1. / self.sampling_freq)
-            psd = np.zeros_like(fs)
 
-            ## Avoid zero frequency
-            psd[1:] = self.amp_atm * (1 + (fs[1:]/self.f0)**self.alpha)
+class OneOverFNoiseGenerator(WhiteNoiseGenerator):
+    """ Class to handle 1/f detector noise, streamed in blocks """
+    def __init__(self, array_noise_level, ndetectors, ntimesamples,
+                 array_noise_seed, fknee=0.1, alpha=-2., sampling_freq=8.,
+                 block_size=65536, filter_length=None, precision='double',
+                 CESnumber=0):
+        """
+        This class is used to simulate time-domain 1/f detector noise, with
+        a power spectrum density
 
-            ## Get the TOD from the PSD
-            ts_corr[i: i+step] = corr_ts(
-                PSD=psd,
-                N=step,
-                amp=amps,
-                phase=phases[i: i+step])
+        $$\begin{equation}
+        PSD = \sigma^2 \Big[ 1 + \Big( \dfrac{f}{f_{knee}} \Big)^{\alpha}
+        \Big].
+        \end{equation}$$
 
-        ## remove PSD normalisation and add white noise!
-        return ts_corr / np.sqrt(self.sampling_freq) + wnoise
+        White noise is drawn in blocks (counter-based generator, see
+        WhiteNoiseGenerator), and filtered by a FIR filter having the square
+        root of the PSD as frequency response. The convolution is done in
+        Fourier space using overlap-add, so that the noise is continuous
+        across blocks (no discontinuity as in CorrNoiseGenerator), and
+        the memory footprint is set by the block size, not by the length of
+        the scan. Below the frequency resolution of the filter
+        (sampling_freq / filter_length), the PSD is flat.
+
+        An instance can be used as the noise generator of
+        TimeOrderedDataPairDiff (attribute noise_generator).
+
+        Parameters
+        ----------
+        array_noise_level : float
+            White noise level for the whole array in [u]K.sqrt(s).
+            WARNING: units has to be same as the input map!
+        ndetectors : int
+            Total number of detectors in the focal plane.
+        ntimesamples : int
+            Number of time samples per timestream (length of the observation).
+        array_noise_seed : int
+            Seed used to generate random numbers.
+        fknee : float, optional
+            Knee frequency in Hz.
+        alpha : float, optional
+            Value of the 1/f slope (negative).
+        sampling_freq : float, optional
+            Sampling frequency of the detectors in Hz.
+        block_size : int, optional
+            Number of white noise samples processed at once.
+            Realisations depend on it. Default is 65536.
+        filter_length : int, optional
+            Number of taps of the filter. Default is the power of two just
+            above 32 * sampling_freq / fknee.
+        precision : string, optional
+            Floating point precision of the noise timestreams: `double`
+            (float64) or `single` (float32).
+        CESnumber : int, optional
+            Index of the scan (key for the counter-based generator).
+
+        """
+        WhiteNoiseGenerator.__init__(
+            self, array_noise_level, ndetectors,
+            ntimesamples, array_noise_seed, precision=precision,
+            rng='philox', CESnumber=CESnumber, chunk_size=block_size)
+        self.fknee = fknee
+        self.alpha = alpha
+        self.sampling_freq = sampling_freq
+        self.block_size = int(block_size)
+
+        if filter_length is None:
+            filter_length = 2**int(
+                np.ceil(np.log2(32. * self.sampling_freq / self.fknee)))
+        self.filter_length = int(filter_length)
+
+        ## Filter is built once, and stored in Fourier space
+        self.nfft = self.block_size + self.filter_length - 1
+        self.filter_fft = rfft(self.get_filter(), self.nfft)
+
+    def get_filter(self):
+        """
+        Return the FIR filter (impulse response) whose frequency
+        response is sqrt(1 + (f/fknee)**alpha).
+
+        Returns
+        ----------
+        h : 1d array
+            Impulse response of size filter_length.
+
+        Examples
+        ----------
+        >>> gen = OneOverFNoiseGenerator(3000., 2, 1000, 493875,
+        ...     fknee=0.5, sampling_freq=8.)
+        >>> h = gen.get_filter()
+        >>> print(len(h))
+        512
+        """
+        fs = rfftfreq(self.filter_length, 1. / self.sampling_freq)
+
+        ## Flat below the frequency resolution
+        fs[0] = fs[1]
+        amp = np.sqrt(1. + (fs / self.fknee)**self.alpha)
+
+        ## Linear phase, and window to limit ripples
+        h = np.roll(irfft(amp, self.filter_length), self.filter_length // 2)
+        return h * np.hanning(self.filter_length)
+
+    def iter_noise_one_detector(self, ch, start=0, stop=None):
+        """
+        Stream 1/f noise for one detector, block-by-block.
+
+        Parameters
+        ----------
+        ch : int
+            Index of the detector in the array.
+        start : int, optional
+            First time sample to return. Default is 0.
+        stop : int, optional
+            Last time sample to return (excluded). Default is ntimesamples.
+
+        Returns
+        ----------
+        vec : generator of 1d arrays
+            Consecutive pieces of the timestream (at most block_size
+            samples each). Their concatenation is the noise from
+            start to stop.
+
+        Examples
+        ----------
+        >>> gen = OneOverFNoiseGenerator(3000., 2, 1000, 493875,
+        ...     fknee=0.5, sampling_freq=8., block_size=256)
+        >>> blocks = list(gen.iter_noise_one_detector(0))
+        >>> print(max([len(block) for block in blocks]))
+        256
+        >>> ts = np.concatenate(blocks)
+        >>> print(len(ts))
+        1000
+
+        Any part of the timestream can be generated independently
+        >>> ts_part = np.concatenate(
+        ...     list(gen.iter_noise_one_detector(0, start=300, stop=700)))
+        >>> assert np.allclose(ts[300:700], ts_part)
+        """
+        if stop is None:
+            stop = self.ntimesamples
+        ntaps = self.filter_length
+
+        ## Output sample n uses the white noise from n to n + ntaps - 1.
+        nwhite = stop + ntaps - 1
+        first_block = start // self.block_size
+        last_block = (nwhite - 1) // self.block_size
+
+        carry = np.zeros(ntaps - 1)
+        for block in range(first_block, last_block + 1):
+            white = self.philox_generator(0, ch, block).standard_normal(
+                self.block_size)
+            conv = irfft(rfft(white, self.nfft) * self.filter_fft, self.nfft)
+
+            ## overlap-add
+            conv[:ntaps - 1] += carry
+            carry = conv[self.block_size:].copy()
+
+            ## Complete output samples [beg, beg + block_size[
+            beg = block * self.block_size - (ntaps - 1)
+            lo = max(beg, start)
+            hi = min(beg + self.block_size, stop)
+            if hi > lo:
+                vec = self.detector_noise_level * conv[lo - beg:hi - beg]
+                yield vec.astype(self.dtype, copy=False)
+
+    def simulate_noise_one_detector(self, ch, start=0, stop=None):
+        """
+        Simulate 1/f noise for one detector.
+
+        Parameters
+        ----------
+        ch : int
+            Index of the detector in the array.
+        start : int, optional
+            First time sample to return. Default is 0.
+        stop : int, optional
+            Last time sample to return (excluded). Default is ntimesamples.
+
+        Returns
+        ----------
+        vec : 1d array
+            Vector of noise of size stop - start.
+
+        Examples
+        ----------
+        >>> gen = OneOverFNoiseGenerator(3000., 2, 1000, 493875,
+        ...     fknee=0.5, sampling_freq=8., block_size=256)
+        >>> ts = gen.simulate_noise_one_detector(1)
+        >>> print(ts.shape)
+        (1000,)
+        """
+        if stop is None:
+            stop = self.ntimesamples
+        vec = np.empty(stop - start, dtype=self.dtype)
+        pos = 0
+        for block in self.iter_noise_one_detector(ch, start, stop):
+            vec[pos:pos + len(block)] = block
+            pos += len(block)
+        return vec
+
+
+def corr_ts(PSD, N, amp, phase):
+    """
+    Generate a timestream based on its Power Spectrum Density.
+
+    Parameters
+    ----------
+    PSD : 1d array
+        Power Spectrum Density.
+    N : int
+        Length of the output timestream.
+    amp : float
+        Scaling factor (between 0 and 1).
+    phase : 1d or 2d array
+        Phase for the IFFT. Must have the same length as the PSD.
+        If 2d, one timestream per row is generated (all with the same PSD).
+
+    Returns
+    ----------
+    ts : 1d or 2d array
+        Timestream based the PSD. Length N, and units sqrt(PSD).
+        WARNING: if your PSD is in uk^2.s, you need to normalise
+        your timestream by the sampling rate of the detectors:
+        ts <- ts/sqrt(sampling_freq).
+
+    Examples
+    ----------
+    Assuming sampling at 2 Hz.
+    >>> sampling = 2.
+    >>> state = np.random.RandomState(0)
+    >>> PSD = state.rand(10)
+    >>> phase = 2 * np.pi * state.rand(10)
+    >>> ts = corr_ts(PSD, N=10, amp=1., phase=phase)
+    >>> print(ts / np.sqrt(sampling)) #doctest: +NORMALIZE_WHITESPACE
+    [ 1.49579944 -2.75993169  0.19454693  0.96278942  0.20053976
+      -0.49232085 0.07355544  0.68893301  0.46171998 -0.82563144]
+    """
+    Nf = len(PSD)
+    PSD[0] = 0.
+
+    A = amp * N * np.sqrt(PSD)
+
+    FFT = A * np.exp(1j*phase[..., :Nf])
+
+    ts = np.fft.ifft(FFT, n=N, axis=-1)
+
+    return np.real(ts)
+
+def psdts(ts, sample_rate, NFFT=4096):
+    '''
+    Compute the power spectrum (or power spectral density) of a timestream ts.
+
+    Parameters
+    ----------
+    ts : 1d array
+        Detector timestream.
+    sample_rate : float
+        Sample rate of the detector in Hz.
+    NFFT : int, optional
+        The number of points.
+
+    Returns
+    ----------
+    fs : 1d array
+        Frequency bin centers in Hz.
+    psd : 1d array
+        Power spectral density of the timestream.
+
+    Examples
+    ----------
+    >>> state = np.random.RandomState(0)
+    >>> ts = state.rand(100)
+    >>> fs, psd = psdts(ts, sample_rate=1)
+    >>> print(round(fs[-1], 2), round(psd[-1], 2))
+    0.49 0.5
+    '''
+    ## Remove the mean
+    ts -= np.mean(ts)
+
+    fs, asd = compute_asd(ts, sample_rate=sample_rate, NFFT=NFFT)
+    psd = asd**2
+
+    return fs, psd
+
+def compute_asd(x, sample_rate, NFFT=2048, is_complex=False):
+    """
+    Compute the amplitude spectral density (PSD = ASD**2).
+
+    Parameters
+    ----------
+    x : 1d array
+        Quantity for which you want the ASD.
+        Typically a detector timestream. Mean of x should have been removed
+        prior to passing x.
+    sample_rate : float
+        Sample rate of x in Hz.
+    NFFT : int, optional
+        The number of points.
+    is_complex : bool, optional
+
+    Returns
+    ----------
+    fs : 1d array
+        Frequency bin centers in Hz.
+    asd : 1d array
+        Amplitude spectral density of x.
+    """
+    ## Sanity check in the case of no chunking
+    maxnfft = x.shape[0] - (x.shape[0] % 2)
+    if(NFFT > maxnfft or NFFT < 0):
+        NFFT = maxnfft
+
+    period = 1.0 / sample_rate
+
+    window = np.blackman(NFFT)
+    window_norm = 1.0 / np.average(window**2)
+
+    n = len(x)
+    ## Truncates and rounds down
+    nchunks = int((2 * n) / NFFT)
+    if is_complex:
+        PSD = np.zeros(NFFT)
+    else:
+        PSD = np.zeros(int(NFFT/2))
+
+    for i in range(0, nchunks-1):
+        chunk = window * x[i * int(NFFT / 2): (i + 2) * int(NFFT / 2)]
+
+        fch = fft(chunk)
+        if not is_complex:
+            fch = fch[0: int(NFFT / 2)]
+
+        cf = fch * np.conj(fch)
+
+        if not is_complex:
+            cf[1: (int(NFFT / 2) - 1)] *= 2
+            cf = cf.real
+        PSD += cf
+
+    fs = fftfreq(NFFT, period)
+    if not is_complex:
+        fs = fs[0: int(NFFT/2)]
+
+    if nchunks != 1:
+        PSD /= (nchunks-1)
+
+    # Numpy normalizes inverse transform
+    PSD /= NFFT
+
+    # Power per root Hz
+    PSD *= 1.0 / sample_rate
+
+    # Remove power reduction from window
+    PSD *= window_norm
+
+    if is_complex:
+        fs = fftshift(fs)
+        PSD = fftshift(PSD)
+
+    # Convert to amplitude/rtHz
+    return fs, PSD**0.5
+
+def get_unflagged_masks(npair, nt):
+    """
+    Return masks of ones (no sample flagged) of size (npair, nt), as a
+    read-only view of a buffer shared between calls (reallocated only if
+    too small).
+
+    Parameters
+    ----------
+    npair : int
+        Number of pairs.
+    nt : int
+        Number of time samples.
+
+    Returns
+    ----------
+    masks : 2d array of uint8
+        Masks of ones.
+
+    Examples
+    ----------
+    >>> m1 = get_unflagged_masks(2, 100)
+    >>> m2 = get_unflagged_masks(1, 50)
+    >>> print(m2.shape, np.shares_memory(m1, m2), m2.all())
+    (1, 50) True True
+    """
+    ones = UNFLAGGED_MASKS.get('ones')
+    if ones is None or ones.size < npair * nt:
+        ones = np.ones(npair * nt, dtype=np.uint8)
+        ones.flags.writeable = False
+        UNFLAGGED_MASKS['ones'] = ones
+    return ones[: npair * nt].reshape((npair, nt))
+
+
+def bin_timestreams(waferts, output_maps, point_matrix, pol_angs,
+                    diff_weight, sum_weight, wafermask_pixel, npixsky,
+                    dtype=np.float64, demodulation=False,
+                    gdeprojection=False, nthreads=1, tiled=None):
+    """
+    Call the fortran kernel projecting timestreams of pairs of
+    detectors into sky maps (see TimeOrderedDataPairDiff.tod2map).
+
+    Parameters
+    ----------
+    waferts : ndarray
+        Array of timestreams. Size (2 * npair, ntimesamples).
+    output_maps : OutputSkyMap instance
+        Sky maps updated on-the-fly.
+    point_matrix : ndarray of int
+        Pixel indices of the top bolometers. Size (npair, ntimesamples).
+    pol_angs : ndarray
+        Polarisation angles of the top bolometers.
+        Size (npair, ntimesamples).
+    diff_weight : 1d array
+        Weights for the difference timestreams. Size npair.
+    sum_weight : 1d array
+        Weights for the sum timestreams. Size npair.
+    wafermask_pixel : ndarray of uint8 or None
+        Masks (0 to discard a sample). Size (npair, ntimesamples).
+        If None, all samples are valid: the pairs are then projected by
+        blocks, with masks of ones for one block only (at most
+        MAX_MASK_BYTES, or nthreads pairs).
+    npixsky : int
+        Number of pixels of the output sky maps.
+    dtype : numpy dtype, optional
+        Precision of the timestreams and angles (np.float64 or
+        np.float32). Default is np.float64.
+    demodulation : bool, optional
+        If True, timestreams are demodulated (I, Q, U) timestreams of
+        TimeOrderedDataDemod. Default is False (pair difference).
+    gdeprojection : bool, optional
+        If True, perform a deprojection of a constant contribution in the
+        polarisation timestream.
+    nthreads : int, optional
+        Number of (OpenMP) threads. Default is 1.
+    tiled : bool, optional
+        Tiled (pixel ranges) or partial maps threading. See tod2map.
+    """
+    npixfp = point_matrix.shape[0]
+    nt = int(waferts.shape[-1])
+
+    ## No flags: masks of ones allocated for one block of pairs only.
+    if wafermask_pixel is None:
+        nblock = max(nthreads, MAX_MASK_BYTES // max(nt, 1))
+        nblock = max(1, min(nblock, npixfp))
+        ones = get_unflagged_masks(nblock, nt)
+        for beg in range(0, npixfp, nblock):
+            sl = slice(beg, min(beg + nblock, npixfp))
+            bin_timestreams(
+                waferts[2 * sl.start: 2 * sl.stop], output_maps,
+                point_matrix[sl], pol_angs[sl],
+                diff_weight[sl], sum_weight[sl],
+                ones[: sl.stop - sl.start], npixsky, dtype=dtype,
+                demodulation=demodulation, gdeprojection=gdeprojection,
+                nthreads=nthreads, tiled=tiled)
+        return
+
+    ## Timestreams and angles in single precision use the
+    ## single precision kernels (map accumulators are in double).
+    if dtype == np.float32:
+        ftype = np.float32
+        suffix = '_sp'
+    else:
+        ftype = np.float64
+        suffix = ''
+
+    ## Buffers are already in the type expected by the kernels:
+    ## ravel returns views (no copy) for contiguous arrays.
+    point_matrix = point_matrix.ravel()
+    pol_angs = pol_angs.astype(ftype, copy=False).ravel()
+    waferts = waferts.astype(ftype, copy=False).ravel()
+    diff_weight = diff_weight.ravel()
+    sum_weight = sum_weight.ravel()
+    ## Flags are passed as signed bytes (view, no copy)
+    wafermask_pixel = np.asarray(
+        wafermask_pixel, dtype=np.uint8).ravel().view(np.int8)
+
+    if (demodulation and (gdeprojection is False)):
+        kernel = 'tod2map_hwp_f'
+        maps = ['d0', 'd4r', 'd4i', 'w0', 'w4', 'nhit']
+        args = {'weight4': diff_weight, 'weight0': sum_weight}
+    elif (demodulation and gdeprojection):
+        kernel = 'tod2map_pair_gdeprojection_f'
+        maps = ['d', 'w', 'dm', 'dc', 'ds', 'wm', 'cc', 'cs', 'ss',
+                'c', 's', 'nhit']
+        args = {'diff_weight': diff_weight, 'sum_weight': sum_weight}
+    else:
+        kernel = 'tod2map_pair_f'
+        maps = ['d', 'w', 'dc', 'ds', 'cc', 'cs', 'ss', 'nhit']
+        args = {'diff_weight': diff_weight, 'sum_weight': sum_weight}
+
+    ## Names of the maps in the kernels
+    fnames = {'c': 'cv', 's': 'sv'}
+    for name in maps:
+        args[fnames.get(name, name)] = getattr(output_maps, name)
+
+    args.update({
+        'waferi1d': point_matrix, 'waferpa': pol_angs, 'waferts': waferts,
+        'npix': int(npixfp), 'nt': nt,
+        'wafermask_pixel': wafermask_pixel, 'nskypix': npixsky})
+
+    if nthreads > 1:
+        ## Private partial maps per thread, unless they would take
+        ## more memory than the timestreams themselves.
+        if tiled is None:
+            tiled = nthreads * npixsky * len(maps) * 8 > waferts.nbytes
+        args.update({'nthreads': nthreads, 'tiled': int(tiled)})
+        kernel += '_omp'
+
+    getattr(tod_f, kernel + suffix)(**args)
+    # Garbage collector guard
+    wafermask_pixel
+
+
+class PointingOperator():
+    """ Class to store the pointing of a CES, and apply it to sky maps """
+    def __init__(self, index_global, index_local, pa, ang_pix, hwpangle,
+                 diff_weight, sum_weight, wafermask_pixel, npixsky,
+                 sign=1., demodulation=False):
+        """
+        Pointing of all the detectors of the focal plane for one CES:
+        pixel indices (input and output maps), parallactic angles,
+        intrinsic polarisation angles and HWP angles.
+        The pointing does not change between sky or noise realisations,
+        so it can be computed once (see
+        TimeOrderedDataPairDiff.get_pointing_operator), saved on disk,
+        and reused (see load_pointing_operator) in Monte Carlo loops.
+
+        Detectors of a pair usually share the same beam offsets: in this
+        case, pixel indices and parallactic angles are stored once per pair.
+
+        Parameters
+        ----------
+        index_global : ndarray of int32
+            Pixel indices in the input sky maps.
+            Size (npair or 2 * npair, ntimesamples).
+        index_local : ndarray of int32
+            Pixel indices in the output sky maps (top bolometers only).
+            Size (npair, ntimesamples).
+        pa : ndarray
+            Parallactic angles [radian]. Same size as index_global.
+        ang_pix : 1d array
+            Intrinsic polarisation angles [radian]. Size 2 * npair.
+        hwpangle : 1d array
+            HWP angles [radian]. Size ntimesamples.
+        diff_weight : 1d array
+            Weights for the difference timestreams. Size npair.
+        sum_weight : 1d array
+            Weights for the sum timestreams. Size npair.
+        wafermask_pixel : ndarray of uint8
+            Masks (0 to discard a sample). Size (npair, ntimesamples).
+        npixsky : int
+            Number of pixels of the output sky maps.
+        sign : float, optional
+            Sign of U (-1 for flat projection). Default is 1.
+        demodulation : bool, optional
+            If True, use the angle convention of TimeOrderedDataDemod.
+            Default is False (pair difference).
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> P = tod.get_pointing_operator()
+        >>> print(P.npair, P.nt, P.index_global.shape)
+        4 139992 (4, 139992)
+        """
+        self.index_global = index_global
+        self.index_local = index_local
+        self.pa = pa
+        self.ang_pix = ang_pix
+        self.hwpangle = hwpangle
+        self.diff_weight = diff_weight
+        self.sum_weight = sum_weight
+        self.wafermask_pixel = wafermask_pixel
+        self.npixsky = int(npixsky)
+        self.sign = float(sign)
+        self.demodulation = bool(demodulation)
+
+        self.npair, self.nt = self.index_local.shape
+        self.dtype = self.pa.dtype
+
+        ## One row of pointing per pair, or one per detector.
+        self.pair_pointing = self.index_global.shape[0] == self.npair
+
+        ## Demodulation or pair diff use different convention
+        ## for the definition of the angle.
+        if self.demodulation:
+            self.angle_sign = -1.
+        else:
+            self.angle_sign = 1.
+
+    def get_pol_angle(self, ch):
+        """
+        Return the polarisation angles of detector ch (as in
+        TimeOrderedDataPairDiff.compute_simpolangle).
+
+        Parameters
+        ----------
+        ch : int
+            Channel index in the focal plane.
+
+        Returns
+        ----------
+        pol_ang : 1d array
+            Polarisation angles for the whole scan [radian].
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> P = tod.get_pointing_operator()
+        >>> pa = tod.compute_pointing(0)[2]
+        >>> pol_ang = tod.compute_simpolangle(0, pa)[0]
+        >>> assert np.allclose(P.get_pol_angle(0), pol_ang)
+        """
+        row = ch // 2 if self.pair_pointing else ch
+        return self.pa[row] + self.angle_sign * (
+            self.ang_pix[ch] + 2.0 * self.hwpangle)
+
+    def apply(self, I, Q=None, U=None):
+        """
+        Scan sky maps to generate the timestreams of all the detectors
+        (no noise, unit gains). The maps must be indexed as the input sky
+        maps used to build the operator (e.g. restricted to the patch if
+        restrict_input_sky was used).
+
+        Parameters
+        ----------
+        I : 1d array
+            Intensity map.
+        Q : 1d array, optional
+            Stokes Q map. If Q and U are None, only the intensity is scanned.
+        U : 1d array, optional
+            Stokes U map.
+
+        Returns
+        ----------
+        waferts : ndarray
+            Timestreams. Size (2 * npair, ntimesamples).
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> P = tod.get_pointing_operator()
+        >>> d = P.apply(sky_in.I, sky_in.Q, sky_in.U)
+        >>> assert np.allclose(d[1], tod.map2tod(1))
+        """
+        waferts = np.zeros((2 * self.npair, self.nt), dtype=self.dtype)
+        for ch in range(2 * self.npair):
+            row = ch // 2 if self.pair_pointing else ch
+            index_global = self.index_global[row]
+            waferts[ch] = I[index_global]
+            if Q is not None and U is not None:
+                pol_ang = self.get_pol_angle(ch)
+                waferts[ch] += Q[index_global] * np.cos(2 * pol_ang) + \
+                    self.sign * U[index_global] * np.sin(2 * pol_ang)
+
+        return waferts
+
+    def transpose_apply(self, waferts, output_maps, gdeprojection=False,
+                        nthreads=1, tiled=None):
+        """
+        Project timestreams into sky maps (maps are updated on-the-fly),
+        as TimeOrderedDataPairDiff.tod2map does.
+
+        Parameters
+        ----------
+        waferts : ndarray
+            Array of timestreams (demodulated if demodulation is True).
+            Size (2 * npair, ...).
+        output_maps : OutputSkyMap instance
+            Instance of OutputSkyMap which contains the sky maps.
+        gdeprojection : bool, optional
+            If True, perform a deprojection of a constant contribution in the
+            polarisation timestream.
+        nthreads : int, optional
+            Number of (OpenMP) threads. Default is 1.
+        tiled : bool, optional
+            Tiled (pixel ranges) or partial maps threading. See tod2map.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> P = tod.get_pointing_operator()
+        >>> d = P.apply(sky_in.I, sky_in.Q, sky_in.U)
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> P.transpose_apply(d, m)
+
+        Same maps as with map2tod and tod2map
+        >>> d = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
+        >>> m1 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(d, m1)
+        >>> assert np.allclose(m.d, m1.d) and np.all(m.nhit == m1.nhit)
+        """
+        assert waferts.shape[0] == 2 * self.npair, \
+            ValueError("Timestreams must be given for all the detectors.")
+
+        ## Angles of the top bolometers, HWP included for pair difference
+        ## only (convention).
+        if self.pair_pointing:
+            pol_angs = self.pa + self.angle_sign * self.ang_pix[::2, None]
+        else:
+            pol_angs = self.pa[::2] + self.angle_sign * \
+                self.ang_pix[::2, None]
+        if not self.demodulation:
+            pol_angs += 2.0 * self.hwpangle
+
+        bin_timestreams(
+            waferts, output_maps, self.index_local,
+            pol_angs.astype(self.dtype, copy=False),
+            self.diff_weight, self.sum_weight, self.wafermask_pixel,
+            npixsky=self.npixsky, dtype=self.dtype,
+            demodulation=self.demodulation,
+            gdeprojection=gdeprojection, nthreads=nthreads, tiled=tiled)
+
+    def get_observation_matrix(self, npix_in, output_maps=None):
+        """
+        Accumulate, in one pass over the timestreams, the response of the
+        map-making (tod2map + OutputSkyMap.get_IQU) to each pixel of the
+        input sky maps. Pair difference only: for demodulation, the
+        filters mix time samples.
+
+        Parameters
+        ----------
+        npix_in : int
+            Number of pixels of the input sky maps.
+        output_maps : OutputSkyMap instance, optional
+            If provided, the weights (w, cc, cs, ss, nhit) are accumulated
+            in it.
+
+        Returns
+        ----------
+        R : ObservationMatrix instance
+            Sparse observation matrix.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> P = tod.get_pointing_operator()
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> R = P.get_observation_matrix(len(sky_in.I), output_maps=m)
+        >>> print(m.nhit.sum() > 0)
+        True
+        """
+        assert not self.demodulation, \
+            ValueError("Observation matrix is only available for " +
+                       "pair difference.")
+
+        npixsky = self.npixsky
+        w = np.zeros(npixsky)
+        cc = np.zeros(npixsky)
+        cs = np.zeros(npixsky)
+        ss = np.zeros(npixsky)
+        nhit = np.zeros(npixsky, dtype=np.int32)
+
+        ## Projected sum and difference (d, dc, ds) as a function
+        ## of the input (I, Q, U): non-zero entries gathered pair-by-pair,
+        ## and the matrix built once at the end.
+        shape = (3 * npixsky, 3 * npix_in)
+        entries = []
+        for pair in range(self.npair):
+            ## Same selection as in the fortran kernels.
+            mask = (self.wafermask_pixel[pair] > 0) * \
+                (self.index_local[pair] > 0)
+            pixel = self.index_local[pair][mask]
+            pol_ang = self.get_pol_angle(2 * pair)[mask]
+            c = np.cos(2 * pol_ang)
+            s = np.sin(2 * pol_ang)
+
+            sw = self.sum_weight[pair]
+            dw = self.diff_weight[pair]
+            nhit += np.bincount(pixel, minlength=npixsky).astype(np.int32)
+            w += sw * np.bincount(pixel, minlength=npixsky)
+            cc += dw * np.bincount(pixel, weights=c * c, minlength=npixsky)
+            cs += dw * np.bincount(pixel, weights=c * s, minlength=npixsky)
+            ss += dw * np.bincount(pixel, weights=s * s, minlength=npixsky)
+
+            rows, cols, data = [], [], []
+            for ch, eps in zip([2 * pair, 2 * pair + 1], [1., -1.]):
+                row = ch // 2 if self.pair_pointing else ch
+                index_global = self.index_global[row][mask]
+                ang = self.get_pol_angle(ch)[mask]
+
+                ## Response of the detector to I, Q and U
+                response = [np.ones_like(ang), np.cos(2 * ang),
+                            self.sign * np.sin(2 * ang)]
+
+                ## Contribution to d, dc, ds
+                coefs = [0.5 * sw, 0.5 * eps * dw * c, 0.5 * eps * dw * s]
+
+                for i, coef in enumerate(coefs):
+                    for j, resp in enumerate(response):
+                        rows.append(i * npixsky + pixel)
+                        cols.append(j * npix_in + index_global)
+                        data.append(coef * resp)
+
+            ## Samples hitting the same pixels summed within the pair
+            ## (much fewer entries than samples).
+            Dpair = sparse.coo_matrix(
+                (np.concatenate(data),
+                 (np.concatenate(rows), np.concatenate(cols))),
+                shape=shape)
+            Dpair.sum_duplicates()
+            entries.append((Dpair.data, Dpair.row, Dpair.col))
+
+        ## Duplicates across pairs summed in a single pass
+        if entries:
+            data, rows, cols = [np.concatenate(e) for e in zip(*entries)]
+        else:
+            data, rows, cols = np.zeros(0), np.zeros(0, int), np.zeros(0, int)
+        D = sparse.coo_matrix((data, (rows, cols)), shape=shape).tocsr()
+
+        if output_maps is not None:
+            output_maps.w += w
+            output_maps.cc += cc
+            output_maps.cs += cs
+            output_maps.ss += ss
+            output_maps.nhit += nhit
+
+        ## Solve for I, Q, U in each pixel (as OutputSkyMap.get_IQU)
+        iw = np.zeros(npixsky)
+        iw[w > 0] = 1. / w[w > 0]
+
+        det = cc * ss - cs * cs
+        idet = np.zeros(npixsky)
+        idet[det != 0.] = 1. / det[det != 0.]
+        idet[np.abs(det) < np.finfo(np.float32).eps] = 0.0
+
+        S = sparse.bmat([
+            [sparse.diags(iw), None, None],
+            [None, sparse.diags(idet * ss), sparse.diags(-idet * cs)],
+            [None, sparse.diags(-idet * cs), sparse.diags(idet * cc)]])
+
+        matrix = S.tocsr().dot(D)
+        matrix.eliminate_zeros()
 
+        return ObservationMatrix(matrix, npixsky, npix_in)
 
-def corr_ts(PSD, N, amp, phase):
-    """
-    Generate a timestream based on its Power Spectrum Density.
+    def save(self, dirname):
+        """
+        Save the operator on disk, one .npy file per array (so that they
+        can be memory-mapped by load_pointing_operator).
 
-    Parameters
-    ----------
-    PSD : 1d array
-        Power Spectrum Density.
-    N : int
-        Length of the output timestream.
-    amp : float
-        Scaling factor (between 0 and 1).
-    phase : 1d array
-        Phase for the IFFT. Must have the same length as the PSD.
+        Parameters
+        ----------
+        dirname : string
+            Name of the output folder (created if needed).
 
-    Returns
-    ----------
-    ts : 1d array
-        Timestream based the PSD. Length N, and units sqrt(PSD).
-        WARNING: if your PSD is in uk^2.s, you need to normalise
-        your timestream by the sampling rate of the detectors:
-        ts <- ts/sqrt(sampling_freq).
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> P = tod.get_pointing_operator()
+        >>> P.save('pointing_to_test')
+        >>> P2 = load_pointing_operator('pointing_to_test')
+        >>> assert np.all(P2.index_local == P.index_local)
+        >>> print(type(P2.pa).__name__)
+        memmap
+        >>> import shutil
+        >>> shutil.rmtree('pointing_to_test')
+        """
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
 
-    Examples
-    ----------
-    Assuming sampling at 2 Hz.
-    >>> sampling = 2.
-    >>> state = np.random.RandomState(0)
-    >>> PSD = state.rand(10)
-    >>> phase = 2 * np.pi * state.rand(10)
-    >>> ts = corr_ts(PSD, N=10, amp=1., phase=phase)
-    >>> print(ts / np.sqrt(sampling)) #doctest: +NORMALIZE_WHITESPACE
-    [ 1.49579944 -2.75993169  0.19454693  0.96278942  0.20053976
-      -0.49232085 0.07355544  0.68893301  0.46171998 -0.82563144]
-    """
-    Nf = len(PSD)
-    PSD[0] = 0.
+        for name in POINTING_OPERATOR_ARRAYS:
+            np.save(os.path.join(dirname, name + '.npy'), getattr(self, name))
 
-    A = amp * N * np.sqrt(PSD)
+        attributes = {
+            'npixsky': self.npixsky,
+            'sign': self.sign,
+            'demodulation': self.demodulation}
+        with open(os.path.join(dirname, 'attributes.pkl'), 'wb') as f:
+            pickle.dump(attributes, f, protocol=2)
 
-    FFT = A * np.exp(1j*phase[: Nf])
 
-    ts = np.fft.ifft(FFT, n=N)
+## Arrays of the PointingOperator saved on disk
+POINTING_OPERATOR_ARRAYS = [
+    'index_global', 'index_local', 'pa', 'ang_pix', 'hwpangle',
+    'diff_weight', 'sum_weight', 'wafermask_pixel']
 
-    return np.real(ts)
 
-def psdts(ts, sample_rate, NFFT=4096):
-    '''
-    Compute the power spectrum (or power spectral density) of a timestream ts.
+def load_pointing_operator(dirname, mmap_mode='r'):
+    """
+    Load a PointingOperator saved with PointingOperator.save.
 
     Parameters
     ----------
-    ts : 1d array
-        Detector timestream.
-    sample_rate : float
-        Sample rate of the detector in Hz.
-    NFFT : int, optional
-        The number of points.
+    dirname : string
+        Folder containing the operator.
+    mmap_mode : string, optional
+        Memory-map mode for the arrays (see numpy.load). Default is 'r'
+        (read-only, the data is read from disk when needed). Use None to
+        load everything in memory.
 
     Returns
     ----------
-    fs : 1d array
-        Frequency bin centers in Hz.
-    psd : 1d array
-        Power spectral density of the timestream.
+    P : PointingOperator instance
+        The pointing operator.
 
     Examples
     ----------
-    >>> state = np.random.RandomState(0)
-    >>> ts = state.rand(100)
-    >>> fs, psd = psdts(ts, sample_rate=1)
-    >>> print(round(fs[-1], 2), round(psd[-1], 2))
-    0.49 0.5
-    '''
-    ## Remove the mean
-    ts -= np.mean(ts)
-
-    fs, asd = compute_asd(ts, sample_rate=sample_rate, NFFT=NFFT)
-    psd = asd**2
+    See PointingOperator.save.
+    """
+    arrays = {
+        name: np.load(os.path.join(dirname, name + '.npy'),
+                      mmap_mode=mmap_mode)
+        for name in POINTING_OPERATOR_ARRAYS}
 
-    return fs, psd
+    with open(os.path.join(dirname, 'attributes.pkl'), 'rb') as f:
+        attributes = pickle.load(f)
 
-def compute_asd(x, sample_rate, NFFT=2048, is_complex=False):
-    """
-    Compute the amplitude spectral density (PSD = ASD**2).
+    arrays.update(attributes)
+    return PointingOperator(**arrays)
 
-    Parameters
-    ----------
-    x : 1d array
-        Quantity for which you want the ASD.
-        Typically a detector timestream. Mean of x should have been removed
-        prior to passing x.
-    sample_rate : float
-        Sample rate of x in Hz.
-    NFFT : int, optional
-        The number of points.
-    is_complex : bool, optional
+class ObservationMatrix():
+    """ Class to handle the linear response of the map-making to the sky """
+    def __init__(self, matrix, npixsky, npix_in):
+        """
+        Sparse observation matrix R, which gives the output sky maps
+        (I, Q, U on the observed pixels) as a linear function of the input
+        sky maps: [I, Q, U]_out = R . [I, Q, U]_in.
+        Once computed (see PointingOperator.get_observation_matrix), new
+        sky realisations are processed with a sparse matrix-vector product
+        instead of a full TOD simulation.
 
-    Returns
-    ----------
-    fs : 1d array
-        Frequency bin centers in Hz.
-    asd : 1d array
-        Amplitude spectral density of x.
-    """
-    ## Sanity check in the case of no chunking
-    maxnfft = x.shape[0] - (x.shape[0] % 2)
-    if(NFFT > maxnfft or NFFT < 0):
-        NFFT = maxnfft
+        Parameters
+        ----------
+        matrix : scipy.sparse matrix
+            Observation matrix of size (3 * npixsky, 3 * npix_in).
+        npixsky : int
+            Number of pixels of the output sky maps.
+        npix_in : int
+            Number of pixels of the input sky maps.
 
-    period = 1.0 / sample_rate
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> P = tod.get_pointing_operator()
+        >>> R = P.get_observation_matrix(len(sky_in.I))
+        >>> print(R.matrix.shape == (3 * tod.npixsky, 3 * len(sky_in.I)))
+        True
+        """
+        self.matrix = sparse.csr_matrix(matrix)
+        self.npixsky = int(npixsky)
+        self.npix_in = int(npix_in)
 
-    window = np.blackman(NFFT)
-    window_norm = 1.0 / np.average(window**2)
+    def apply(self, I, Q, U):
+        """
+        Return the output sky maps for the input sky maps I, Q, U (indexed
+        as the input sky maps used to build the pointing).
 
-    n = len(x)
-    ## Truncates and rounds down
-    nchunks = int((2 * n) / NFFT)
-    if is_complex:
-        PSD = np.zeros(NFFT)
-    else:
-        PSD = np.zeros(int(NFFT/2))
+        Parameters
+        ----------
+        I : ndarray
+            Input intensity map. Can be 2D (nrealisations, npix_in) to
+            process several realisations at once.
+        Q : ndarray
+            Input Stokes Q map (same shape as I).
+        U : ndarray
+            Input Stokes U map (same shape as I).
 
-    for i in range(0, nchunks-1):
-        chunk = window * x[i * int(NFFT / 2): (i + 2) * int(NFFT / 2)]
+        Returns
+        ----------
+        I, Q, U : ndarray
+            Output sky maps on the observed pixels (as
+            OutputSkyMap.get_IQU). Size npixsky or (nrealisations, npixsky).
 
-        fch = fft(chunk)
-        if not is_complex:
-            fch = fch[0: int(NFFT / 2)]
+        Examples
+        ----------
+        The observation matrix reproduces map2tod -> tod2map -> get_IQU
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> P = tod.get_pointing_operator()
+        >>> R = P.get_observation_matrix(len(sky_in.I))
+        >>> I, Q, U = R.apply(sky_in.I, sky_in.Q, sky_in.U)
+        >>> d = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(d, m)
+        >>> I1, Q1, U1 = m.get_IQU()
+        >>> assert np.allclose(I, I1) and np.allclose(Q, Q1)
+        >>> assert np.allclose(U, U1)
+
+        Several realisations at once
+        >>> IQU = np.array([sky_in.I, sky_in.Q, sky_in.U])
+        >>> I, Q, U = R.apply(IQU, 2 * IQU, 3 * IQU)
+        >>> print(I.shape)
+        (3, 726)
+        """
+        x = np.concatenate([I, Q, U], axis=-1)
+        assert x.shape[-1] == 3 * self.npix_in, \
+            ValueError("Input maps must have {} pixels.".format(self.npix_in))
 
-        cf = fch * np.conj(fch)
+        y = self.matrix.dot(x.T).T
+        return (y[..., :self.npixsky],
+                y[..., self.npixsky: 2 * self.npixsky],
+                y[..., 2 * self.npixsky:])
 
-        if not is_complex:
-            cf[1: (int(NFFT / 2) - 1)] *= 2
-            cf = cf.real
-        PSD += cf
+    def save(self, fn):
+        """
+        Save the observation matrix on disk (compressed sparse format).
 
-    fs = fftfreq(NFFT, period)
-    if not is_complex:
-        fs = fs[0: int(NFFT/2)]
+        Parameters
+        ----------
+        fn : string
+            Name of the output file (.npz).
 
-    if nchunks != 1:
-        PSD /= (nchunks-1)
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> R = tod.get_pointing_operator().get_observation_matrix(
+        ...     len(sky_in.I))
+        >>> R.save('obsmat_to_test.npz')
+        >>> R2 = load_observation_matrix('obsmat_to_test.npz')
+        >>> assert (R2.matrix != R.matrix).nnz == 0
+        >>> os.remove('obsmat_to_test.npz')
+        """
+        sparse.save_npz(fn, self.matrix, compressed=True)
 
-    # Numpy normalizes inverse transform
-    PSD /= NFFT
 
-    # Power per root Hz
-    PSD *= 1.0 / sample_rate
+def load_observation_matrix(fn):
+    """
+    Load an ObservationMatrix saved with ObservationMatrix.save.
 
-    # Remove power reduction from window
-    PSD *= window_norm
+    Parameters
+    ----------
+    fn : string
+        Name of the file (.npz).
 
-    if is_complex:
-        fs = fftshift(fs)
-        PSD = fftshift(PSD)
+    Returns
+    ----------
+    R : ObservationMatrix instance
+        The observation matrix.
 
-    # Convert to amplitude/rtHz
-    return fs, PSD**0.5
+    Examples
+    ----------
+    See ObservationMatrix.save.
+    """
+    matrix = sparse.load_npz(fn)
+    return ObservationMatrix(
+        matrix, matrix.shape[0] // 3, matrix.shape[1] // 3)
 
 class OutputSkyMap():
     """ Class to handle sky maps generated by tod2map """
@@ -1893,6 +4636,10 @@ class OutputSkyMap():
 
         self.initialise_sky_maps()
 
+        ## Range of pixels held, if the maps are distributed across
+        ## processors (see distribute_MPI).
+        self.pixel_range = None
+
         if not self.demodulation:
             self.to_coadd = 'd dc ds w cc cs ss nhit'
         else:
@@ -2066,6 +4813,112 @@ class OutputSkyMap():
         Q, U = self.get_QU()
         return I, Q, U
 
+    def add_white_noise(self, detector_noise_level, sum_weight=1.,
+                        diff_weight=1., seed=None):
+        """
+        Add a white noise realisation to the projected maps (d, dc, ds or
+        d0, d4r, d4i), drawn directly from the accumulated weights
+        (w, cc, cs, ss or w0, w4). This is statistically identical to
+        adding white noise to the timestreams (map2tod) before the
+        projection (tod2map), but costs O(npixsky) instead of
+        O(ndetectors * ntimesamples).
+
+        The noise in the two detectors of a pair is independent, with
+        the same level, and the gains are 1. The weights must be the same
+        for all the pairs (default weights of the TOD classes).
+
+        Parameters
+        ----------
+        detector_noise_level : float
+            Noise level per time sample of one detector
+            (WhiteNoiseGenerator.detector_noise_level). For demodulated
+            data, noise level per time sample of the demodulated
+            timestreams (correlations between time samples introduced by
+            the demodulation filters are neglected).
+        sum_weight : float, optional
+            Weight of the sum timestreams (weight0 for demodulation) used
+            in tod2map. Default is 1.
+        diff_weight : float, optional
+            Weight of the difference timestreams (weight4 for demodulation)
+            used in tod2map. Default is 1.
+        seed : int, optional
+            Seed for the random numbers.
+
+        Examples
+        ----------
+        The noise has the same statistics as the one from the timestreams
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     array_noise_level=10., array_noise_seed=487587)
+        >>> sigma = tod.noise_generator.detector_noise_level
+        >>> d = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(d, m)
+
+        Same without noise, and add noise in the map domain
+        >>> tod.noise_generator = None
+        >>> d = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
+        >>> m2 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(d, m2)
+        >>> d_signal, dc_signal = m2.d.copy(), m2.dc.copy()
+        >>> m2.add_white_noise(sigma, seed=9487)
+
+        Compare noise (whitened) in both cases
+        >>> hit = m2.w > 0
+        >>> r = np.std((m.d - d_signal)[hit] / np.sqrt(m.w[hit])) / (
+        ...     np.std((m2.d - d_signal)[hit] / np.sqrt(m2.w[hit])))
+        >>> assert abs(r - 1) < 0.15, r
+        >>> r = np.std((m.dc - dc_signal)[hit] / np.sqrt(m.cc[hit])) / (
+        ...     np.std((m2.dc - dc_signal)[hit] / np.sqrt(m2.cc[hit])))
+        >>> assert abs(r - 1) < 0.15, r
+
+        Demodulation
+        >>> m = OutputSkyMap(projection='healpix',
+        ...     nside=16, obspix=np.array([0, 1, 2, 3]), demodulation=True)
+        >>> m.w0 += 10.
+        >>> m.w4 += 10.
+        >>> m.add_white_noise(1., seed=9487)
+        >>> I, Q, U = m.get_IQU()
+        """
+        assert not isinstance(self, OutputSkyMapIGQU), \
+            ValueError("Noise realisations are not available with " +
+                       "deprojection.")
+        state = np.random.RandomState(seed)
+        var = detector_noise_level**2
+
+        if self.demodulation:
+            ## d0, d4r and d4i are independent
+            self.d0 += np.sqrt(sum_weight * self.w0 * var) * \
+                state.normal(size=self.npixsky)
+            for name in ['d4r', 'd4i']:
+                getattr(self, name)[:] += np.sqrt(
+                    diff_weight * self.w4 * var) * \
+                    state.normal(size=self.npixsky)
+            return
+
+        ## Sum and difference of a pair have variance var / 2,
+        ## and are independent.
+        self.d += np.sqrt(sum_weight * self.w * var / 2.) * \
+            state.normal(size=self.npixsky)
+
+        ## (dc, ds) has covariance diff_weight * var / 2 * [[cc cs][cs ss]]
+        ## (Cholesky decomposition in each pixel).
+        g1 = state.normal(size=self.npixsky)
+        g2 = state.normal(size=self.npixsky)
+        hit = self.cc > 0
+        l11 = np.zeros(self.npixsky)
+        l21 = np.zeros(self.npixsky)
+        l22 = np.zeros(self.npixsky)
+        l11[hit] = np.sqrt(self.cc[hit])
+        l21[hit] = self.cs[hit] / l11[hit]
+        l22[hit] = np.sqrt(np.maximum(self.ss[hit] - l21[hit]**2, 0.))
+
+        norm = np.sqrt(diff_weight * var / 2.)
+        self.dc += norm * l11 * g1
+        self.ds += norm * (l21 * g1 + l22 * g2)
+
     def coadd(self, other, to_coadd=None):
         """
         Add other\'s vectors into our vectors.
@@ -2130,9 +4983,12 @@ class OutputSkyMap():
             b = getattr(other, k)
             a += b
 
-    def coadd_MPI(self, other, MPI, to_coadd=None):
+    def coadd_MPI(self, other, MPI, to_coadd=None, root=None, comm=None):
         """
-        Crappy way of coadding vectors through different processors.
+        Coadd vectors through different processors.
+        All the vectors are packed into one contiguous buffer (float64,
+        hit counts are exactly represented), which is summed with one
+        buffer-based reduction (in place), and unpacked into self.
 
         Parameters
         ----------
@@ -2144,6 +5000,13 @@ class OutputSkyMap():
         to_coadd : string, optional
             String with names of vectors to coadd separated by a space.
             Names must be attributes of other and self.
+        root : int, optional
+            If None (default), all the processors receive the coadded vectors
+            (Allreduce). Otherwise, only the processor root does (Reduce),
+            e.g. the one writing the maps on disk, and the vectors of the
+            other processors are left unchanged.
+        comm : communicator, optional
+            Communicator. Default is MPI.COMM_WORLD.
 
         Examples
         ---------
@@ -2153,14 +5016,116 @@ class OutputSkyMap():
         ...     nside=16, obspix=np.array([0, 1, 2, 3]))
         >>> ## do whatever you want with the maps
         >>> m.coadd_MPI(m, MPI)
+
+        Only the processor 0 receives the coadded maps
+        >>> m.nhit[:] = 3
+        >>> m.coadd_MPI(m, MPI, root=0)
+        >>> if MPI.COMM_WORLD.rank == 0:
+        ...     print(m.nhit // MPI.COMM_WORLD.size)
+        [3 3 3 3]
         """
         if to_coadd is None:
             to_coadd = self.to_coadd
+        if comm is None:
+            comm = MPI.COMM_WORLD
 
+        ## Pack all vectors into one buffer
         to_coadd_split = to_coadd.split(' ')
-        for k in to_coadd_split:
-            setattr(self, k, MPI.COMM_WORLD.allreduce(
-                getattr(other, k), op=MPI.SUM))
+        vectors = [np.asarray(getattr(other, k)) for k in to_coadd_split]
+        offsets = np.cumsum([0] + [v.size for v in vectors])
+        buf = np.empty(offsets[-1], dtype=np.float64)
+        for v, beg, end in zip(vectors, offsets[:-1], offsets[1:]):
+            buf[beg: end] = v.ravel()
+
+        if root is None:
+            comm.Allreduce(MPI.IN_PLACE, buf, op=MPI.SUM)
+        elif comm.rank == root:
+            comm.Reduce(MPI.IN_PLACE, buf, op=MPI.SUM, root=root)
+        else:
+            comm.Reduce(buf, None, op=MPI.SUM, root=root)
+            return
+
+        ## Unpack (views of the buffer for float64 vectors)
+        for k, v, beg, end in zip(
+                to_coadd_split, vectors, offsets[:-1], offsets[1:]):
+            setattr(self, k, buf[beg: end].reshape(v.shape).astype(
+                v.dtype, copy=False))
+
+    def distribute_MPI(self, other, MPI, to_coadd=None, comm=None):
+        """
+        Coadd vectors through different processors, and distribute the
+        coadded maps: the sky pixels are partitioned into contiguous ranges
+        of obspix (healpix) or of the flattened map (flat projection), of
+        about npixsky / nprocessors pixels each. The cuts are arbitrary:
+        they do not follow rings or rows. Each processor keeps only the
+        coadded vectors of its range (Reduce_scatter, vector-by-vector
+        directly from the accumulators: no packed copy of the maps).
+        Solving for I, Q, U (get_IQU, ...) and writing the maps (pickle_me)
+        then operate on the pixels of the processor only, and
+        pixel_range gives the indices of these pixels in the full map.
+
+        Parameters
+        ----------
+        other : OutputSkyMap instance
+            Instance of OutputSkyMap to be coadded (accumulated over
+            the full map).
+        MPI : module
+            Module for communication (mpi4py).
+        to_coadd : string, optional
+            String with names of vectors to coadd separated by a space.
+            Names must be attributes of other and self.
+        comm : communicator, optional
+            Communicator. Default is MPI.COMM_WORLD.
+
+        Examples
+        ---------
+        >>> from mpi4py import MPI
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> d = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(d, m)
+        >>> I, Q, U = m.get_IQU()
+        >>> m.distribute_MPI(m, MPI)
+        >>> beg, end = m.pixel_range
+        >>> assert np.allclose(m.get_IQU(), [I[beg: end], Q[beg: end],
+        ...     U[beg: end]])
+        >>> assert np.all(m.obspix == tod.obspix[beg: end])
+        """
+        assert self.pixel_range is None and other.pixel_range is None, \
+            ValueError("The maps are already distributed!")
+
+        if to_coadd is None:
+            to_coadd = self.to_coadd
+        if comm is None:
+            comm = MPI.COMM_WORLD
+
+        ## Contiguous ranges of pixels for all processors (even split of
+        ## the pixel indices, regardless of rings or rows)
+        npixsky = other.npixsky
+        bounds = npixsky * np.arange(comm.size + 1) // comm.size
+        counts = np.diff(bounds)
+        beg, end = bounds[comm.rank], bounds[comm.rank + 1]
+
+        for k in to_coadd.split(' '):
+            v = np.ascontiguousarray(getattr(other, k))
+            assert v.shape == (npixsky,), \
+                ValueError("Only vectors of size npixsky can be distributed")
+            local = np.empty(end - beg, dtype=v.dtype)
+            comm.Reduce_scatter(v, local, recvcounts=counts, op=MPI.SUM)
+            setattr(self, k, local)
+
+        self.pixel_range = (beg, end)
+        self.npixsky = end - beg
+        if other.obspix is not None:
+            self.obspix = other.obspix[beg: end]
+
+        ## Quantities cached from the full maps (see set_idet and
+        ## set_goodpix) are recomputed on the local pixels.
+        for name in ['idet', 'goodpix']:
+            if hasattr(self, name):
+                delattr(self, name)
 
     def pickle_me(self, fn, shrink_maps=True, crop_maps=False,
                   epsilon=0., verbose=False):
@@ -2181,6 +5146,10 @@ class OutputSkyMap():
             Threshold for selecting the pixels in polarisation.
             0 <= epsilon < 1/4. The higher the more selective.
 
+        For maps distributed across processors (see distribute_MPI), only
+        the pixels of the processor are saved (and pixel_range), without
+        shrinking or cropping.
+
         """
         if self.demodulation:
             self.pickle_me_demod(
@@ -2197,6 +5166,11 @@ class OutputSkyMap():
                     'nside': self.nside, 'pixel_size': self.pixel_size,
                     'obspix': self.obspix}
 
+            ## Distributed maps: only the pixels of this processor
+            if self.pixel_range is not None:
+                data['pixel_range'] = self.pixel_range
+                shrink_maps, crop_maps = False, False
+
             if shrink_maps and self.projection == 'flat':
                 data = shrink_me(data, based_on='wP')
             elif crop_maps is not False and self.projection == 'flat':
@@ -2320,6 +5294,11 @@ class OutputSkyMap():
                 'nside': self.nside, 'pixel_size': self.pixel_size,
                 'obspix': self.obspix}
 
+        ## Distributed maps: only the pixels of this processor
+        if self.pixel_range is not None:
+            data['pixel_range'] = self.pixel_range
+            shrink_maps, crop_maps = False, False
+
         if shrink_maps and self.projection == 'flat':
             data = shrink_me(data, based_on='wP')
         elif crop_maps is not False and self.projection == 'flat':
@@ -2718,6 +5697,7 @@ def build_pointing_matrix(ra, dec, nside_in, nside_out=None,
                           projection='healpix', obspix=None, ext_map_gal=False,
                           xmin=None, ymin=None,
                           pixel_size=None, npix_per_row=None,
+                          input_lookup=None, output_lookup=None,
                           cut_pixels_outside=True):
     """
     Given pointing coordinates (RA/Dec), retrieve the corresponding healpix
@@ -2765,6 +5745,18 @@ def build_pointing_matrix(ra, dec, nside_in, nside_out=None,
         In flat sky projection, it corresponds to the number of pixel per row.
         In other word, this is the square root of the total number of pixels
         in your square patch.
+    input_lookup : PixelLookupTable instance, optional
+        If the input maps are restricted to a sky patch (see
+        HealpixFitsMap.restrict_to_patch), the lookup table to convert
+        global indices of the input map into local indices. If provided,
+        index_global is returned local to the input patch (-1 for pixels
+        outside). Default is None.
+    output_lookup : PixelLookupTable instance, optional
+        Lookup table built from obspix, to convert global indices of the
+        output map into local indices (healpix projection). If provided,
+        it replaces the binary search in obspix. It can be built from
+        NESTED indices (nest=True), which avoids converting output pixels
+        to RING when nside_out differs from nside_in. Default is None.
     cut_pixels_outside : bool, optional
         If True assign -1 to pixels not in obspix. If False, the routine
         crashes if there are pixels outside. Default is True.
@@ -2772,7 +5764,8 @@ def build_pointing_matrix(ra, dec, nside_in, nside_out=None,
     Returns
     ----------
     index_global : float or 1d array
-        The input pixels seen labeled as if it was a full sky healpix map.
+        The input pixels seen labeled as if it was a full sky healpix map
+        (or relative to the input patch if input_lookup is provided).
         To be used for the projection map2tod.
     index_local : None or float or 1d array
         The indices of pixels relative to where they are in obspix. None if
@@ -2798,6 +5791,44 @@ def build_pointing_matrix(ra, dec, nside_in, nside_out=None,
     ...  nside_in=16, nside_out=8, obspix=np.array(range(12*16**2)))
     >>> print(index_global, index_local)
     [2592  420] [624 112]
+
+    Same with a lookup table for the output pixels
+    >>> lookup = input_sky.PixelLookupTable(np.array(range(12*8**2)))
+    >>> index_global, index_local = build_pointing_matrix(
+    ... np.array([0.0, 0.0]), np.array([-np.pi/4, np.pi/4]),
+    ...  nside_in=16, nside_out=8, obspix=np.array(range(12*8**2)),
+    ...  output_lookup=lookup)
+    >>> print(index_local)
+    [624 112]
+
+    And with a lookup table in NESTED (no conversion to RING)
+    >>> obspix = np.array(range(12*8**2))
+    >>> lookup = input_sky.PixelLookupTable(
+    ...     hp.ring2nest(8, obspix), nest=True)
+    >>> index_global, index_local = build_pointing_matrix(
+    ... np.array([0.0, 0.0]), np.array([-np.pi/4, np.pi/4]),
+    ...  nside_in=16, nside_out=8, obspix=obspix, output_lookup=lookup)
+    >>> print(index_local)
+    [624 112]
+
+    With input maps restricted to a patch
+    >>> lookup = input_sky.PixelLookupTable(np.array([420, 2592]))
+    >>> index_global, index_local = build_pointing_matrix(
+    ... np.array([0.0, 0.0]), np.array([-np.pi/4, np.pi/4]),
+    ...  nside_in=16, input_lookup=lookup)
+    >>> print(index_global)
+    [1 0]
+
+    Samples outside the input patch read the zero sentinel (-1),
+    with a warning
+    >>> lookup = input_sky.PixelLookupTable(np.array([420]))
+    >>> with warnings.catch_warnings(record=True) as w:
+    ...     warnings.simplefilter('always')
+    ...     index_global, index_local = build_pointing_matrix(
+    ...         np.array([0.0, 0.0]), np.array([-np.pi/4, np.pi/4]),
+    ...         nside_in=16, input_lookup=lookup)
+    >>> print(index_global, len(w))
+    [-1  0] 1
     """
     if nside_out is None:
         nside_out = nside_in
@@ -2807,15 +5838,52 @@ def build_pointing_matrix(ra, dec, nside_in, nside_out=None,
         r = hp.Rotator(coord=['C', 'G'])
         theta, phi = r(theta, phi)
 
-    index_global = hp.ang2pix(nside_in, theta, phi)
-
-    if projection == 'healpix' and obspix is not None:
-        index_global_out = hp.ang2pix(nside_out, theta, phi)
-        index_local = obspix.searchsorted(index_global_out)
-        mask1 = index_local < len(obspix)
-        loc = mask1
-        loc[mask1] = obspix[index_local[mask1]] == index_global_out[mask1]
-        outside_pixels = np.invert(loc)
+    ## Pixelise only once, at the finest resolution. If the output
+    ## resolution differs, the coarser indices are obtained in the
+    ## NESTED scheme by bit shifting (nsides are powers of 2).
+    do_output = projection == 'healpix' and obspix is not None
+    if do_output and nside_out != nside_in:
+        nside_fine = max(nside_in, nside_out)
+        ipix_fine = hp.ang2pix(nside_fine, theta, phi, nest=True)
+        ipix_in = ipix_fine >> nside_shift(nside_fine, nside_in)
+        ipix_out = ipix_fine >> nside_shift(nside_fine, nside_out)
+
+        ## RING is needed for the input maps, and for the output
+        ## if the lookup table is not in NESTED.
+        index_global = hp.nest2ring(nside_in, ipix_in)
+        if output_lookup is not None and output_lookup.nest:
+            index_global_out = ipix_out
+        else:
+            index_global_out = hp.nest2ring(nside_out, ipix_out)
+    else:
+        index_global = hp.ang2pix(nside_in, theta, phi)
+        index_global_out = index_global
+
+    ## Make the input indices local to the input patch.
+    if input_lookup is not None:
+        index_global = input_lookup.get_local(index_global)
+        outside_input = index_global == -1
+        if np.sum(outside_input) and (not cut_pixels_outside):
+            msg = "Pixels outside the input sky patch. " + \
+                "To avoid this, increase the margin when restricting " + \
+                "the input maps or set cut_pixels_outside to True."
+            raise ValueError(msg)
+        elif np.sum(outside_input):
+            msg = "Pixels outside the input sky patch. " + \
+                "They will be assigned a zero signal. To avoid this, " + \
+                "increase the margin when restricting the input maps."
+            warnings.warn(msg)
+
+    if do_output:
+        if output_lookup is not None:
+            index_local = output_lookup.get_local(index_global_out)
+            outside_pixels = index_local == -1
+        else:
+            index_local = obspix.searchsorted(index_global_out)
+            mask1 = index_local < len(obspix)
+            loc = mask1
+            loc[mask1] = obspix[index_local[mask1]] == index_global_out[mask1]
+            outside_pixels = np.invert(loc)
 
         ## Handling annoying cases.
         if (np.sum(outside_pixels) and (not cut_pixels_outside)):
@@ -2872,8 +5940,35 @@ def build_pointing_matrix(ra, dec, nside_in, nside_out=None,
 
     return index_global, index_local
 
+def nside_shift(nside_fine, nside_coarse):
+    """
+    Number of bits to shift a NESTED pixel index at nside_fine
+    to get the index of the pixel containing it at nside_coarse.
+
+    Parameters
+    ----------
+    nside_fine : int
+        Finest resolution (power of 2).
+    nside_coarse : int
+        Coarsest resolution (power of 2), smaller or equal to nside_fine.
+
+    Returns
+    ----------
+    shift : int
+        2 * log2(nside_fine / nside_coarse).
+
+    Examples
+    ----------
+    >>> ipix = hp.ang2pix(16, 0.3, 1.2, nest=True)
+    >>> ipix >> nside_shift(16, 4) == hp.ang2pix(4, 0.3, 1.2, nest=True)
+    True
+    """
+    assert nside_fine % nside_coarse == 0, \
+        ValueError("nside_coarse must divide nside_fine!")
+    return 2 * (int(nside_fine // nside_coarse).bit_length() - 1)
+
 def load_fake_instrument(nside=16, nsquid_per_mux=1, fwhm_in2=None,
-                         compute_derivatives=False):
+                         compute_derivatives=False, precision='double'):
     """
     For test purposes.
     Create instances of HealpixFitsMap, hardware, and
@@ -2902,7 +5997,8 @@ def load_fake_instrument(nside=16, nsquid_per_mux=1, fwhm_in2=None,
                             do_pol=True, fwhm_in=0.0, fwhm_in2=fwhm_in2,
                             nside_in=nside, map_seed=48584937,
                             compute_derivatives=compute_derivatives,
-                            verbose=False, no_ileak=False, no_quleak=False)
+                            verbose=False, no_ileak=False, no_quleak=False,
+                            precision=precision)
 
     ## Instrument
     inst = Hardware(ncrate=1, ndfmux_per_crate=1,
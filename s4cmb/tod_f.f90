@@ -2,6 +2,7 @@
 ! Ju@Sussex
 ! FORTRAN routines to compute low level products
 ! Main purposes is interfacing with python (using f2py)
+! Timestream flags (wafermask_pixel) are stored on 1 byte.
 !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 module tod_f
 
@@ -9,16 +10,20 @@ contains
 
     subroutine tod2map_pair_f(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, &
     waferpa, waferts, diff_weight, sum_weight, npix, nt, &
-    wafermask_pixel, nskypix)
+    wafermask_pixel, nskypix, pixmin, pixmax)
         implicit none
 
+        integer, parameter       :: I1B = 1
         integer, parameter       :: I4B = 4
         integer, parameter       :: DP = 8
         real(DP), parameter      :: pi = 3.141592
 
         integer(I4B), intent(in) :: npix, nt, nskypix
+        integer(I4B), intent(in) :: pixmin, pixmax
+        !f2py integer(4) optional, intent(in) :: pixmin = 0
+        !f2py integer(4) optional, intent(in) :: pixmax = nskypix
         integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
-        integer(I4B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
         real(DP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*2 - 1)
         real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
 
@@ -34,7 +39,8 @@ contains
         do j=0, npix - 1
             do i=0, nt - 1
                 ipix = i + j * nt
-                if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .gt. 0) then
+                if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .gt. 0 .and. &
+                    waferi1d(ipix) .ge. pixmin .and. waferi1d(ipix) .lt. pixmax) then
                     ict = i + 2*j*nt
                     icb = i + (2*j + 1)*nt
 
@@ -63,16 +69,20 @@ contains
     subroutine tod2map_pair_gdeprojection_f(d, w, dm, dc, ds, &
     wm, cc, cs, ss, cv, sv, nhit, waferi1d, &
     waferpa, waferts, diff_weight, sum_weight, npix, nt, &
-    wafermask_pixel, nskypix)
+    wafermask_pixel, nskypix, pixmin, pixmax)
         implicit none
 
+        integer, parameter       :: I1B = 1
         integer, parameter       :: I4B = 4
         integer, parameter       :: DP = 8
         real(DP), parameter      :: pi = 3.141592
 
         integer(I4B), intent(in) :: npix, nt, nskypix
+        integer(I4B), intent(in) :: pixmin, pixmax
+        !f2py integer(4) optional, intent(in) :: pixmin = 0
+        !f2py integer(4) optional, intent(in) :: pixmax = nskypix
         integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
-        integer(I4B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
         real(DP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*2 - 1)
         real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
 
@@ -90,7 +100,8 @@ contains
         do j=0, npix - 1
             do i=0, nt - 1
                 ipix = i + j * nt
-                if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .gt. 0) then
+                if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .gt. 0 .and. &
+                    waferi1d(ipix) .ge. pixmin .and. waferi1d(ipix) .lt. pixmax) then
                     ict = i + 2*j*nt
                     icb = i + (2*j + 1)*nt
 
@@ -123,15 +134,20 @@ contains
 
     subroutine tod2map_hwp_f(d0, d4r, d4i, w0, w4, nhit, waferi1d, &
     waferpa, waferts, weight4, weight0, npix, nt, &
-    wafermask_pixel, nskypix)
+    wafermask_pixel, nskypix, pixmin, pixmax)
         implicit none
 
+        integer, parameter       :: I1B = 1
         integer, parameter       :: I4B = 4
         integer, parameter       :: DP = 8
         real(DP), parameter      :: pi = 3.141592
 
         integer(I4B), intent(in) :: npix, nt, nskypix
-        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1), wafermask_pixel(0:npix*nt - 1)
+        integer(I4B), intent(in) :: pixmin, pixmax
+        !f2py integer(4) optional, intent(in) :: pixmin = 0
+        !f2py integer(4) optional, intent(in) :: pixmax = nskypix
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
         real(DP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*3*2 - 1)
         real(DP), intent(in)     :: weight0(0:npix - 1), weight4(0:npix - 1)
 
@@ -147,10 +163,256 @@ contains
         do j=0, npix - 1
             do i=0, nt - 1
                 ipix = i + j*nt
-                if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .gt. 0) then
-                    if0 = i + j*3*nt
-                    i4r = i + nt + j*3*nt
-                    i4i = i + nt*2 + j*3*nt
+                if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .gt. 0 .and. &
+                    waferi1d(ipix) .ge. pixmin .and. waferi1d(ipix) .lt. pixmax) then
+                    ! Demodulated timestreams of the top detector (2j)
+                    ! of the pair j.
+                    if0 = i + 2*j*3*nt
+                    i4r = i + nt + 2*j*3*nt
+                    i4i = i + nt*2 + 2*j*3*nt
+
+                    pixel = waferi1d(ipix)
+
+                    c = cos(2.0*waferpa(ipix))
+                    s = sin(2.0*waferpa(ipix))
+
+                    nhit(pixel) = nhit(pixel) + 1
+
+                    w0(pixel) = w0(pixel) + weight0(j)
+                    w4(pixel) = w4(pixel) + weight4(j)
+                    d0(pixel) = d0(pixel)+ waferts(if0) * weight0(j)
+                    d4r(pixel) = d4r(pixel) + (c*waferts(i4r)+s*waferts(i4i)) * weight4(j)
+                    d4i(pixel) = d4i(pixel) + (s*waferts(i4r)-c*waferts(i4i)) * weight4(j)
+                endif
+            enddo
+        enddo
+    end subroutine
+
+    subroutine tod2map_hwp_demod_f(d0, d4r, d4i, w0, w4, nhit, waferi1d, &
+    waferpa, b0, b4, weight4, weight0, npix, nt, &
+    wafermask_pixel, nskypix, pixmin, pixmax)
+        ! Same as tod2map_hwp_f, but reading directly the outputs of the
+        ! demodulation filters: low passed intensity b0 (real) and
+        ! filtered 4f component b4 (complex), one timestream per pair.
+        ! Used block-by-block with the streaming demodulation.
+        implicit none
+
+        integer, parameter       :: I1B = 1
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+
+        integer(I4B), intent(in) :: npix, nt, nskypix
+        integer(I4B), intent(in) :: pixmin, pixmax
+        !f2py integer(4) optional, intent(in) :: pixmin = 0
+        !f2py integer(4) optional, intent(in) :: pixmax = nskypix
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(DP), intent(in)     :: waferpa(0:npix*nt - 1), b0(0:npix*nt - 1)
+        complex(DP), intent(in)  :: b4(0:npix*nt - 1)
+        real(DP), intent(in)     :: weight0(0:npix - 1), weight4(0:npix - 1)
+
+        real(DP), intent(inout)  :: d0(0:nskypix - 1), d4r(0:nskypix - 1), d4i(0:nskypix - 1)
+        real(DP), intent(inout)  :: w0(0:nskypix - 1), w4(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: i, j, ipix
+        integer(I4B)             :: pixel
+        real(DP)                 :: c, s, b4r, b4i
+
+        do j=0, npix - 1
+            do i=0, nt - 1
+                ipix = i + j*nt
+                if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .gt. 0 .and. &
+                    waferi1d(ipix) .ge. pixmin .and. waferi1d(ipix) .lt. pixmax) then
+                    pixel = waferi1d(ipix)
+
+                    c = cos(2.0*waferpa(ipix))
+                    s = sin(2.0*waferpa(ipix))
+                    b4r = real(b4(ipix), DP)
+                    b4i = aimag(b4(ipix))
+
+                    nhit(pixel) = nhit(pixel) + 1
+
+                    w0(pixel) = w0(pixel) + weight0(j)
+                    w4(pixel) = w4(pixel) + weight4(j)
+                    d0(pixel) = d0(pixel)+ b0(ipix) * weight0(j)
+                    d4r(pixel) = d4r(pixel) + (c*b4r+s*b4i) * weight4(j)
+                    d4i(pixel) = d4i(pixel) + (s*b4r-c*b4i) * weight4(j)
+                endif
+            enddo
+        enddo
+    end subroutine
+
+    !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+    ! Single precision variants: angles and timestreams are real(4),
+    ! while the sky map accumulators are kept in real(8).
+    !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+
+    subroutine tod2map_pair_f_sp(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, &
+    waferpa, waferts, diff_weight, sum_weight, npix, nt, &
+    wafermask_pixel, nskypix, pixmin, pixmax)
+        implicit none
+
+        integer, parameter       :: I1B = 1
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+        real(DP), parameter      :: pi = 3.141592
+
+        integer(I4B), intent(in) :: npix, nt, nskypix
+        integer(I4B), intent(in) :: pixmin, pixmax
+        !f2py integer(4) optional, intent(in) :: pixmin = 0
+        !f2py integer(4) optional, intent(in) :: pixmax = nskypix
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(SP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*2 - 1)
+        real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
+
+        real(DP), intent(inout)  :: d(0:nskypix - 1), w(0:nskypix - 1), dc(0:nskypix - 1)
+        real(DP), intent(inout)  :: ds(0:nskypix - 1), cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: cs(0:nskypix - 1), ss(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: i, j, ipix, pixel
+        integer(I4B)             :: ict, icb
+        real(DP)                 :: sum, diff, c, s
+
+        do j=0, npix - 1
+            do i=0, nt - 1
+                ipix = i + j * nt
+                if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .gt. 0 .and. &
+                    waferi1d(ipix) .ge. pixmin .and. waferi1d(ipix) .lt. pixmax) then
+                    ict = i + 2*j*nt
+                    icb = i + (2*j + 1)*nt
+
+                    pixel = waferi1d(ipix)
+
+                    sum = 0.5*(waferts(ict) + waferts(icb))
+                    diff = 0.5*(waferts(ict) - waferts(icb))
+                    c = cos(2.0*waferpa(ipix))
+                    s = sin(2.0*waferpa(ipix))
+
+                    nhit(pixel) = nhit(pixel) + 1
+                    w(pixel) = w(pixel) + sum_weight(j)
+                    d(pixel) = d(pixel) + sum * sum_weight(j)
+
+                    dc(pixel) = dc(pixel) + c * diff * diff_weight(j)
+                    ds(pixel) = ds(pixel) + s * diff * diff_weight(j)
+                    cc(pixel) = cc(pixel) + c * c * diff_weight(j)
+                    cs(pixel) = cs(pixel) + c * s * diff_weight(j)
+                    ss(pixel) = ss(pixel) + s * s * diff_weight(j)
+                endif
+            enddo
+        enddo
+
+    end subroutine
+
+    subroutine tod2map_pair_gdeprojection_f_sp(d, w, dm, dc, ds, &
+    wm, cc, cs, ss, cv, sv, nhit, waferi1d, &
+    waferpa, waferts, diff_weight, sum_weight, npix, nt, &
+    wafermask_pixel, nskypix, pixmin, pixmax)
+        implicit none
+
+        integer, parameter       :: I1B = 1
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+        real(DP), parameter      :: pi = 3.141592
+
+        integer(I4B), intent(in) :: npix, nt, nskypix
+        integer(I4B), intent(in) :: pixmin, pixmax
+        !f2py integer(4) optional, intent(in) :: pixmin = 0
+        !f2py integer(4) optional, intent(in) :: pixmax = nskypix
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(SP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*2 - 1)
+        real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
+
+        real(DP), intent(inout)  :: d(0:nskypix - 1), w(0:nskypix - 1), dc(0:nskypix - 1)
+        real(DP), intent(inout)  :: dm(0:nskypix - 1), wm(0:nskypix - 1)
+        real(DP), intent(inout)  :: ds(0:nskypix - 1), cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: cs(0:nskypix - 1), ss(0:nskypix - 1)
+        real(DP), intent(inout)  :: cv(0:nskypix - 1), sv(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: i, j, ipix, pixel
+        integer(I4B)             :: ict, icb
+        real(DP)                 :: sum, diff, c, s
+
+        do j=0, npix - 1
+            do i=0, nt - 1
+                ipix = i + j * nt
+                if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .gt. 0 .and. &
+                    waferi1d(ipix) .ge. pixmin .and. waferi1d(ipix) .lt. pixmax) then
+                    ict = i + 2*j*nt
+                    icb = i + (2*j + 1)*nt
+
+                    pixel = waferi1d(ipix)
+
+                    sum = 0.5*(waferts(ict) + waferts(icb))
+                    diff = 0.5*(waferts(ict) - waferts(icb))
+                    c = cos(2.0*waferpa(ipix))
+                    s = sin(2.0*waferpa(ipix))
+
+                    nhit(pixel) = nhit(pixel) + 1
+                    w(pixel) = w(pixel) + sum_weight(j)
+                    wm(pixel) = wm(pixel) + diff_weight(j)
+
+                    d(pixel) = d(pixel) + sum * sum_weight(j)
+                    dm(pixel) = dm(pixel) + diff * diff_weight(j)
+
+                    dc(pixel) = dc(pixel) + c * diff * diff_weight(j)
+                    ds(pixel) = ds(pixel) + s * diff * diff_weight(j)
+                    cc(pixel) = cc(pixel) + c * c * diff_weight(j)
+                    cs(pixel) = cs(pixel) + c * s * diff_weight(j)
+                    ss(pixel) = ss(pixel) + s * s * diff_weight(j)
+                    cv(pixel) = cv(pixel) + c * diff_weight(j)
+                    sv(pixel) = sv(pixel) + s * diff_weight(j)
+                endif
+            enddo
+        enddo
+
+    end subroutine
+
+    subroutine tod2map_hwp_f_sp(d0, d4r, d4i, w0, w4, nhit, waferi1d, &
+    waferpa, waferts, weight4, weight0, npix, nt, &
+    wafermask_pixel, nskypix, pixmin, pixmax)
+        implicit none
+
+        integer, parameter       :: I1B = 1
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+        real(DP), parameter      :: pi = 3.141592
+
+        integer(I4B), intent(in) :: npix, nt, nskypix
+        integer(I4B), intent(in) :: pixmin, pixmax
+        !f2py integer(4) optional, intent(in) :: pixmin = 0
+        !f2py integer(4) optional, intent(in) :: pixmax = nskypix
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(SP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*3*2 - 1)
+        real(DP), intent(in)     :: weight0(0:npix - 1), weight4(0:npix - 1)
+
+        real(DP), intent(inout)  :: d0(0:nskypix - 1), d4r(0:nskypix - 1), d4i(0:nskypix - 1)
+        real(DP), intent(inout)  :: w0(0:nskypix - 1), w4(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: i, j, ipix
+        integer(I4B)             :: pixel
+        integer(I4B)             :: if0, i4r, i4i
+        real(DP)                 :: c, s
+
+        do j=0, npix - 1
+            do i=0, nt - 1
+                ipix = i + j*nt
+                if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .gt. 0 .and. &
+                    waferi1d(ipix) .ge. pixmin .and. waferi1d(ipix) .lt. pixmax) then
+                    ! Demodulated timestreams of the top detector (2j)
+                    ! of the pair j.
+                    if0 = i + 2*j*3*nt
+                    i4r = i + nt + 2*j*3*nt
+                    i4i = i + nt*2 + 2*j*3*nt
 
                     pixel = waferi1d(ipix)
 
@@ -169,4 +431,642 @@ contains
         enddo
     end subroutine
 
+    !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+    ! Threaded (OpenMP) drivers of the routines above.
+    !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+
+    subroutine tod2map_pair_f_omp(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, &
+    waferpa, waferts, diff_weight, sum_weight, npix, nt, &
+    wafermask_pixel, nskypix, nthreads, tiled)
+        ! Threaded version of tod2map_pair_f (OpenMP).
+        ! If tiled = 0, each thread bins a slice of detectors into its own
+        ! partial maps, which are then summed in a fixed order
+        ! (deterministic for a given number of threads).
+        ! If tiled > 0, each thread owns a range of sky pixels and scans
+        ! all the samples (no extra memory, for huge patches).
+        implicit none
+
+        integer, parameter       :: I1B = 1
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nthreads, tiled
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(DP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*2 - 1)
+        real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
+
+        real(DP), intent(inout)  :: d(0:nskypix - 1)
+        real(DP), intent(inout)  :: w(0:nskypix - 1)
+        real(DP), intent(inout)  :: dc(0:nskypix - 1)
+        real(DP), intent(inout)  :: ds(0:nskypix - 1)
+        real(DP), intent(inout)  :: cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: cs(0:nskypix - 1)
+        real(DP), intent(inout)  :: ss(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        real(DP), allocatable    :: pd(:, :)
+        real(DP), allocatable    :: pw(:, :)
+        real(DP), allocatable    :: pdc(:, :)
+        real(DP), allocatable    :: pds(:, :)
+        real(DP), allocatable    :: pcc(:, :)
+        real(DP), allocatable    :: pcs(:, :)
+        real(DP), allocatable    :: pss(:, :)
+        integer(I4B), allocatable :: pnhit(:, :)
+        integer(I4B)             :: t, j0, j1, p0, p1, pixel
+
+        if (tiled .gt. 0) then
+            !$omp parallel do schedule(static, 1) private(p0, p1) num_threads(nthreads)
+            do t=0, nthreads - 1
+                p0 = int(int(t, 8) * nskypix / nthreads, I4B)
+                p1 = int(int(t + 1, 8) * nskypix / nthreads, I4B)
+                call tod2map_pair_f(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, waferpa, &
+                waferts, diff_weight, sum_weight, npix, nt, wafermask_pixel, nskypix, &
+                p0, p1)
+            enddo
+            !$omp end parallel do
+        else
+            allocate(pd(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pw(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pdc(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pds(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pcc(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pcs(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pss(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pnhit(0:nskypix - 1, 0:nthreads - 1))
+            pd = 0.0_DP
+            pw = 0.0_DP
+            pdc = 0.0_DP
+            pds = 0.0_DP
+            pcc = 0.0_DP
+            pcs = 0.0_DP
+            pss = 0.0_DP
+            pnhit = 0
+
+            !$omp parallel do schedule(static, 1) private(j0, j1) num_threads(nthreads)
+            do t=0, nthreads - 1
+                j0 = int(int(t, 8) * npix / nthreads, I4B)
+                j1 = int(int(t + 1, 8) * npix / nthreads, I4B)
+                if (j1 .gt. j0) then
+                    call tod2map_pair_f(pd(:, t), pw(:, t), pdc(:, t), pds(:, t), &
+                    pcc(:, t), pcs(:, t), pss(:, t), pnhit(:, t), waferi1d(j0*nt), &
+                    waferpa(j0*nt), waferts(2*j0*nt), diff_weight(j0), sum_weight(j0), &
+                    j1 - j0, nt, wafermask_pixel(j0*nt), nskypix, 0, nskypix)
+                endif
+            enddo
+            !$omp end parallel do
+
+            !$omp parallel do private(t) num_threads(nthreads)
+            do pixel=0, nskypix - 1
+                do t=0, nthreads - 1
+                    d(pixel) = d(pixel) + pd(pixel, t)
+                    w(pixel) = w(pixel) + pw(pixel, t)
+                    dc(pixel) = dc(pixel) + pdc(pixel, t)
+                    ds(pixel) = ds(pixel) + pds(pixel, t)
+                    cc(pixel) = cc(pixel) + pcc(pixel, t)
+                    cs(pixel) = cs(pixel) + pcs(pixel, t)
+                    ss(pixel) = ss(pixel) + pss(pixel, t)
+                    nhit(pixel) = nhit(pixel) + pnhit(pixel, t)
+                enddo
+            enddo
+            !$omp end parallel do
+
+            deallocate(pd, pw, pdc, pds, pcc, pcs, pss, pnhit)
+        endif
+
+    end subroutine
+
+    subroutine tod2map_pair_gdeprojection_f_omp(d, w, dm, dc, ds, &
+    wm, cc, cs, ss, cv, sv, nhit, waferi1d, &
+    waferpa, waferts, diff_weight, sum_weight, npix, nt, &
+    wafermask_pixel, nskypix, nthreads, tiled)
+        ! Threaded version of tod2map_pair_gdeprojection_f (OpenMP).
+        ! If tiled = 0, each thread bins a slice of detectors into its own
+        ! partial maps, which are then summed in a fixed order
+        ! (deterministic for a given number of threads).
+        ! If tiled > 0, each thread owns a range of sky pixels and scans
+        ! all the samples (no extra memory, for huge patches).
+        implicit none
+
+        integer, parameter       :: I1B = 1
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nthreads, tiled
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(DP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*2 - 1)
+        real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
+
+        real(DP), intent(inout)  :: d(0:nskypix - 1)
+        real(DP), intent(inout)  :: w(0:nskypix - 1)
+        real(DP), intent(inout)  :: dm(0:nskypix - 1)
+        real(DP), intent(inout)  :: dc(0:nskypix - 1)
+        real(DP), intent(inout)  :: ds(0:nskypix - 1)
+        real(DP), intent(inout)  :: wm(0:nskypix - 1)
+        real(DP), intent(inout)  :: cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: cs(0:nskypix - 1)
+        real(DP), intent(inout)  :: ss(0:nskypix - 1)
+        real(DP), intent(inout)  :: cv(0:nskypix - 1)
+        real(DP), intent(inout)  :: sv(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        real(DP), allocatable    :: pd(:, :)
+        real(DP), allocatable    :: pw(:, :)
+        real(DP), allocatable    :: pdm(:, :)
+        real(DP), allocatable    :: pdc(:, :)
+        real(DP), allocatable    :: pds(:, :)
+        real(DP), allocatable    :: pwm(:, :)
+        real(DP), allocatable    :: pcc(:, :)
+        real(DP), allocatable    :: pcs(:, :)
+        real(DP), allocatable    :: pss(:, :)
+        real(DP), allocatable    :: pcv(:, :)
+        real(DP), allocatable    :: psv(:, :)
+        integer(I4B), allocatable :: pnhit(:, :)
+        integer(I4B)             :: t, j0, j1, p0, p1, pixel
+
+        if (tiled .gt. 0) then
+            !$omp parallel do schedule(static, 1) private(p0, p1) num_threads(nthreads)
+            do t=0, nthreads - 1
+                p0 = int(int(t, 8) * nskypix / nthreads, I4B)
+                p1 = int(int(t + 1, 8) * nskypix / nthreads, I4B)
+                call tod2map_pair_gdeprojection_f(d, w, dm, dc, ds, wm, cc, cs, ss, cv, &
+                sv, nhit, waferi1d, waferpa, waferts, diff_weight, sum_weight, npix, &
+                nt, wafermask_pixel, nskypix, p0, p1)
+            enddo
+            !$omp end parallel do
+        else
+            allocate(pd(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pw(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pdm(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pdc(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pds(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pwm(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pcc(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pcs(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pss(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pcv(0:nskypix - 1, 0:nthreads - 1))
+            allocate(psv(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pnhit(0:nskypix - 1, 0:nthreads - 1))
+            pd = 0.0_DP
+            pw = 0.0_DP
+            pdm = 0.0_DP
+            pdc = 0.0_DP
+            pds = 0.0_DP
+            pwm = 0.0_DP
+            pcc = 0.0_DP
+            pcs = 0.0_DP
+            pss = 0.0_DP
+            pcv = 0.0_DP
+            psv = 0.0_DP
+            pnhit = 0
+
+            !$omp parallel do schedule(static, 1) private(j0, j1) num_threads(nthreads)
+            do t=0, nthreads - 1
+                j0 = int(int(t, 8) * npix / nthreads, I4B)
+                j1 = int(int(t + 1, 8) * npix / nthreads, I4B)
+                if (j1 .gt. j0) then
+                    call tod2map_pair_gdeprojection_f(pd(:, t), pw(:, t), pdm(:, t), &
+                    pdc(:, t), pds(:, t), pwm(:, t), pcc(:, t), pcs(:, t), pss(:, t), &
+                    pcv(:, t), psv(:, t), pnhit(:, t), waferi1d(j0*nt), waferpa(j0*nt), &
+                    waferts(2*j0*nt), diff_weight(j0), sum_weight(j0), j1 - j0, nt, &
+                    wafermask_pixel(j0*nt), nskypix, 0, nskypix)
+                endif
+            enddo
+            !$omp end parallel do
+
+            !$omp parallel do private(t) num_threads(nthreads)
+            do pixel=0, nskypix - 1
+                do t=0, nthreads - 1
+                    d(pixel) = d(pixel) + pd(pixel, t)
+                    w(pixel) = w(pixel) + pw(pixel, t)
+                    dm(pixel) = dm(pixel) + pdm(pixel, t)
+                    dc(pixel) = dc(pixel) + pdc(pixel, t)
+                    ds(pixel) = ds(pixel) + pds(pixel, t)
+                    wm(pixel) = wm(pixel) + pwm(pixel, t)
+                    cc(pixel) = cc(pixel) + pcc(pixel, t)
+                    cs(pixel) = cs(pixel) + pcs(pixel, t)
+                    ss(pixel) = ss(pixel) + pss(pixel, t)
+                    cv(pixel) = cv(pixel) + pcv(pixel, t)
+                    sv(pixel) = sv(pixel) + psv(pixel, t)
+                    nhit(pixel) = nhit(pixel) + pnhit(pixel, t)
+                enddo
+            enddo
+            !$omp end parallel do
+
+            deallocate(pd, pw, pdm, pdc, pds, pwm, pcc, pcs, pss, pcv, psv, pnhit)
+        endif
+
+    end subroutine
+
+    subroutine tod2map_hwp_f_omp(d0, d4r, d4i, w0, w4, nhit, waferi1d, &
+    waferpa, waferts, weight4, weight0, npix, nt, &
+    wafermask_pixel, nskypix, nthreads, tiled)
+        ! Threaded version of tod2map_hwp_f (OpenMP).
+        ! If tiled = 0, each thread bins a slice of detectors into its own
+        ! partial maps, which are then summed in a fixed order
+        ! (deterministic for a given number of threads).
+        ! If tiled > 0, each thread owns a range of sky pixels and scans
+        ! all the samples (no extra memory, for huge patches).
+        implicit none
+
+        integer, parameter       :: I1B = 1
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nthreads, tiled
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(DP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*3*2 - 1)
+        real(DP), intent(in)     :: weight4(0:npix - 1), weight0(0:npix - 1)
+
+        real(DP), intent(inout)  :: d0(0:nskypix - 1)
+        real(DP), intent(inout)  :: d4r(0:nskypix - 1)
+        real(DP), intent(inout)  :: d4i(0:nskypix - 1)
+        real(DP), intent(inout)  :: w0(0:nskypix - 1)
+        real(DP), intent(inout)  :: w4(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        real(DP), allocatable    :: pd0(:, :)
+        real(DP), allocatable    :: pd4r(:, :)
+        real(DP), allocatable    :: pd4i(:, :)
+        real(DP), allocatable    :: pw0(:, :)
+        real(DP), allocatable    :: pw4(:, :)
+        integer(I4B), allocatable :: pnhit(:, :)
+        integer(I4B)             :: t, j0, j1, p0, p1, pixel
+
+        if (tiled .gt. 0) then
+            !$omp parallel do schedule(static, 1) private(p0, p1) num_threads(nthreads)
+            do t=0, nthreads - 1
+                p0 = int(int(t, 8) * nskypix / nthreads, I4B)
+                p1 = int(int(t + 1, 8) * nskypix / nthreads, I4B)
+                call tod2map_hwp_f(d0, d4r, d4i, w0, w4, nhit, waferi1d, waferpa, &
+                waferts, weight4, weight0, npix, nt, wafermask_pixel, nskypix, p0, p1)
+            enddo
+            !$omp end parallel do
+        else
+            allocate(pd0(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pd4r(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pd4i(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pw0(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pw4(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pnhit(0:nskypix - 1, 0:nthreads - 1))
+            pd0 = 0.0_DP
+            pd4r = 0.0_DP
+            pd4i = 0.0_DP
+            pw0 = 0.0_DP
+            pw4 = 0.0_DP
+            pnhit = 0
+
+            !$omp parallel do schedule(static, 1) private(j0, j1) num_threads(nthreads)
+            do t=0, nthreads - 1
+                j0 = int(int(t, 8) * npix / nthreads, I4B)
+                j1 = int(int(t + 1, 8) * npix / nthreads, I4B)
+                if (j1 .gt. j0) then
+                    call tod2map_hwp_f(pd0(:, t), pd4r(:, t), pd4i(:, t), pw0(:, t), &
+                    pw4(:, t), pnhit(:, t), waferi1d(j0*nt), waferpa(j0*nt), &
+                    waferts(6*j0*nt), weight4(j0), weight0(j0), j1 - j0, nt, &
+                    wafermask_pixel(j0*nt), nskypix, 0, nskypix)
+                endif
+            enddo
+            !$omp end parallel do
+
+            !$omp parallel do private(t) num_threads(nthreads)
+            do pixel=0, nskypix - 1
+                do t=0, nthreads - 1
+                    d0(pixel) = d0(pixel) + pd0(pixel, t)
+                    d4r(pixel) = d4r(pixel) + pd4r(pixel, t)
+                    d4i(pixel) = d4i(pixel) + pd4i(pixel, t)
+                    w0(pixel) = w0(pixel) + pw0(pixel, t)
+                    w4(pixel) = w4(pixel) + pw4(pixel, t)
+                    nhit(pixel) = nhit(pixel) + pnhit(pixel, t)
+                enddo
+            enddo
+            !$omp end parallel do
+
+            deallocate(pd0, pd4r, pd4i, pw0, pw4, pnhit)
+        endif
+
+    end subroutine
+
+    subroutine tod2map_pair_f_omp_sp(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, &
+    waferpa, waferts, diff_weight, sum_weight, npix, nt, &
+    wafermask_pixel, nskypix, nthreads, tiled)
+        ! Threaded version of tod2map_pair_f_sp (OpenMP).
+        ! If tiled = 0, each thread bins a slice of detectors into its own
+        ! partial maps, which are then summed in a fixed order
+        ! (deterministic for a given number of threads).
+        ! If tiled > 0, each thread owns a range of sky pixels and scans
+        ! all the samples (no extra memory, for huge patches).
+        implicit none
+
+        integer, parameter       :: I1B = 1
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nthreads, tiled
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(SP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*2 - 1)
+        real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
+
+        real(DP), intent(inout)  :: d(0:nskypix - 1)
+        real(DP), intent(inout)  :: w(0:nskypix - 1)
+        real(DP), intent(inout)  :: dc(0:nskypix - 1)
+        real(DP), intent(inout)  :: ds(0:nskypix - 1)
+        real(DP), intent(inout)  :: cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: cs(0:nskypix - 1)
+        real(DP), intent(inout)  :: ss(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        real(DP), allocatable    :: pd(:, :)
+        real(DP), allocatable    :: pw(:, :)
+        real(DP), allocatable    :: pdc(:, :)
+        real(DP), allocatable    :: pds(:, :)
+        real(DP), allocatable    :: pcc(:, :)
+        real(DP), allocatable    :: pcs(:, :)
+        real(DP), allocatable    :: pss(:, :)
+        integer(I4B), allocatable :: pnhit(:, :)
+        integer(I4B)             :: t, j0, j1, p0, p1, pixel
+
+        if (tiled .gt. 0) then
+            !$omp parallel do schedule(static, 1) private(p0, p1) num_threads(nthreads)
+            do t=0, nthreads - 1
+                p0 = int(int(t, 8) * nskypix / nthreads, I4B)
+                p1 = int(int(t + 1, 8) * nskypix / nthreads, I4B)
+                call tod2map_pair_f_sp(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, &
+                waferpa, waferts, diff_weight, sum_weight, npix, nt, wafermask_pixel, &
+                nskypix, p0, p1)
+            enddo
+            !$omp end parallel do
+        else
+            allocate(pd(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pw(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pdc(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pds(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pcc(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pcs(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pss(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pnhit(0:nskypix - 1, 0:nthreads - 1))
+            pd = 0.0_DP
+            pw = 0.0_DP
+            pdc = 0.0_DP
+            pds = 0.0_DP
+            pcc = 0.0_DP
+            pcs = 0.0_DP
+            pss = 0.0_DP
+            pnhit = 0
+
+            !$omp parallel do schedule(static, 1) private(j0, j1) num_threads(nthreads)
+            do t=0, nthreads - 1
+                j0 = int(int(t, 8) * npix / nthreads, I4B)
+                j1 = int(int(t + 1, 8) * npix / nthreads, I4B)
+                if (j1 .gt. j0) then
+                    call tod2map_pair_f_sp(pd(:, t), pw(:, t), pdc(:, t), pds(:, t), &
+                    pcc(:, t), pcs(:, t), pss(:, t), pnhit(:, t), waferi1d(j0*nt), &
+                    waferpa(j0*nt), waferts(2*j0*nt), diff_weight(j0), sum_weight(j0), &
+                    j1 - j0, nt, wafermask_pixel(j0*nt), nskypix, 0, nskypix)
+                endif
+            enddo
+            !$omp end parallel do
+
+            !$omp parallel do private(t) num_threads(nthreads)
+            do pixel=0, nskypix - 1
+                do t=0, nthreads - 1
+                    d(pixel) = d(pixel) + pd(pixel, t)
+                    w(pixel) = w(pixel) + pw(pixel, t)
+                    dc(pixel) = dc(pixel) + pdc(pixel, t)
+                    ds(pixel) = ds(pixel) + pds(pixel, t)
+                    cc(pixel) = cc(pixel) + pcc(pixel, t)
+                    cs(pixel) = cs(pixel) + pcs(pixel, t)
+                    ss(pixel) = ss(pixel) + pss(pixel, t)
+                    nhit(pixel) = nhit(pixel) + pnhit(pixel, t)
+                enddo
+            enddo
+            !$omp end parallel do
+
+            deallocate(pd, pw, pdc, pds, pcc, pcs, pss, pnhit)
+        endif
+
+    end subroutine
+
+    subroutine tod2map_pair_gdeprojection_f_omp_sp(d, w, dm, dc, ds, &
+    wm, cc, cs, ss, cv, sv, nhit, waferi1d, &
+    waferpa, waferts, diff_weight, sum_weight, npix, nt, &
+    wafermask_pixel, nskypix, nthreads, tiled)
+        ! Threaded version of tod2map_pair_gdeprojection_f_sp (OpenMP).
+        ! If tiled = 0, each thread bins a slice of detectors into its own
+        ! partial maps, which are then summed in a fixed order
+        ! (deterministic for a given number of threads).
+        ! If tiled > 0, each thread owns a range of sky pixels and scans
+        ! all the samples (no extra memory, for huge patches).
+        implicit none
+
+        integer, parameter       :: I1B = 1
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nthreads, tiled
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(SP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*2 - 1)
+        real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
+
+        real(DP), intent(inout)  :: d(0:nskypix - 1)
+        real(DP), intent(inout)  :: w(0:nskypix - 1)
+        real(DP), intent(inout)  :: dm(0:nskypix - 1)
+        real(DP), intent(inout)  :: dc(0:nskypix - 1)
+        real(DP), intent(inout)  :: ds(0:nskypix - 1)
+        real(DP), intent(inout)  :: wm(0:nskypix - 1)
+        real(DP), intent(inout)  :: cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: cs(0:nskypix - 1)
+        real(DP), intent(inout)  :: ss(0:nskypix - 1)
+        real(DP), intent(inout)  :: cv(0:nskypix - 1)
+        real(DP), intent(inout)  :: sv(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        real(DP), allocatable    :: pd(:, :)
+        real(DP), allocatable    :: pw(:, :)
+        real(DP), allocatable    :: pdm(:, :)
+        real(DP), allocatable    :: pdc(:, :)
+        real(DP), allocatable    :: pds(:, :)
+        real(DP), allocatable    :: pwm(:, :)
+        real(DP), allocatable    :: pcc(:, :)
+        real(DP), allocatable    :: pcs(:, :)
+        real(DP), allocatable    :: pss(:, :)
+        real(DP), allocatable    :: pcv(:, :)
+        real(DP), allocatable    :: psv(:, :)
+        integer(I4B), allocatable :: pnhit(:, :)
+        integer(I4B)             :: t, j0, j1, p0, p1, pixel
+
+        if (tiled .gt. 0) then
+            !$omp parallel do schedule(static, 1) private(p0, p1) num_threads(nthreads)
+            do t=0, nthreads - 1
+                p0 = int(int(t, 8) * nskypix / nthreads, I4B)
+                p1 = int(int(t + 1, 8) * nskypix / nthreads, I4B)
+                call tod2map_pair_gdeprojection_f_sp(d, w, dm, dc, ds, wm, cc, cs, ss, &
+                cv, sv, nhit, waferi1d, waferpa, waferts, diff_weight, sum_weight, &
+                npix, nt, wafermask_pixel, nskypix, p0, p1)
+            enddo
+            !$omp end parallel do
+        else
+            allocate(pd(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pw(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pdm(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pdc(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pds(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pwm(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pcc(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pcs(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pss(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pcv(0:nskypix - 1, 0:nthreads - 1))
+            allocate(psv(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pnhit(0:nskypix - 1, 0:nthreads - 1))
+            pd = 0.0_DP
+            pw = 0.0_DP
+            pdm = 0.0_DP
+            pdc = 0.0_DP
+            pds = 0.0_DP
+            pwm = 0.0_DP
+            pcc = 0.0_DP
+            pcs = 0.0_DP
+            pss = 0.0_DP
+            pcv = 0.0_DP
+            psv = 0.0_DP
+            pnhit = 0
+
+            !$omp parallel do schedule(static, 1) private(j0, j1) num_threads(nthreads)
+            do t=0, nthreads - 1
+                j0 = int(int(t, 8) * npix / nthreads, I4B)
+                j1 = int(int(t + 1, 8) * npix / nthreads, I4B)
+                if (j1 .gt. j0) then
+                    call tod2map_pair_gdeprojection_f_sp(pd(:, t), pw(:, t), pdm(:, t), &
+                    pdc(:, t), pds(:, t), pwm(:, t), pcc(:, t), pcs(:, t), pss(:, t), &
+                    pcv(:, t), psv(:, t), pnhit(:, t), waferi1d(j0*nt), waferpa(j0*nt), &
+                    waferts(2*j0*nt), diff_weight(j0), sum_weight(j0), j1 - j0, nt, &
+                    wafermask_pixel(j0*nt), nskypix, 0, nskypix)
+                endif
+            enddo
+            !$omp end parallel do
+
+            !$omp parallel do private(t) num_threads(nthreads)
+            do pixel=0, nskypix - 1
+                do t=0, nthreads - 1
+                    d(pixel) = d(pixel) + pd(pixel, t)
+                    w(pixel) = w(pixel) + pw(pixel, t)
+                    dm(pixel) = dm(pixel) + pdm(pixel, t)
+                    dc(pixel) = dc(pixel) + pdc(pixel, t)
+                    ds(pixel) = ds(pixel) + pds(pixel, t)
+                    wm(pixel) = wm(pixel) + pwm(pixel, t)
+                    cc(pixel) = cc(pixel) + pcc(pixel, t)
+                    cs(pixel) = cs(pixel) + pcs(pixel, t)
+                    ss(pixel) = ss(pixel) + pss(pixel, t)
+                    cv(pixel) = cv(pixel) + pcv(pixel, t)
+                    sv(pixel) = sv(pixel) + psv(pixel, t)
+                    nhit(pixel) = nhit(pixel) + pnhit(pixel, t)
+                enddo
+            enddo
+            !$omp end parallel do
+
+            deallocate(pd, pw, pdm, pdc, pds, pwm, pcc, pcs, pss, pcv, psv, pnhit)
+        endif
+
+    end subroutine
+
+    subroutine tod2map_hwp_f_omp_sp(d0, d4r, d4i, w0, w4, nhit, waferi1d, &
+    waferpa, waferts, weight4, weight0, npix, nt, &
+    wafermask_pixel, nskypix, nthreads, tiled)
+        ! Threaded version of tod2map_hwp_f_sp (OpenMP).
+        ! If tiled = 0, each thread bins a slice of detectors into its own
+        ! partial maps, which are then summed in a fixed order
+        ! (deterministic for a given number of threads).
+        ! If tiled > 0, each thread owns a range of sky pixels and scans
+        ! all the samples (no extra memory, for huge patches).
+        implicit none
+
+        integer, parameter       :: I1B = 1
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nthreads, tiled
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I1B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(SP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*3*2 - 1)
+        real(DP), intent(in)     :: weight4(0:npix - 1), weight0(0:npix - 1)
+
+        real(DP), intent(inout)  :: d0(0:nskypix - 1)
+        real(DP), intent(inout)  :: d4r(0:nskypix - 1)
+        real(DP), intent(inout)  :: d4i(0:nskypix - 1)
+        real(DP), intent(inout)  :: w0(0:nskypix - 1)
+        real(DP), intent(inout)  :: w4(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        real(DP), allocatable    :: pd0(:, :)
+        real(DP), allocatable    :: pd4r(:, :)
+        real(DP), allocatable    :: pd4i(:, :)
+        real(DP), allocatable    :: pw0(:, :)
+        real(DP), allocatable    :: pw4(:, :)
+        integer(I4B), allocatable :: pnhit(:, :)
+        integer(I4B)             :: t, j0, j1, p0, p1, pixel
+
+        if (tiled .gt. 0) then
+            !$omp parallel do schedule(static, 1) private(p0, p1) num_threads(nthreads)
+            do t=0, nthreads - 1
+                p0 = int(int(t, 8) * nskypix / nthreads, I4B)
+                p1 = int(int(t + 1, 8) * nskypix / nthreads, I4B)
+                call tod2map_hwp_f_sp(d0, d4r, d4i, w0, w4, nhit, waferi1d, waferpa, &
+                waferts, weight4, weight0, npix, nt, wafermask_pixel, nskypix, p0, p1)
+            enddo
+            !$omp end parallel do
+        else
+            allocate(pd0(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pd4r(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pd4i(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pw0(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pw4(0:nskypix - 1, 0:nthreads - 1))
+            allocate(pnhit(0:nskypix - 1, 0:nthreads - 1))
+            pd0 = 0.0_DP
+            pd4r = 0.0_DP
+            pd4i = 0.0_DP
+            pw0 = 0.0_DP
+            pw4 = 0.0_DP
+            pnhit = 0
+
+            !$omp parallel do schedule(static, 1) private(j0, j1) num_threads(nthreads)
+            do t=0, nthreads - 1
+                j0 = int(int(t, 8) * npix / nthreads, I4B)
+                j1 = int(int(t + 1, 8) * npix / nthreads, I4B)
+                if (j1 .gt. j0) then
+                    call tod2map_hwp_f_sp(pd0(:, t), pd4r(:, t), pd4i(:, t), pw0(:, t), &
+                    pw4(:, t), pnhit(:, t), waferi1d(j0*nt), waferpa(j0*nt), &
+                    waferts(6*j0*nt), weight4(j0), weight0(j0), j1 - j0, nt, &
+                    wafermask_pixel(j0*nt), nskypix, 0, nskypix)
+                endif
+            enddo
+            !$omp end parallel do
+
+            !$omp parallel do private(t) num_threads(nthreads)
+            do pixel=0, nskypix - 1
+                do t=0, nthreads - 1
+                    d0(pixel) = d0(pixel) + pd0(pixel, t)
+                    d4r(pixel) = d4r(pixel) + pd4r(pixel, t)
+                    d4i(pixel) = d4i(pixel) + pd4i(pixel, t)
+                    w0(pixel) = w0(pixel) + pw0(pixel, t)
+                    w4(pixel) = w4(pixel) + pw4(pixel, t)
+                    nhit(pixel) = nhit(pixel) + pnhit(pixel, t)
+                enddo
+            enddo
+            !$omp end parallel do
+
+            deallocate(pd0, pd4r, pd4i, pw0, pw4, pnhit)
+        endif
+
+    end subroutine
+
 end module